@@ -8,6 +8,8 @@ CABLE=papilio
 PROXY=bscan_spi_lx45_csg324.bit
 BIOS_ADDR=0x170000
 RUNTIME_ADDR=0x180000
+# With --i2c-image-flash 0x200000, see tools/mkimage.py
+IMAGE_ADDR=0x200000
 BIN_PREFIX=$PWD/binaries
 PROXY_PATH=$HOME/.migen
 
@@ -21,3 +23,4 @@ cd binaries
 xc3sprog -v -c $CABLE -I$PROXY_PATH/$PROXY $BIN_PREFIX/top.bit:w:0x0:BIT
 xc3sprog -v -c $CABLE -I$PROXY_PATH/$PROXY $BIN_PREFIX/bios.bin:w:$BIOS_ADDR:BIN
 #xc3sprog -v -c $CABLE -I$PROXY_PATH/$PROXY $BIN_PREFIX/runtime.fbi:w:$RUNTIME_ADDR:BIN
+#xc3sprog -v -c $CABLE -I$PROXY_PATH/$PROXY $BIN_PREFIX/images.bin:w:$IMAGE_ADDR:BIN
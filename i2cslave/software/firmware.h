@@ -22,6 +22,7 @@ typedef __u8 __le8;
 typedef __u8 __be8;
 #define htobe8c(x) (x)
 #define htole8c(x) (x)
+#ifndef FX2FW_LINKED
 union fx2fw_t {
     struct {
         struct {
@@ -919,6 +920,7 @@ union fx2fw_t {
         }
     },
 };
+#endif
 union mb2fw_t {
     struct {
         struct {
@@ -1,9 +1,431 @@
 #include <generated/csr.h>
-#ifdef CSR_I2C_BASE
+#ifdef CSR_I2C0_BASE
+#include <stdio.h>
+#include <irq.h>
 #include "i2c.h"
+#include "trace.h"
 
-/* I2C bit banging */
+const struct i2c_core_info i2c_cores[I2C_CORES] = {
+    {
+        .base = CSR_I2C0_BASE,
+        .irq = I2C0_INTERRUPT,
+#ifdef I2C0_EEPROM_BASE
+        .eeprom = I2C0_EEPROM_BASE,
+#endif
+#ifdef I2C0_TRACE_BASE
+        .trace = I2C0_TRACE_BASE,
+#endif
+    },
+#ifdef CSR_I2C1_BASE
+    {
+        .base = CSR_I2C1_BASE,
+        .irq = I2C1_INTERRUPT,
+#ifdef I2C0_EEPROM_BASE
+        .eeprom = I2C1_EEPROM_BASE,
+#endif
+#ifdef I2C0_TRACE_BASE
+        .trace = I2C1_TRACE_BASE,
+#endif
+    },
+#endif
+};
+
+/* One per slave address table entry */
+struct i2c_device {
+    size_t addr; /* next byte the master reads */
+    unsigned char addr_high;
+#ifndef CSR_I2C0_TXN_DATA_ADDR
+    unsigned char loading_low;
+#endif
+};
+
+/* Servicing state of one core, each bus has its own master */
+struct i2c_state {
+    unsigned long base;
+    struct i2c_device devices[I2C_ADDRESSES];
+    /* Device the TX FIFO is filled for, and address of the next byte to
+     * queue */
+    unsigned int tx_dev;
+    size_t tx_addr;
+#ifdef CSR_I2C0_DMA_BASE_ADDR
+    int dma_running;
+#endif
+#ifdef CSR_I2C0_TXN_DATA_ADDR
+    /* Bytes taken from the RX FIFO since the last descriptor, and where
+     * the write going on starts among them, after those of the writes
+     * whose descriptors were dropped */
+    unsigned int rx_pos;
+    unsigned int rx_start;
+#endif
+    /* Between a START and a STOP */
+    volatile int bus_busy;
+};
+
+static struct i2c_state states[I2C_CORES];
+/* i2c_init() was called, the cores are serviced from i2c_isr() */
+static int serviced;
+
+/* Queue as many bytes as the TX FIFO has room for */
+static void tx_refill(struct i2c_state *s)
+{
+    unsigned int n = i2c_tx_free(s->base);
+
+    while(n--) {
+        i2c_write(s->base, TX_DATA, get_eeprom_value(s->tx_dev, s->tx_addr));
+        s->tx_addr++;
+    }
+}
+
+/* Fill the TX FIFO from tx_addr on, by DMA when the bytes are in memory */
+static void tx_start(struct i2c_state *s)
+{
+    unsigned int enable = i2c_read(s->base, EV_ENABLE) & ~I2C_EV_TX;
+#ifdef CSR_I2C0_DMA_BASE_ADDR
+    size_t len;
+    const uint8_t *p = get_eeprom_span(s->tx_dev, s->tx_addr, &len);
+
+    enable &= ~I2C_EV_DMA;
+    s->dma_running = p != NULL;
+    if(p) {
+        if(len > 0xffff)
+            len = 0xffff;
+        i2c_write(s->base, DMA_BASE, (unsigned int)p);
+        i2c_write(s->base, DMA_LENGTH, len);
+        i2c_write(s->base, DMA_MODE, I2C_DMA_TO_TX);
+        i2c_write(s->base, DMA_START, 1);
+        s->tx_addr += len;
+        // The DMA keeps the FIFO topped up, no need for tx events
+        i2c_write(s->base, EV_ENABLE, enable | I2C_EV_DMA);
+        return;
+    }
+#endif
+    i2c_write(s->base, EV_ENABLE, enable | I2C_EV_TX);
+    tx_refill(s);
+}
 
+/* Bytes queued for tx_dev that the master has not read yet */
+static size_t tx_queued(struct i2c_state *s)
+{
+#ifdef CSR_I2C0_DMA_BASE_ADDR
+    unsigned int remaining, level;
+
+    if(s->dma_running) {
+        // The DMA moves bytes from one count to the other meanwhile
+        do {
+            remaining = i2c_read(s->base, DMA_REMAINING);
+            level = i2c_read(s->base, TX_LEVEL);
+        } while(remaining != i2c_read(s->base, DMA_REMAINING));
+        return remaining + level;
+    }
+#endif
+    return i2c_read(s->base, TX_LEVEL);
+}
+
+/* Serve dev from addr on, dropping what was queued for the last device */
+static void tx_switch(struct i2c_state *s, unsigned int dev, size_t addr)
+{
+    size_t queued = tx_queued(s);
+
+    s->devices[s->tx_dev].addr = s->tx_addr - queued;
+    // The flush also cancels a DMA still filling the FIFO
+    i2c_write(s->base, TX_FLUSH, 1);
+    if(queued)
+        trace_record(s->tx_addr - queued, 0, TRACE_FLUSH);
+    s->tx_dev = dev;
+    s->tx_addr = addr;
+    tx_start(s);
+#ifdef CSR_I2C0_TX_CONTEXT_ADDR
+    // Reads from dev are stretched until this is set
+    i2c_write(s->base, TX_CONTEXT, dev);
+#endif
+}
+
+#ifdef CSR_I2C0_TXN_DATA_ADDR
+/* Take n more bytes of the write going on: its first two are a word
+ * address, the image is read only so the rest are dropped */
+static void rx_take(struct i2c_state *s, unsigned int n)
+{
+    while(n--) {
+        unsigned char b = i2c_read(s->base, RX_DATA);
+#ifdef CSR_I2C0_RX_INDEX_ADDR
+        unsigned int dev = i2c_read(s->base, RX_INDEX);
+#else
+        unsigned int dev = 0;
+#endif
+        struct i2c_device *d = &s->devices[dev];
+
+        if(s->rx_pos - s->rx_start == 0)
+            d->addr_high = b;
+        else if(s->rx_pos - s->rx_start == 1)
+            // Reads stay stretched while the RX FIFO holds data, so
+            // replace the queued bytes before popping the address.
+            tx_switch(s, dev, (d->addr_high << 8) | b);
+        s->rx_pos++;
+        i2c_rx_pop(s->base);
+    }
+}
+
+/* Skip the bytes of the writes whose descriptors were dropped, lost of
+ * them since the last descriptor: without their length, their word
+ * addresses cannot be told apart. Bytes already taken as the write going
+ * on may turn out to be one of them. Returns how many were skipped. */
+static unsigned int rx_resync(struct i2c_state *s, unsigned int lost)
+{
+    unsigned int n = 0;
+
+    if(lost <= s->rx_start)
+        return 0;
+    for(; s->rx_pos < lost; s->rx_pos++, n++)
+        i2c_rx_pop(s->base);
+    s->rx_start = lost;
+    return n;
+}
+
+/* Take the writes that are over from their descriptors, then what the
+ * write going on has sent so far */
+static void rx_drain(struct i2c_state *s)
+{
+    unsigned int lost, level, txn, n, bytes;
+
+    for(;;) {
+        // With no descriptor queued after this, the bytes counted are all
+        // from the write going on, but for those lost counts. Nothing is
+        // queued between reading lost and finding the queue empty.
+        lost = i2c_read(s->base, TXN_LOST);
+        level = i2c_read(s->base, RX_LEVEL);
+        n = i2c_read(s->base, TXN_LEVEL);
+        if(!n)
+            break;
+        while(n--) {
+            txn = i2c_read(s->base, TXN_DATA);
+            bytes = I2C_TXN_BYTES(txn);
+            if(txn & I2C_TXN_DROPPED)
+                rx_resync(s, i2c_read(s->base, TXN_LOST));
+            if(!(txn & I2C_TXN_READ) && bytes > s->rx_pos - s->rx_start)
+                rx_take(s, bytes - (s->rx_pos - s->rx_start));
+            s->rx_pos = s->rx_start = 0;
+            i2c_txn_pop(s->base);
+        }
+    }
+    level -= rx_resync(s, lost);
+    rx_take(s, level);
+}
+#else
+/* Take the 2-byte word addresses the master wrote */
+static void rx_drain(struct i2c_state *s)
+{
+    unsigned int n = i2c_read(s->base, RX_LEVEL);
+
+    while(n--) {
+        unsigned char b = i2c_read(s->base, RX_DATA);
+#ifdef CSR_I2C0_RX_INDEX_ADDR
+        unsigned int dev = i2c_read(s->base, RX_INDEX);
+#else
+        unsigned int dev = 0;
+#endif
+        struct i2c_device *d = &s->devices[dev];
+
+        if(d->loading_low)
+            // Reads stay stretched while the RX FIFO holds data, so
+            // replace the queued bytes before popping the address.
+            tx_switch(s, dev, (d->addr_high << 8) | b);
+        else
+            d->addr_high = b;
+        d->loading_low = 1 - d->loading_low;
+        i2c_rx_pop(s->base);
+    }
+}
+#endif
 
+static void core_init(struct i2c_state *s, unsigned long base)
+{
+    unsigned int enable = I2C_EV_RX | I2C_EV_START | I2C_EV_STOP;
+    unsigned int i;
+
+    s->base = base;
+    for(i = 0; i < I2C_ADDRESSES; i++) {
+        s->devices[i].addr = 0;
+#ifndef CSR_I2C0_TXN_DATA_ADDR
+        s->devices[i].loading_low = 0;
+#endif
+    }
+    s->tx_dev = 0;
+    s->tx_addr = 0;
+    s->bus_busy = 0;
+#ifdef CSR_I2C0_MATCH_INDEX_ADDR
+    enable |= I2C_EV_ADDR;
+#endif
+#ifdef CSR_I2C0_TXN_DATA_ADDR
+    // One rx event per word address, taken whole before the read that
+    // follows is stretched waiting on it. The descriptors tell where the
+    // writes end and are popped in bulk, half a queue at a time or along
+    // with the next word address.
+    s->rx_pos = s->rx_start = 0;
+    enable |= I2C_EV_TXN;
+    i2c_write(base, RX_THRESHOLD, 2);
+    i2c_write(base, TXN_THRESHOLD, I2C_TXN_DEPTH/2);
+#endif
+
+    i2c_write(base, EV_PENDING, i2c_read(base, EV_PENDING));
+    i2c_write(base, EV_ENABLE, enable);
+    tx_start(s);
+}
+
+static void core_isr(struct i2c_state *s)
+{
+    unsigned int pending;
+
+    /* Service every source in one go, and go round again for events
+     * raised meanwhile instead of taking another interrupt for them. */
+    while((pending = i2c_read(s->base, EV_PENDING) & i2c_read(s->base, EV_ENABLE))) {
+        i2c_write(s->base, EV_PENDING, pending);
+        if(pending & I2C_EV_START)
+            s->bus_busy = 1;
+#ifdef CSR_I2C0_TXN_DATA_ADDR
+        if(pending & (I2C_EV_RX | I2C_EV_TXN))
+#else
+        if(pending & I2C_EV_RX)
+#endif
+            rx_drain(s);
+#ifdef CSR_I2C0_MATCH_INDEX_ADDR
+        if(pending & I2C_EV_ADDR) {
+            unsigned int dev = i2c_read(s->base, MATCH_INDEX);
+            // Current address read from another device
+            if(dev != s->tx_dev)
+                tx_switch(s, dev, s->devices[dev].addr);
+        }
+#endif
+        if(pending & I2C_EV_TX)
+            tx_refill(s);
+#ifdef CSR_I2C0_DMA_BASE_ADDR
+        if(pending & I2C_EV_DMA)
+            // Past the end of the span, back to the CPU
+            tx_start(s);
+#endif
+        if(pending & I2C_EV_STOP)
+            s->bus_busy = 0;
+    }
+}
+
+void i2c_init(void)
+{
+    unsigned int i, mask = 0;
+
+    for(i = 0; i < I2C_CORES; i++) {
+        core_init(&states[i], i2c_cores[i].base);
+        mask |= 1 << i2c_cores[i].irq;
+    }
+    serviced = 1;
+    irq_setmask(irq_getmask() | mask);
+}
+
+void i2c_isr(unsigned int irqs)
+{
+    unsigned int i;
+
+    for(i = 0; i < I2C_CORES; i++)
+        if(irqs & (1 << i2c_cores[i].irq))
+            core_isr(&states[i]);
+}
+
+int i2c_bus_idle(void)
+{
+    unsigned int i;
+
+    for(i = 0; i < I2C_CORES; i++) {
+#ifdef I2C0_EEPROM_BASE
+        // Before i2c_init(), the gateware serves the EEPROM on its own
+        if(!serviced && i2c_read(i2c_cores[i].base, BUSY))
+            return 0;
+#endif
+        if(states[i].bus_busy)
+            return 0;
+    }
+    return 1;
+}
+
+void i2c_image_changed(unsigned int dev)
+{
+    unsigned int i;
+
+    if(!serviced)
+        return;
+    for(i = 0; i < I2C_CORES; i++) {
+        struct i2c_state *s = &states[i];
+
+        // Bytes already sent came from the old image, the next ones will
+        // not
+        if(s->tx_dev == dev)
+            tx_switch(s, dev, s->tx_addr - tx_queued(s));
+    }
+}
+
+#ifdef CSR_I2C0_PERF_UPDATE_ADDR
+void i2c_perf_print(void)
+{
+    unsigned int i, k;
+
+    for(i = 0; i < I2C_CORES; i++) {
+        unsigned long base = i2c_cores[i].base;
+
+        // Snapshot the counters, so they are consistent with each other
+        i2c_write(base, PERF_UPDATE, 1);
+        printf("i2c core %u: %u starts, %u stops, %u matches, %u NACKs\n", i,
+               i2c_read(base, PERF_STARTS), i2c_read(base, PERF_STOPS),
+               i2c_read(base, PERF_MATCHES), i2c_read(base, PERF_NACKS));
+        printf("  %u bytes read, %u written\n",
+               i2c_read(base, PERF_BYTES_READ),
+               i2c_read(base, PERF_BYTES_WRITTEN));
+        printf("  stretched %u cycles, %u at most\n  stretches by log2(cycles):",
+               i2c_read(base, PERF_STRETCH_CYCLES),
+               i2c_read(base, PERF_STRETCH_MAX));
+        for(k = 0; k < I2C_PERF_HIST_BINS; k++) {
+            i2c_write(base, PERF_HIST_INDEX, k);
+            printf(" %u", i2c_read(base, PERF_HIST_COUNT));
+        }
+        printf("\n");
+    }
+}
+#endif
+
+#ifdef CSR_I2C0_TRACE_ARM_ADDR
+void i2c_trace_arm(unsigned int triggers)
+{
+    unsigned int i;
+
+    for(i = 0; i < I2C_CORES; i++) {
+        unsigned long base = i2c_cores[i].base;
+
+        i2c_write(base, TRACE_TRIGGER_MASK, triggers);
+        // Keep a quarter of the buffer from before the trigger
+        i2c_write(base, TRACE_POST_TRIGGER, I2C_TRACE_DEPTH*3/4);
+        i2c_write(base, TRACE_ARM, 1);
+    }
+}
+
+void i2c_trace_print(void)
+{
+    unsigned int i, k, n, first;
+
+    for(i = 0; i < I2C_CORES; i++) {
+        unsigned long base = i2c_cores[i].base;
+        const volatile uint32_t *entries = (const volatile uint32_t *)i2c_cores[i].trace;
+
+        n = i2c_read(base, TRACE_WRITE_PTR);
+        first = 0;
+        if(i2c_read(base, TRACE_WRAPPED)) {
+            first = n;
+            n = I2C_TRACE_DEPTH;
+        }
+        // Header: core, entries, entry of the trigger, 0 if not done
+        printf("trace %u %u %u %u\n", i, n,
+               (i2c_read(base, TRACE_TRIGGER_PTR) - first) % I2C_TRACE_DEPTH,
+               i2c_read(base, TRACE_DONE));
+        for(k = 0; k < n; k++)
+            printf("%08x%c", entries[(first + k) % I2C_TRACE_DEPTH],
+                   k % 8 == 7 || k == n - 1 ? '\n' : ' ');
+    }
+}
+#endif
 
 #endif
@@ -1,8 +1,149 @@
 #ifndef __I2C_H
 #define __I2C_H
 
-#define I2C_STATUS_SHIFT_REG_FULL  1
-#define I2C_STATUS_SHIFT_REG_EMPTY 2
-#define I2C_STATUS_SHIFT_REG_READY 0
+#include <stddef.h>
+#include <stdint.h>
+#include <hw/common.h>
+#include <generated/csr.h>
+#include <generated/mem.h>
+
+#define I2C_EEPROM_ENABLE 1
+#define I2C_EEPROM_WIDE   2 /* 2-byte word addresses */
+
+/* Event sources, in the order the gateware declares them */
+#define I2C_EV_RX    0x01
+#define I2C_EV_TX    0x02
+#define I2C_EV_ADDR  0x04
+#define I2C_EV_START 0x08
+#define I2C_EV_STOP  0x10
+#ifdef CSR_I2C0_TXN_DATA_ADDR
+#define I2C_EV_TXN   0x20
+#define I2C_EV_DMA   0x40
+#else
+#define I2C_EV_DMA   0x20
+#endif
+
+/* Transaction descriptors, from i2c_txn_data */
+#define I2C_TXN_ADDR(d)    ((d) & 0x7f)
+#define I2C_TXN_READ       0x80
+#define I2C_TXN_END(d)     (((d) >> 8) & 3)
+#define I2C_TXN_DROPPED    0x400 /* descriptors were lost before this one,
+                                   * their written bytes in i2c_txn_lost */
+#define I2C_TXN_INDEX(d)   (((d) >> 11) & 0x1f)
+#define I2C_TXN_BYTES(d)   ((d) >> 16)
+
+/* I2C_TXN_END() */
+#define I2C_TXN_STOP    0
+#define I2C_TXN_RESTART 1
+#define I2C_TXN_NACK    2
+
+/* i2c_trace_trigger_mask, with none the capture starts right away */
+#define I2C_TRACE_FREE_RUN 0
+#define I2C_TRACE_START    0x01
+#define I2C_TRACE_MATCH    0x02
+#define I2C_TRACE_NACK     0x04
+#define I2C_TRACE_STRETCH  0x08
+
+/* i2c_dma_mode */
+#define I2C_DMA_TO_TX   0
+#define I2C_DMA_FROM_RX 1
+
+#ifdef CSR_I2C1_BASE
+#define I2C_CORES 2
+#else
+#define I2C_CORES 1
+#endif
+
+/* One slave core per I2C bus, i2c0 first */
+struct i2c_core_info {
+    unsigned long base; /* CSR base */
+    unsigned int irq;
+#ifdef I2C0_EEPROM_BASE
+    unsigned long eeprom; /* gateware EEPROM memory */
+#endif
+#ifdef I2C0_TRACE_BASE
+    unsigned long trace; /* logic analyzer entries */
+#endif
+};
+
+extern const struct i2c_core_info i2c_cores[I2C_CORES];
+
+/* All cores are built alike, so the registers of any of them are at the
+ * offsets the generated header gives for i2c0. */
+#define I2C_CSR(base, reg) ((base) + CSR_I2C0_##reg##_ADDR - CSR_I2C0_BASE)
+#define i2c_read(base, reg) \
+    i2c_csr_read(I2C_CSR(base, reg), CSR_I2C0_##reg##_SIZE)
+#define i2c_write(base, reg, v) \
+    i2c_csr_write(I2C_CSR(base, reg), CSR_I2C0_##reg##_SIZE, v)
+
+/* CSRs are split in 8-bit words, most significant first */
+static inline unsigned int i2c_csr_read(unsigned long addr, int words)
+{
+    unsigned int r = 0;
+
+    while(words--) {
+        r = (r << 8) | MMPTR(addr);
+        addr += 4;
+    }
+    return r;
+}
+
+static inline void i2c_csr_write(unsigned long addr, int words, unsigned int v)
+{
+    while(words--) {
+        MMPTR(addr) = v >> (8*words);
+        addr += 4;
+    }
+}
+
+/* Number of bytes that can still be queued for the master to read, the
+ * TX side holds a couple more than the FIFO */
+static inline unsigned int i2c_tx_free(unsigned long base)
+{
+    return I2C_TX_DEPTH - i2c_read(base, TX_LEVEL);
+}
+
+/* Drop the byte at the head of the RX FIFO */
+static inline void i2c_rx_pop(unsigned long base)
+{
+    i2c_write(base, RX_DATA, 0);
+}
+
+#ifdef CSR_I2C0_TXN_DATA_ADDR
+/* Drop the oldest transaction descriptor. The CSR strobe comes with the
+ * write of the last word, the others need not be written. */
+static inline void i2c_txn_pop(unsigned long base)
+{
+    MMPTR(I2C_CSR(base, TXN_DATA) + 4*(CSR_I2C0_TXN_DATA_SIZE - 1)) = 0;
+}
+#endif
+
+/* Provided by the application, returns the byte served at addr by dev,
+ * the index of the slave address table entry the master addressed.
+ * Every core serves the same devices. */
+uint8_t get_eeprom_value(unsigned int dev, size_t addr);
+/* Provided by the application on DMA capable gateware: the *len bytes
+ * served from addr on, in memory, or NULL to queue them with
+ * get_eeprom_value() instead. */
+const uint8_t *get_eeprom_span(unsigned int dev, size_t addr, size_t *len);
+
+void i2c_init(void);
+/* Services the cores whose interrupt is set in irqs */
+void i2c_isr(unsigned int irqs);
+/* No transaction going on on any bus */
+int i2c_bus_idle(void);
+/* The image of dev changed, queues its bytes again. Interrupts must be
+ * off. Before i2c_init() there is nothing queued. */
+void i2c_image_changed(unsigned int dev);
+#ifdef CSR_I2C0_PERF_UPDATE_ADDR
+/* Prints the performance counters of every core */
+void i2c_perf_print(void);
+#endif
+#ifdef CSR_I2C0_TRACE_ARM_ADDR
+/* Restarts the logic analyzer captures, with the given trigger_mask */
+void i2c_trace_arm(unsigned int triggers);
+/* Prints the captures for tools/trace2vcd.py */
+void i2c_trace_print(void);
+#endif
 
 #endif /* __I2C_H */
@@ -0,0 +1,137 @@
+#include <generated/csr.h>
+#include <stdio.h>
+#include <string.h>
+#include <irq.h>
+#include <crc.h>
+
+#include "image.h"
+
+struct image {
+    const uint8_t *bytes;
+    size_t size;
+    int cached;
+};
+
+static struct image images[I2C_ADDRESSES];
+
+/* Direct mapped, tagged with the device and the index of the line in its
+ * image */
+struct image_line {
+    int valid;
+    unsigned int dev;
+    size_t line;
+    uint8_t bytes[IMAGE_LINE];
+};
+
+static struct image_line cache[IMAGE_LINES];
+
+/* Line after the last one read, set from the I2C interrupt */
+static volatile unsigned int next_dev;
+static volatile size_t next_line;
+
+void image_init(const uint8_t *flash, size_t len)
+{
+    const uint8_t *end = flash + len;
+    const struct image_header *h;
+    unsigned int i;
+
+    for(i = 0; i < I2C_ADDRESSES; i++) {
+        h = (const struct image_header *)flash;
+        flash += sizeof(*h);
+        // Erased flash reads as all ones, so no magic there either
+        if(flash > end || h->magic != IMAGE_MAGIC) {
+            printf("No image %u in flash\n", i);
+            break;
+        }
+        if(h->size > (size_t)(end - flash) || crc32(flash, h->size) != h->crc) {
+            printf("Image %u in flash is corrupt\n", i);
+            break;
+        }
+        image_set(i, flash, h->size, 1);
+        printf("Image %u: %u bytes from flash\n", i, (unsigned int)h->size);
+        flash += (h->size + 3) & ~3;
+    }
+}
+
+void image_set(unsigned int dev, const uint8_t *bytes, size_t size,
+               int cached)
+{
+    unsigned int ie = irq_getie();
+    unsigned int i;
+
+    // Not while the I2C interrupt reads the image
+    irq_setie(0);
+    images[dev].bytes = bytes;
+    images[dev].size = size;
+    images[dev].cached = cached;
+    for(i = 0; i < IMAGE_LINES; i++)
+        if(cache[i].dev == dev)
+            cache[i].valid = 0;
+    irq_setie(ie);
+}
+
+size_t image_size(unsigned int dev)
+{
+    return dev < I2C_ADDRESSES ? images[dev].size : 0;
+}
+
+const uint8_t *image_bytes(unsigned int dev)
+{
+    return images[dev].bytes;
+}
+
+static struct image_line *line_of(unsigned int dev, size_t line)
+{
+    // Keep the same lines of two images apart
+    return &cache[(line + dev*IMAGE_LINES/2) % IMAGE_LINES];
+}
+
+static int line_cached(struct image_line *l, unsigned int dev, size_t line)
+{
+    return l->valid && l->dev == dev && l->line == line;
+}
+
+static void line_fill(struct image_line *l, unsigned int dev, size_t line)
+{
+    size_t start = line*IMAGE_LINE;
+    size_t len = images[dev].size - start;
+
+    if(len > IMAGE_LINE)
+        len = IMAGE_LINE;
+    memcpy(l->bytes, images[dev].bytes + start, len);
+    l->dev = dev;
+    l->line = line;
+    l->valid = 1;
+}
+
+uint8_t image_read(unsigned int dev, size_t addr)
+{
+    size_t line = addr / IMAGE_LINE;
+    struct image_line *l = line_of(dev, line);
+
+    if(!images[dev].cached)
+        return images[dev].bytes[addr];
+    if(!line_cached(l, dev, line))
+        line_fill(l, dev, line);
+    next_dev = dev;
+    next_line = line + 1;
+    return l->bytes[addr % IMAGE_LINE];
+}
+
+void image_prefetch(void)
+{
+    unsigned int dev;
+    size_t line;
+    struct image_line *l;
+
+    // image_read() may fill the same line meanwhile, so no interrupts
+    // while this one is
+    irq_setie(0);
+    dev = next_dev;
+    line = next_line;
+    l = line_of(dev, line);
+    if(images[dev].cached && line*IMAGE_LINE < images[dev].size &&
+       !line_cached(l, dev, line))
+        line_fill(l, dev, line);
+    irq_setie(1);
+}
@@ -0,0 +1,43 @@
+#ifndef __IMAGE_H
+#define __IMAGE_H
+
+#include <stddef.h>
+#include <stdint.h>
+
+/* Images served by each slave address table entry, from memory or from
+ * the image partition in flash.
+ *
+ * The image partition in flash holds one image per slave address table
+ * entry, in table order. Each is this header followed by size bytes,
+ * padded to 4 bytes, see tools/mkimage.py. Fields are big endian. */
+#define IMAGE_MAGIC 0x49324349 /* "I2CI" */
+
+struct image_header {
+    uint32_t magic;
+    uint32_t size;
+    uint32_t crc; /* CRC-32 of the size bytes */
+};
+
+/* Reads from flash go through a cache of IMAGE_LINES lines of IMAGE_LINE
+ * bytes, each a power of two */
+#define IMAGE_LINE  64
+#define IMAGE_LINES 16
+
+/* Finds and checks the images in the len bytes of the partition at flash,
+ * and serves them */
+void image_init(const uint8_t *flash, size_t len);
+/* Serves the size bytes at bytes for dev from now on, through the cache
+ * if cached. The previous image is no longer read once this returns. */
+void image_set(unsigned int dev, const uint8_t *bytes, size_t size,
+               int cached);
+/* Size of the image of dev, 0 if it has none */
+size_t image_size(unsigned int dev);
+/* The image of dev, for the gateware to read from */
+const uint8_t *image_bytes(unsigned int dev);
+/* Byte at addr of the image of dev, addr < image_size(dev) */
+uint8_t image_read(unsigned int dev, size_t addr);
+/* Loads the line after the last one read into the cache, from the main
+ * loop, so sequential reads never wait on the flash */
+void image_prefetch(void);
+
+#endif /* __IMAGE_H */
@@ -2,6 +2,8 @@
 #include <irq.h>
 #include <uart.h>
 
+#include "i2c.h"
+
 void isr(void);
 void isr(void)
 {
@@ -11,4 +13,6 @@ void isr(void)
     
     if(irqs & (1 << UART_INTERRUPT))
         uart_isr();
+
+    i2c_isr(irqs);
 }
@@ -6,62 +6,203 @@
 #include <console.h>
 #include <system.h>
 #include <generated/csr.h>
+#include <generated/mem.h>
 #include <hw/flags.h>
 
 #include "i2c.h"
+#include "trace.h"
+#include "image.h"
+#include "upload.h"
+#ifndef I2C_IMAGE_FLASH_OFFSET
 #include "firmware.h"
+#endif
 
 #define I2C_SLAVE_ADDRESS 0x40
+/* The FX2 looks for its boot EEPROM there */
+#define I2C_FX2_ADDRESS   0x51
 
-#define SET_ADDR(x) do { addr = (x) % sizeof(fx2fw); } while(false)
+/* Table entries the gateware has a reset address for */
+#ifndef I2C_RESET_ADDRS
+#define I2C_RESET_ADDRS 0
+#endif
 
-inline uint8_t get_eeprom_value(size_t addr) {
+#ifndef I2C_IMAGE_FLASH_OFFSET
+#ifdef FX2FW_LINKED
+/* Linked in from the fw2header.py asm output, see the Makefile */
+extern const uint8_t fx2fw_start[], fx2fw_size[];
+#define FX2FW_BYTES fx2fw_start
+#define FX2FW_SIZE  ((size_t)fx2fw_size)
+#else
+#define FX2FW_BYTES fx2fw.bytes
+#define FX2FW_SIZE  sizeof(fx2fw)
+#endif
+#endif
+
+uint8_t get_eeprom_value(unsigned int dev, size_t addr) {
 	uint8_t r = 0xff;
-	if (addr < sizeof(mb2fw)) {
-		printf("R");
-		r = mb2fw.bytes[addr];
-	} else {
-		printf("r");
+	uint8_t flags = 0;
+	if (addr < image_size(dev)) {
+		r = image_read(dev, addr);
+		flags = TRACE_HIT;
 	}
-        //printf("%04x %02x\n", addr, r);
+	trace_record(addr, r, flags);
 
 	return r;
 }
 
+#ifdef CSR_I2C0_DMA_BASE_ADDR
+const uint8_t *get_eeprom_span(unsigned int dev, size_t addr, size_t *len) {
+	if (addr >= image_size(dev))
+		return NULL;
+	*len = image_size(dev) - addr;
+	// Straight from flash for images there, past the cache
+	trace_record(addr, image_bytes(dev)[addr], TRACE_HIT | TRACE_DMA);
+
+	return &image_bytes(dev)[addr];
+}
+#endif
+
+#ifdef I2C0_EEPROM_BASE
+/* Hand the images to the gateware, which then serves reads on its own.
+ * Each table entry has a bank of its own. The gateware may already serve
+ * the start of the images from the bitstream, they are the same bytes.
+ * Returns 0 when an image is larger than its bank. */
+static int eeprom_load(const struct i2c_core_info *core)
+{
+    const size_t bank = I2C0_EEPROM_SIZE / I2C_ADDRESSES;
+    unsigned int i;
+    int fits = 1;
+
+    for(i = 0; i < I2C_ADDRESSES; i++) {
+        unsigned char *dst = (unsigned char *)core->eeprom + i*bank;
+        size_t len = image_size(i);
+
+        if(len > bank) {
+            len = bank;
+            fits = 0;
+        }
+        if(len)
+            memcpy(dst, image_bytes(i), len);
+        memset(dst + len, 0xff, bank - len);
+    }
+    i2c_write(core->base, EEPROM_CTRL, I2C_EEPROM_ENABLE | I2C_EEPROM_WIDE);
+    return fits;
+}
+
+/* Take over from the gateware and serve the images from the CPU. The
+ * gateware keeps serving the transaction going on, if any, up to its
+ * STOP. */
+static void eeprom_hand_over(void)
+{
+    unsigned int i;
+
+    for(i = 0; i < I2C_CORES; i++)
+        i2c_write(i2c_cores[i].base, EEPROM_CTRL, 0);
+    i2c_init();
+}
+#endif
+
+/* One key commands on the console */
+static void console_command(char c)
+{
+    switch(c) {
+#ifdef CSR_I2C0_PERF_UPDATE_ADDR
+    case 'p':
+        i2c_perf_print();
+        break;
+#endif
+#ifdef CSR_I2C0_TRACE_ARM_ADDR
+    case 'a':
+        // Capture the next NACK
+        i2c_trace_arm(I2C_TRACE_NACK);
+        break;
+    case 'f':
+        i2c_trace_arm(I2C_TRACE_FREE_RUN);
+        break;
+    case 't':
+        i2c_trace_print();
+        break;
+#endif
+    default:
+        break;
+    }
+}
+
 int main(void)
 {
-    size_t addr = 0x0;
-    unsigned char loading_low = 0;
+    unsigned int i;
+#ifdef I2C0_EEPROM_BASE
+    int fits = 1;
+#endif
+
     irq_setmask(0);
     irq_setie(1);
     uart_init();
 
     puts("I2C runtime built "__DATE__" "__TIME__"\n");
+#ifdef I2C_IMAGE_FLASH_OFFSET
+    image_init((const uint8_t *)(ROM_BASE + I2C_IMAGE_FLASH_OFFSET),
+               ROM_SIZE - I2C_IMAGE_FLASH_OFFSET);
+#else
+    image_set(0, mb2fw.bytes, sizeof(mb2fw), 0);
+#if I2C_ADDRESSES > 1
+    image_set(1, FX2FW_BYTES, FX2FW_SIZE, 0);
+#endif
+#endif
 
-    i2c_slave_addr_write(I2C_SLAVE_ADDRESS);
-    i2c_shift_reg_write(get_eeprom_value(addr));
-    i2c_status_write(I2C_STATUS_SHIFT_REG_READY);
+    for(i = 0; i < I2C_CORES; i++) {
+        // The gateware answers the entries with a reset address from
+        // configuration on, they keep it
+        if(I2C_RESET_ADDRS < 1)
+            i2c_write(i2c_cores[i].base, MATCH0_ADDR, I2C_SLAVE_ADDRESS);
+#if I2C_ADDRESSES > 1
+        if(I2C_RESET_ADDRS < 2) {
+            i2c_write(i2c_cores[i].base, MATCH1_ADDR, I2C_FX2_ADDRESS);
+            i2c_write(i2c_cores[i].base, MATCH1_ENABLE, 1);
+        }
+#endif
+#ifdef I2C0_EEPROM_BASE
+        fits &= eeprom_load(&i2c_cores[i]);
+#endif
+    }
+    trace_init();
+    upload_init();
+#ifdef I2C0_EEPROM_BASE
+    if(fits)
+        puts("Serving EEPROM from gateware");
+    else {
+        // The gateware only holds the start of the images, serve them
+        // whole from here on
+        eeprom_hand_over();
+        puts("Images larger than the gateware EEPROM, serving them from the CPU");
+    }
+#else
+    i2c_init();
+#endif
     puts("Started!");
     while(1) {
-        unsigned char status = i2c_status_read();
-        if(status == I2C_STATUS_SHIFT_REG_EMPTY) // there's been a master READ
-        {
-            addr++;
-            i2c_shift_reg_write(get_eeprom_value(addr));
-            i2c_status_write(I2C_STATUS_SHIFT_REG_READY);
-        } else if(status == I2C_STATUS_SHIFT_REG_FULL) // there's been a master WRITE
-        {
-            if(loading_low)
-                addr |= i2c_shift_reg_read() & 0xFF;
-            else
-                addr = i2c_shift_reg_read() << 8;
-            if(loading_low)
-                i2c_shift_reg_write(get_eeprom_value(addr));
-            loading_low = 1 - loading_low;
-            i2c_status_write(I2C_STATUS_SHIFT_REG_READY);
-
-        } else if (status != 0)
-            printf("wuut? %02X\n", status);
+        // The I2C core is serviced from i2c_isr(), only spend the UART
+        // time on the trace while no transaction is going on, and while
+        // the UART is not busy with an upload.
+        while(i2c_bus_idle() && !upload_active() && trace_drain_one());
+        image_prefetch();
+#ifdef I2C0_EEPROM_BASE
+        // The gateware has the old image, an uploaded one is served from
+        // the CPU
+        if(upload_poll() && fits) {
+            eeprom_hand_over();
+            fits = 0;
+        }
+#else
+        upload_poll();
+#endif
+        // Keep up with uploads coming at the full line rate
+        while(readchar_nonblock()) {
+            char c = readchar();
+
+            if(!upload_feed(c))
+                console_command(c);
+        }
     }
     return 0;
 }
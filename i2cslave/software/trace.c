@@ -0,0 +1,83 @@
+#include <generated/csr.h>
+#include <uart.h>
+
+#include "trace.h"
+
+/* Single producer (the I2C interrupt) single consumer (the main loop) ring,
+ * so the indexes only ever get written from one side each. */
+static struct trace_event events[TRACE_EVENTS];
+static volatile unsigned int head;
+static volatile unsigned int tail;
+static volatile unsigned int dropped;
+static unsigned int dropped_sent;
+
+uint32_t trace_timestamp(void)
+{
+    timer0_update_value_write(1);
+    return ~timer0_value_read();
+}
+
+void trace_init(void)
+{
+    head = tail = dropped = dropped_sent = 0;
+    timer0_en_write(0);
+    timer0_reload_write(0xffffffff);
+    timer0_load_write(0xffffffff);
+    timer0_en_write(1);
+}
+
+void trace_record(uint16_t addr, uint8_t value, uint8_t flags)
+{
+    struct trace_event *e;
+
+    if(head - tail == TRACE_EVENTS) {
+        dropped++;
+        return;
+    }
+    e = &events[head % TRACE_EVENTS];
+    e->timestamp = trace_timestamp();
+    e->addr = addr;
+    e->value = value;
+    e->flags = flags;
+    head++;
+}
+
+static void trace_send(const struct trace_event *e)
+{
+    const unsigned char *p = (const unsigned char *)e;
+    unsigned char sum = 0;
+    unsigned int i;
+
+    // The LM32 is big endian, so the struct is already in wire order
+    uart_write(TRACE_SYNC);
+    for(i = 0; i < sizeof(*e); i++) {
+        uart_write(p[i]);
+        sum ^= p[i];
+    }
+    uart_write(sum);
+}
+
+/* Send the oldest event to the UART, returns 0 once there is nothing left */
+int trace_drain_one(void)
+{
+    unsigned int lost = dropped - dropped_sent;
+
+    if(lost) {
+        struct trace_event e;
+
+        if(lost > 0xffff)
+            lost = 0xffff;
+        e.timestamp = trace_timestamp();
+        e.addr = lost;
+        e.value = 0;
+        e.flags = TRACE_DROPPED;
+        dropped_sent += lost;
+        trace_send(&e);
+        return 1;
+    }
+    if(tail == head)
+        return 0;
+    trace_send(&events[tail % TRACE_EVENTS]);
+    tail++;
+    return 1;
+}
@@ -0,0 +1,33 @@
+#ifndef __TRACE_H
+#define __TRACE_H
+
+#include <stdint.h>
+
+#define TRACE_SYNC    0xa5
+#define TRACE_EVENTS  512 /* must be a power of two */
+
+/* Event flags */
+#define TRACE_HIT     0x01 /* address was inside the image */
+#define TRACE_DMA     0x02 /* the rest of the image from addr on goes by DMA */
+#define TRACE_FLUSH   0x04 /* bytes queued from addr on were dropped unsent */
+#define TRACE_DROPPED 0x80 /* addr holds the number of events lost */
+
+/* Bytes are recorded as they are queued, before the master reads them, a
+ * TRACE_FLUSH event then takes back those it never did.
+ *
+ * On the UART each event goes out as TRACE_SYNC, the 8 bytes below (big
+ * endian) and the XOR of those 8 bytes, see tools/trace2log.py. */
+struct trace_event {
+    uint32_t timestamp; /* sys clock cycles */
+    uint16_t addr;
+    uint8_t value;
+    uint8_t flags;
+} __attribute__((packed));
+
+void trace_init(void);
+/* sys clock cycles, counting from trace_init() */
+uint32_t trace_timestamp(void);
+void trace_record(uint16_t addr, uint8_t value, uint8_t flags);
+int trace_drain_one(void);
+
+#endif /* __TRACE_H */
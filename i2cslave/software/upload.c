@@ -0,0 +1,244 @@
+#include <generated/csr.h>
+#include <string.h>
+#include <irq.h>
+#include <uart.h>
+#include <crc.h>
+
+#include "i2c.h"
+#include "image.h"
+#include "trace.h"
+#include "upload.h"
+
+/* In sys clock cycles, about 10 ms and 2 s at 83 MHz: a frame is dropped
+ * once its bytes stop coming, an upload once its frames do */
+#define UPLOAD_BYTE_TIMEOUT 1000000
+#define UPLOAD_IDLE_TIMEOUT 200000000
+
+/* One buffer per device for the image it serves, and one to upload the
+ * next image into. Buffer i is only used once device i commits an upload
+ * for the first time, the one it gives back becomes the next to upload
+ * into. */
+static uint8_t buffers[I2C_ADDRESSES + 1][UPLOAD_MAX_SIZE];
+static int live[I2C_ADDRESSES]; /* buffer served by each device, or -1 */
+static unsigned int staging;
+
+/* Frame being received, without its sync byte */
+static uint8_t frame[3 + 4 + UPLOAD_CHUNK + 4];
+static int in_frame;
+static unsigned int frame_pos;
+static unsigned int frame_len;
+static uint32_t last_byte;
+
+/* Upload going on */
+static int active;
+static int commit_pending;
+static int committed;
+static unsigned int dev;
+static uint32_t size;
+static uint32_t crc;
+static uint32_t received;
+static int nak_sent;
+static uint32_t last_frame;
+
+static uint32_t be32(const uint8_t *p)
+{
+    return ((uint32_t)p[0] << 24) | (p[1] << 16) | (p[2] << 8) | p[3];
+}
+
+static void put_be32(uint8_t *p, uint32_t v)
+{
+    p[0] = v >> 24;
+    p[1] = v >> 16;
+    p[2] = v >> 8;
+    p[3] = v;
+}
+
+static void reply(uint8_t code, uint32_t value)
+{
+    uint8_t r[9];
+    unsigned int i;
+
+    r[0] = code;
+    put_be32(&r[1], value);
+    put_be32(&r[5], crc32(r, 5));
+    uart_write(UPLOAD_SYNC);
+    for(i = 0; i < sizeof(r); i++)
+        uart_write(r[i]);
+}
+
+/* Frames after a lost one are out of order, one NAK is enough for the
+ * host to go back */
+static void nak(void)
+{
+    if(active && !nak_sent) {
+        reply(UPLOAD_NAK, received);
+        nak_sent = 1;
+    }
+}
+
+static void begin(const uint8_t *p, unsigned int n)
+{
+    if(n != 9 || commit_pending) {
+        reply(UPLOAD_ERROR, UPLOAD_ERROR_FRAME);
+        return;
+    }
+    if(p[0] >= I2C_ADDRESSES || be32(&p[1]) > UPLOAD_MAX_SIZE) {
+        reply(UPLOAD_ERROR, UPLOAD_ERROR_SIZE);
+        return;
+    }
+    // A BEGIN sent again restarts the upload
+    dev = p[0];
+    size = be32(&p[1]);
+    crc = be32(&p[5]);
+    received = 0;
+    nak_sent = 0;
+    committed = 0;
+    active = 1;
+    reply(UPLOAD_ACK, received);
+}
+
+static void data(const uint8_t *p, unsigned int n)
+{
+    if(!active || commit_pending || n < 4) {
+        reply(UPLOAD_ERROR, UPLOAD_ERROR_FRAME);
+        return;
+    }
+    n -= 4;
+    if(be32(p) != received) {
+        nak();
+        return;
+    }
+    if(received + n > size) {
+        active = 0;
+        reply(UPLOAD_ERROR, UPLOAD_ERROR_SIZE);
+        return;
+    }
+    memcpy(&buffers[staging][received], &p[4], n);
+    received += n;
+    nak_sent = 0;
+    reply(UPLOAD_ACK, received);
+}
+
+static void commit(void)
+{
+    if(committed) {
+        // The host missed the DONE
+        reply(UPLOAD_DONE, crc);
+        return;
+    }
+    if(!active) {
+        reply(UPLOAD_ERROR, UPLOAD_ERROR_FRAME);
+        return;
+    }
+    if(commit_pending)
+        return;
+    if(received != size || crc32(buffers[staging], size) != crc) {
+        active = 0;
+        reply(UPLOAD_ERROR, UPLOAD_ERROR_CRC);
+        return;
+    }
+    // Swapped by upload_poll() between two transactions
+    commit_pending = 1;
+}
+
+static void frame_take(void)
+{
+    unsigned int n = frame_len - 7;
+
+    if(crc32(frame, frame_len - 4) != be32(&frame[frame_len - 4])) {
+        nak();
+        return;
+    }
+    last_frame = last_byte;
+    switch(frame[0]) {
+    case UPLOAD_BEGIN:
+        begin(&frame[3], n);
+        break;
+    case UPLOAD_DATA:
+        data(&frame[3], n);
+        break;
+    case UPLOAD_COMMIT:
+        commit();
+        break;
+    case UPLOAD_ABORT:
+        if(!commit_pending)
+            active = 0;
+        reply(UPLOAD_ACK, received);
+        break;
+    default:
+        reply(UPLOAD_ERROR, UPLOAD_ERROR_FRAME);
+        break;
+    }
+}
+
+void upload_init(void)
+{
+    unsigned int i;
+
+    for(i = 0; i < I2C_ADDRESSES; i++)
+        live[i] = -1;
+    staging = I2C_ADDRESSES;
+    in_frame = active = commit_pending = committed = 0;
+}
+
+int upload_feed(char c)
+{
+    uint8_t b = c;
+    uint32_t now = trace_timestamp();
+
+    if(in_frame && now - last_byte > UPLOAD_BYTE_TIMEOUT)
+        in_frame = 0;
+    last_byte = now;
+    if(!in_frame) {
+        if(b != UPLOAD_SYNC)
+            return 0;
+        in_frame = 1;
+        frame_pos = 0;
+        frame_len = 3;
+        return 1;
+    }
+    frame[frame_pos++] = b;
+    if(frame_pos == 3) {
+        frame_len = 3 + ((frame[1] << 8) | frame[2]) + 4;
+        if(frame_len > sizeof(frame)) {
+            // Lost bytes, look for the next sync
+            in_frame = 0;
+            nak();
+            return 1;
+        }
+    }
+    if(frame_pos == frame_len) {
+        in_frame = 0;
+        frame_take();
+    }
+    return 1;
+}
+
+int upload_poll(void)
+{
+    int given_back;
+
+    if(commit_pending && i2c_bus_idle()) {
+        irq_setie(0);
+        image_set(dev, buffers[staging], size, 0);
+        i2c_image_changed(dev);
+        irq_setie(1);
+        given_back = live[dev];
+        live[dev] = staging;
+        staging = given_back >= 0 ? (unsigned int)given_back : dev;
+        commit_pending = 0;
+        active = 0;
+        committed = 1;
+        reply(UPLOAD_DONE, crc);
+        return 1;
+    }
+    if(active && !commit_pending &&
+       trace_timestamp() - last_frame > UPLOAD_IDLE_TIMEOUT)
+        active = 0;
+    return 0;
+}
+
+int upload_active(void)
+{
+    return active || in_frame;
+}
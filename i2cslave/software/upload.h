@@ -0,0 +1,46 @@
+#ifndef __UPLOAD_H
+#define __UPLOAD_H
+
+#include <stdint.h>
+
+/* Images uploaded over the UART into memory, see tools/upload.py.
+ *
+ * Every frame starts with UPLOAD_SYNC, then the type, the length of the
+ * payload (16 bits), the payload and the CRC-32 of the type, length and
+ * payload. Fields are big endian. Replies are UPLOAD_SYNC, a code, a
+ * 32-bit value and the CRC-32 of the code and value.
+ *
+ * An upload goes to a buffer of its own, the old image is served until
+ * the new one is committed. Data frames are taken in order only: the
+ * host streams up to a window of them ahead, and goes back to the offset
+ * of a NAK or, without replies, of the last ACK. */
+#define UPLOAD_SYNC     0xc3
+#define UPLOAD_CHUNK    256     /* most data bytes in a frame */
+#define UPLOAD_MAX_SIZE 0x10000 /* the reach of 2-byte word addresses */
+
+/* Frame types */
+#define UPLOAD_BEGIN  1 /* u8 device, u32 size, u32 CRC-32 of the image */
+#define UPLOAD_DATA   2 /* u32 offset, then the bytes */
+#define UPLOAD_COMMIT 3 /* serve the image once its CRC checks */
+#define UPLOAD_ABORT  4
+
+/* Reply codes */
+#define UPLOAD_ACK   0 /* value: offset of the next byte expected */
+#define UPLOAD_NAK   1 /* value: offset to send again from */
+#define UPLOAD_DONE  2 /* value: CRC-32 of the image now served */
+#define UPLOAD_ERROR 3 /* value: one of the errors below */
+
+#define UPLOAD_ERROR_FRAME 1 /* unknown frame, or no upload going on */
+#define UPLOAD_ERROR_SIZE  2 /* bad device or size */
+#define UPLOAD_ERROR_CRC   3 /* the image does not match its CRC */
+
+void upload_init(void);
+/* Takes c from the UART, returns 0 if it is not part of a frame */
+int upload_feed(char c);
+/* Commits and times out uploads, from the main loop. Returns 1 when an
+ * image was committed, it is served from the next transaction on. */
+int upload_poll(void);
+/* An upload is going on, the UART is all for it */
+int upload_active(void);
+
+#endif /* __UPLOAD_H */
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""Randomized differential testing of I2CEngineCore against I2CShiftReg.
+
+Every run is a random list of transactions: reads, writes, repeated
+starts, wrong addresses, early NACKs from the master and SDA bounces while
+SCL is low. The same master plays it into both cores, which must answer
+alike: the ACK bits and bytes the master sees, the bytes and transaction
+descriptors that reach the CPU side and whether the bus hangs. Runs are seeded, so the seeds can be
+split over processes (-j) and machines (--shard). Each run that fails is
+minimized and saved as a JSON reproducer to replay.
+
+    $ python -m i2cslave.targets.i2c_diff -n 1000 -j 16
+    $ python -m i2cslave.targets.i2c_diff --shard 3/8 -n 100000 -t 20
+    $ python -m i2cslave.targets.i2c_diff --replay diff_failures/seed17.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from functools import partial
+
+from migen import *
+
+from .i2c_sim import I2CBus, I2CMaster
+from .pipistrello_i2c import I2CEngineCore, I2CShiftReg
+
+# Address the cores answer to
+ADDRESS = 0x50
+# Addresses of other devices, the reserved 0000xxx and 1111xxx ones
+# (general call, Hs-mode master codes, 10-bit addressing) are left out
+OTHER_ADDRESSES = [a for a in range(0x08, 0x78) if a != ADDRESS]
+
+
+def read_data(k):
+    """Byte k of what the CPU side queues for the master to read."""
+    return (0x5a + 0x3b*k) & 0xff
+
+
+def _strobe(csr):
+    """Pulses csr.re, returns once the core has seen it."""
+    yield csr.re.eq(1)
+    yield
+    yield csr.re.eq(0)
+    yield
+
+
+class CoreBus(I2CBus):
+    """core answering ADDRESS. Its CPU side drains the RX FIFO and the
+    transaction queue and keeps the TX FIFO full with read_data() right
+    away."""
+    def __init__(self, core):
+        I2CBus.__init__(self, core=core, fifo_depth=4, txn_depth=4)
+
+    def setup(self):
+        yield self.dut.match0.addr.storage.eq(ADDRESS)
+        if hasattr(self.dut, "sample_div"):
+            # sample every cycle, the master is much faster than Fast mode
+            yield self.dut.sample_div.storage.eq(0)
+        yield
+
+    @passive
+    def cpu(self, received, txns):
+        dut = self.dut
+        sent = 0
+        while True:
+            if (yield dut.rx_level.status):
+                received.append((yield dut.rx_data.w))
+                yield from _strobe(dut.rx_data)
+            elif (yield dut.txn.level.status):
+                txns.append((yield dut.txn.data.w))
+                yield from _strobe(dut.txn.data)
+            elif (yield dut.tx_level.status) < dut.tx_depth:
+                yield dut.tx_data.r.eq(read_data(sent))
+                sent += 1
+                yield from _strobe(dut.tx_data)
+            else:
+                yield
+
+
+# The reference first
+CORES = {
+    "I2CShiftReg": partial(CoreBus, I2CShiftReg),
+    "I2CEngineCore": partial(CoreBus, I2CEngineCore),
+}
+
+
+class BusHang(Exception):
+    pass
+
+
+class DiffMaster(I2CMaster):
+    """I2CMaster giving up on SCL stretches longer than timeout cycles.
+
+    Bits whose number in the transaction (9 per byte, ACK included) is in
+    glitches get SDA bounced to the other level first, while SCL is low.
+    """
+    def __init__(self, bus, half_period, timeout):
+        I2CMaster.__init__(self, bus, half_period)
+        self.timeout = timeout
+        self.glitches = set()
+        self.bit_count = 0
+
+    def _scl_high(self):
+        yield self.bus.master_scl.eq(1)
+        for i in range(self.timeout):
+            yield
+            self.cycles += 1
+            if (yield self.bus.scl):
+                return
+        raise BusHang
+
+    def _bit(self, b):
+        if self.bit_count in self.glitches:
+            yield self.bus.master_sda.eq(1 - b)
+            yield from self._wait(max(self.half_period//4, 1))
+        self.bit_count += 1
+        return (yield from I2CMaster._bit(self, b))
+
+
+def transact(master, t):
+    """Plays the transaction t, returns what the master saw."""
+    master.glitches = {byte*9 + bit for byte, bit in t.get("glitches", [])}
+    master.bit_count = 0
+    yield from master.start()
+    acks = [(yield from master.write((t["addr"] << 1) | ("read" in t)))]
+    for b in t.get("write", []):
+        acks.append((yield from master.write(b)))
+    read = []
+    for i in range(t.get("read", 0)):
+        read.append((yield from master.read(i != t["read"] - 1)))
+    if not t.get("restart"):
+        yield from master.stop()
+    return {"acks": acks, "read": read}
+
+
+def run_core(core, transactions, half_period=8, timeout=4096):
+    """Plays transactions into core, one of CORES.
+
+    Returns what the master saw in each transaction, the bytes and the
+    transaction descriptors received on the CPU side, and the transaction
+    the bus hung in, if it did.
+    """
+    bus = CORES[core]()
+    master = DiffMaster(bus, half_period, timeout)
+    result = {"transactions": [], "received": [], "txns": [], "hang": None}
+
+    def bench():
+        yield from bus.setup()
+        for i, t in enumerate(transactions):
+            try:
+                result["transactions"].append((yield from transact(master, t)))
+            except BusHang:
+                result["hang"] = i
+                return
+        if transactions and transactions[-1].get("restart"):
+            yield from master.stop()
+        # let the last byte reach the CPU side
+        yield from master._wait(4*half_period)
+
+    run_simulation(bus, [bench(), bus.cpu(result["received"], result["txns"])])
+    return result
+
+
+def compare(transactions, **kwargs):
+    """Runs transactions into every core.
+
+    Returns how the first core that differs from the reference does, None
+    if they all agree, and the results of all of them.
+    """
+    results = {core: run_core(core, transactions, **kwargs) for core in CORES}
+    ref_core, ref = next(iter(results.items()))
+    for core, r in results.items():
+        if r["hang"] != ref["hang"]:
+            return "%s hangs in transaction %s, %s in %s" % (
+                ref_core, ref["hang"], core, r["hang"]), results
+        for i, (a, b) in enumerate(zip(ref["transactions"], r["transactions"])):
+            if a != b:
+                return "transaction %d: %s sees %s, %s %s" % (
+                    i, ref_core, a, core, b), results
+        if r["received"] != ref["received"]:
+            return "%s receives %s, %s %s" % (
+                ref_core, ref["received"], core, r["received"]), results
+        if r["txns"] != ref["txns"]:
+            return "%s queues descriptors %s, %s %s" % (
+                ref_core, [hex(d) for d in ref["txns"]], core,
+                [hex(d) for d in r["txns"]]), results
+    return None, results
+
+
+# What random_run() generates: reads, writes, repeated starts, addresses
+# of other devices and SDA bounces
+KINDS = ("read", "write", "restart", "other", "glitch")
+
+
+def random_run(rng, n, kinds=KINDS, max_bytes=4, glitch_rate=0.1):
+    """n random transactions of the given kinds, of up to max_bytes data
+    bytes."""
+    assert "read" in kinds or "write" in kinds
+    transactions = []
+    for i in range(n):
+        t = {"addr": ADDRESS}
+        if "other" in kinds and rng.random() < 0.2:
+            t["addr"] = rng.choice(OTHER_ADDRESSES)
+        if "read" not in kinds or ("write" in kinds and rng.random() < 0.5):
+            t["write"] = [rng.randrange(256)
+                          for k in range(rng.randint(0, max_bytes))]
+        else:
+            # the master NACKs the last byte, so early when it is short
+            t["read"] = rng.randint(1, max_bytes)
+        if "restart" in kinds and rng.random() < 0.25:
+            t["restart"] = True
+        nbytes = 1 + len(t.get("write", [])) + t.get("read", 0)
+        glitches = [[rng.randrange(nbytes), rng.randrange(9)]
+                    for k in range(nbytes)
+                    if "glitch" in kinds and rng.random() < glitch_rate]
+        if glitches:
+            t["glitches"] = glitches
+        transactions.append(t)
+    return transactions
+
+
+def _simpler(t):
+    """Variants of the transaction t, one step simpler each."""
+    for key in ("glitches", "restart"):
+        if key in t:
+            yield {k: v for k, v in t.items() if k != key}
+    for i in range(len(t.get("glitches", []))):
+        yield dict(t, glitches=t["glitches"][:i] + t["glitches"][i + 1:])
+    if t.get("read", 0) > 1:
+        yield dict(t, read=t["read"] - 1)
+    for i in range(len(t.get("write", []))):
+        yield dict(t, write=t["write"][:i] + t["write"][i + 1:])
+    if t["addr"] != ADDRESS and t["addr"] != OTHER_ADDRESSES[0]:
+        yield dict(t, addr=OTHER_ADDRESSES[0])
+
+
+def minimize(transactions, fails):
+    """Shrinks transactions as long as fails(transactions) holds: drops
+    chunks of transactions, halving their size down to single ones, then
+    simplifies those left one step at a time."""
+    chunk = len(transactions)//2
+    while chunk >= 1:
+        i = 0
+        while i < len(transactions):
+            candidate = transactions[:i] + transactions[i + chunk:]
+            if candidate and fails(candidate):
+                transactions = candidate
+            else:
+                i += chunk
+        chunk //= 2
+
+    simplified = True
+    while simplified:
+        simplified = False
+        for i, t in enumerate(transactions):
+            for s in _simpler(t):
+                candidate = transactions[:i] + [s] + transactions[i + 1:]
+                if fails(candidate):
+                    transactions = candidate
+                    simplified = True
+                    break
+    return transactions
+
+
+def check_run(settings, seed):
+    """Runs the transactions of seed, returns None if the cores agree,
+    else the reproducer, also saved to the output directory."""
+    rng = random.Random(seed)
+    transactions = random_run(rng, settings["transactions"], settings["kinds"],
+                              settings["max_bytes"], settings["glitch_rate"])
+    kwargs = {"half_period": settings["half_period"]}
+    difference, results = compare(transactions, **kwargs)
+    if difference is None:
+        return None
+
+    original = transactions
+    if settings["minimize"]:
+        transactions = minimize(
+            transactions, lambda ts: compare(ts, **kwargs)[0] is not None)
+        difference, results = compare(transactions, **kwargs)
+    reproducer = {
+        "seed": seed,
+        "half_period": settings["half_period"],
+        "difference": difference,
+        "transactions": transactions,
+        "results": results,
+        "original": original,
+    }
+    os.makedirs(settings["out"], exist_ok=True)
+    filename = os.path.join(settings["out"], "seed%d.json" % seed)
+    with open(filename, "w") as f:
+        json.dump(reproducer, f, indent=2)
+        f.write("\n")
+    reproducer["filename"] = filename
+    return reproducer
+
+
+def replay(filename):
+    with open(filename) as f:
+        reproducer = json.load(f)
+    difference, results = compare(reproducer["transactions"],
+                                  half_period=reproducer["half_period"])
+    for i, t in enumerate(reproducer["transactions"]):
+        print("%d: %s" % (i, json.dumps(t)))
+        for core, r in results.items():
+            if i < len(r["transactions"]):
+                print("    %-12s %s" % (core, r["transactions"][i]))
+    for core, r in results.items():
+        print("%-12s received %s, descriptors %s, hang %s" % (
+            core, r["received"], [hex(d) for d in r["txns"]], r["hang"]))
+    print(difference or "no difference")
+    return 1 if difference else 0
+
+
+def _shard(s):
+    k, n = (int(x) for x in s.split("/"))
+    if not 0 <= k < n:
+        raise argparse.ArgumentTypeError("shard must be K/N with 0 <= K < N")
+    return k, n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Differential testing of"
+                                                 " I2CEngineCore against"
+                                                 " I2CShiftReg")
+    parser.add_argument("-n", "--runs", default=100, type=int,
+                        help="number of seeded runs. Default: 100")
+    parser.add_argument("-t", "--transactions", default=10, type=int,
+                        help="transactions per run. Default: 10")
+    parser.add_argument("-s", "--seed", default=0, type=int,
+                        help="seed of the first run. Default: 0")
+    parser.add_argument("--shard", default=(0, 1), type=_shard,
+                        help="K/N, only run the seeds equal to K modulo N."
+                             " Default: 0/1")
+    parser.add_argument("-j", "--jobs", default=os.cpu_count(), type=int,
+                        help="number of processes. Default: one per CPU")
+    parser.add_argument("-k", "--kinds", default=",".join(KINDS),
+                        help="comma separated kinds of transactions."
+                             " Default: " + ",".join(KINDS))
+    parser.add_argument("-b", "--max-bytes", default=4, type=int,
+                        help="data bytes per transaction, at most."
+                             " Default: 4")
+    parser.add_argument("--glitch-rate", default=0.1, type=float,
+                        help="chance of an SDA bounce in each byte."
+                             " Default: 0.1")
+    parser.add_argument("--half-period", default=8, type=int,
+                        help="SCL half period in sys clock cycles."
+                             " Default: 8")
+    parser.add_argument("--max-failures", default=10, type=int,
+                        help="stop after that many failing runs, 0 for no"
+                             " limit. Default: 10")
+    parser.add_argument("--no-minimize", action="store_true",
+                        help="save failing runs as they are")
+    parser.add_argument("-o", "--out", default="diff_failures",
+                        help="directory of the reproducers."
+                             " Default: diff_failures")
+    parser.add_argument("--replay",
+                        help="run a reproducer again and show both cores")
+    args = parser.parse_args()
+
+    if args.replay:
+        return replay(args.replay)
+
+    kinds = args.kinds.split(",")
+    unknown = set(kinds) - set(KINDS)
+    if unknown or not {"read", "write"} & set(kinds):
+        parser.error("kinds must be among %s, with read or write" %
+                     ",".join(KINDS))
+
+    settings = {
+        "transactions": args.transactions,
+        "kinds": kinds,
+        "max_bytes": args.max_bytes,
+        "glitch_rate": args.glitch_rate,
+        "half_period": args.half_period,
+        "minimize": not args.no_minimize,
+        "out": args.out,
+    }
+    k, n = args.shard
+    seeds = [s for s in range(args.seed, args.seed + args.runs) if s % n == k]
+
+    # small chunks spread short runs over every process
+    chunksize = max(1, min(16, len(seeds)//(4*args.jobs)))
+    failures = []
+    runs = 0
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.jobs) as pool:
+        for reproducer in pool.imap_unordered(partial(check_run, settings),
+                                              seeds, chunksize=chunksize):
+            runs += 1
+            if reproducer is None:
+                continue
+            failures.append(reproducer)
+            print("seed %d: %s, %d of %d transactions left in %s" % (
+                reproducer["seed"], reproducer["difference"],
+                len(reproducer["transactions"]),
+                len(reproducer["original"]), reproducer["filename"]))
+            if args.max_failures and len(failures) >= args.max_failures:
+                pool.terminate()
+                break
+    elapsed = time.perf_counter() - start
+
+    print("%d runs, %d transactions, %d failed, %.1fs (%.2f transactions/s)"
+          % (runs, runs*args.transactions, len(failures), elapsed,
+             runs*args.transactions/elapsed))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
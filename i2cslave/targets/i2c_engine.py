@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""The parts of I2CEngine, and the engine itself, see I2CEngineCore in
+pipistrello_i2c.py. Their tests are in i2c_parts.py."""
+
+from migen import *
+
+##########################################################################
+##########################################################################
+
+def Shift(sig, direction, d=0):
+    if direction == "right":
+        return Cat(sig[1:], d)
+    elif direction == "left":
+        return Cat(d, sig[:-1])
+
+def Rotate(sig, direction):
+    if direction == "right":
+        return Shift(sig, "right", sig[0])
+    elif direction == "left":
+        return Shift(sig, "left", sig[-1])
+
+##########################################################################
+##########################################################################
+
+class I2CStartCondition(Module):
+    """
+    A start condition is SDA going low and then SCL going low.
+    """
+    def __init__(self):
+        self.scl = Signal(reset=1)      # Clock signal
+        self.sda = Signal(reset=1)      # Data signal
+        self.detected = Signal(reset=0) # Detected start condition
+        self.submodules.fsm = fsm = FSM("PRE")
+
+        # Starting from SCL and SDA high. 
+        fsm.act("PRE",   # 00
+            If((self.scl == 1) & (self.sda == 1), NextState("SDA")),
+        )
+
+        # SCL is high and SDA is high, wait for SDA to go low
+        fsm.act("SDA",   # 01
+            If(self.sda == 0, NextState("SCL")),
+            # Take preference when both change at the same time.
+            If(self.scl != 1, NextState("PRE")), 
+        )
+
+        # SDA is low, wait for SCL to go low
+        fsm.act("SCL",   # 10
+            If(self.scl == 0, NextState("DET")),
+            # Take preference when both change at the same time.
+            If(self.sda != 0, NextState("PRE")),
+        )
+
+        # We have a start condition!
+        fsm.act("DET",     # 11
+            self.detected.eq(1),
+            NextState("PRE"),
+        )
+
+
+
+class I2CStopCondition(Module):
+    """
+    Stop conditions are defined by a 0->1 (low to high) transition on SDA after
+    a 0->1 transition on SCL, with SCL remaining high.
+    """
+    def __init__(self):
+        self.scl = Signal(reset=1)      # Clock signal
+        self.sda = Signal(reset=1)      # Data signal
+        self.detected = Signal(reset=0) # Detected stop condition
+
+        self.submodules.fsm = fsm = FSM("PRE")
+
+        # Starting from SCL and SDA low. 
+        fsm.act("PRE",   # 00
+            If((self.scl == 0) & (self.sda == 0), NextState("SCL")),
+        )
+
+        # SCL is low and SDA is low, wait for SCL to go high
+        fsm.act("SCL",   # 01
+            If(self.scl == 1, NextState("SDA")),
+            # Take preference when both change at the same time.
+            If(self.sda != 0, NextState("PRE")),
+        )
+
+        # SCL is high and SDA is low, wait for SDA to go high
+        fsm.act("SDA",   # 10
+            If(self.sda == 1, NextState("DET")),
+            # Take preference when both change at the same time.
+            If(self.scl != 1, NextState("PRE")),
+        )
+
+        # We have a stop condition!
+        fsm.act("DET",     # 11
+            self.detected.eq(1),
+            NextState("PRE"),
+        )
+
+
+class I2CAcker(Module):
+    """Module which handles the ACK in I2C (with clock stretching).
+
+    Setting ack.eq(1) will cause module to drive SDA low for one cycle.
+    Setting hold.eq(1) will cause module to drive SCL low until it is released.
+    """
+
+    def __init__(self):
+        # Clock signal
+        self.scl_oe = scl_oe = Signal(reset=0)
+        self.scl_r = scl_r = Signal(reset=1)
+        self.scl_w = scl_w = Signal(reset=0)
+
+        # Data signal
+        self.sda_oe = sda_oe = Signal(reset=0)
+        self.sda_r = sda_r = Signal(reset=1)
+        self.sda_w = sda_w = Signal(reset=0)
+
+        self.run = run = Signal(reset=0)
+        self.ack = ack = Signal(reset=0)
+        self.hold = hold = Signal(reset=0)
+        self.finished = finished = Signal(reset=0)
+
+        self.submodules.fsm = fsm = FSM("INIT")
+        fsm.act("INIT",
+            NextValue(sda_oe, 0),
+            NextValue(scl_oe, 0),
+            If((run == 1),
+                NextState("WAITING_START"),
+            ),
+        )
+
+        fsm.act("WAITING_START",
+            If(scl_r == 0,
+                NextValue(sda_oe, ack),
+                NextValue(sda_w, 0),
+                NextValue(scl_oe, hold),
+                NextValue(scl_w,  0),
+                NextState("STRETCHING"),
+            ),
+        )
+
+        fsm.act("STRETCHING",
+            If(hold == 0,
+                NextValue(scl_oe, 0),
+                NextState("WAITING_SCL_HIGH"),
+            ),
+        )
+
+        fsm.act("WAITING_SCL_HIGH",
+            If(scl_r == 1,
+                NextState("WAITING_SCL_LOW"),
+            ),
+        )
+
+        fsm.act("WAITING_SCL_LOW",
+            If(scl_r == 0,
+                NextValue(sda_oe, 0),
+                NextState("DONE"),
+            ),
+        )
+
+        fsm.act("DONE",
+            finished.eq(1),
+        )
+
+        # If we stop running, force everything back to IDLE
+        for state in fsm.actions.keys():
+            fsm.act(state, If(run == 0, NextState("INIT")))
+
+##########################################################################
+##########################################################################
+
+class I2CDataShifter(Module):
+    """Module which handles the shifting of 8 bits of data."""
+
+    DATA_SIZE = 8
+
+    def __init__(self):
+        self.scl = scl = Signal(reset=1) # Clock signal
+        self.sda_r = sda_r = Signal(reset=1) # Data signal
+        self.sda_w = sda_w = Signal(reset=0) # Data signal
+
+        # Signals to the outside world
+        self.din = din = Signal(self.DATA_SIZE)
+        self.dout = dout = Signal(self.DATA_SIZE)
+        self.run = run = Signal(reset=0)
+        self.finished = finished = Signal(reset=0)
+        # dout <= load_data, while not running
+        self.load = load = Signal(reset=0)
+        self.load_data = load_data = Signal(self.DATA_SIZE)
+
+        self.sync += If(load, dout.eq(load_data))
+
+        self._bit_index = bit_index = Signal(min=0, max=self.DATA_SIZE)
+        self.submodules.fsm = fsm = FSM("INIT")
+        fsm.act("INIT",
+            NextValue(sda_w, 1),
+            If((run == 1) & (scl == 0),
+                NextValue(bit_index, 0),
+                NextState("SHIFT_OUT"),
+            ),
+        )
+
+        # Data changes while SCL is low, MSB first
+        fsm.act("SHIFT_OUT",
+            NextValue(sda_w, dout[-1]),
+            NextValue(dout, Shift(dout, "left")),
+            NextState("SHIFTED_OUT"),
+        )
+
+        fsm.act("SHIFTED_OUT",
+            If(scl == 1,
+                NextState("SHIFT_IN"),
+            ),
+        )
+
+        # Data should be stable while SCL is high
+        fsm.act("SHIFT_IN",
+            NextValue(din, Shift(din, "left", sda_r)),
+            NextState("SHIFTED_IN"),
+        )
+
+        fsm.act("SHIFTED_IN",
+            If(scl == 0,
+                If(bit_index < self.DATA_SIZE-1,
+                    NextValue(bit_index, bit_index+1),
+                    NextState("SHIFT_OUT"),
+                ).Else(
+                    NextState("DONE"),
+                ),
+            ),
+        )
+
+        fsm.act("DONE",
+            finished.eq(1),
+        )
+
+        # If we stop running, force everything back to IDLE
+        for state in fsm.actions.keys():
+            fsm.act(state, If(run == 0, NextState("INIT")))
+
+##########################################################################
+##########################################################################
+
+class I2CStateMachine(Module):
+    """Frames the bytes on the bus: the address byte and its ACK, then the
+    data bytes and their ACKs. The framing is the same for reads and
+    writes, which side drives SDA is up to the user.
+
+    A STOP goes back to IDLE and a (repeated) START to ADDR from any state,
+    error pulses the cycle after one came in the middle of a byte or an
+    ACK.
+    """
+    def __init__(self):
+        self.start_detected = start_detected = Signal(reset=0)
+        self.stop_detected = stop_detected = Signal(reset=0)
+
+        self.data_run = data_run = Signal(reset=0)
+        self.data_next = data_next = Signal(reset=0)
+        self.data_finished = data_finished = Signal(reset=0)
+
+        self.ack_run = ack_run = Signal(reset=0)
+        self.ack_finished = ack_finished = Signal(reset=0)
+
+        self.addr_ready = addr_ready = Signal(reset=0)
+        self.data_ready = data_ready = Signal(reset=0)
+        self.idle = idle = Signal(reset=0)
+        self.error = error = Signal(reset=0)
+
+        self.submodules.fsm = fsm = FSM("IDLE")
+
+        # Nothing happening
+        fsm.act("IDLE",
+            idle.eq(1),
+        )
+
+        # Reading addr byte
+        fsm.act("ADDR",
+            data_run.eq(1),
+            If(data_finished == 1,
+                NextState("ADDR_ACK"),
+            ),
+        )
+
+        # Ack the addr byte
+        fsm.act("ADDR_ACK",
+            ack_run.eq(1),
+            addr_ready.eq(1),
+            If(ack_finished == 1,
+                NextState("DATA"),
+            )
+        )
+
+        # Reading the data bytes
+        fsm.act("DATA",
+            data_run.eq(1),
+            If(data_finished == 1,
+                NextState("DATA_ACK"),
+            ),
+        )
+
+        # Ack the data byte
+        fsm.act("DATA_ACK",
+            ack_run.eq(1),
+            data_ready.eq(1),
+            If(ack_finished == 1,
+                NextState("WAITING"),
+            )
+        )
+
+        # Wait for either,
+        #  * Start of next data byte
+        #  * Start condition
+        #  * Stop condition
+        fsm.act("WAITING",
+            data_run.eq(1),
+            # Just another data byte
+            If(data_next,
+                NextState("DATA"),
+            ),
+        )
+
+        # Stop and (repeated) start conditions, from any state
+        for state in fsm.actions.keys():
+            fsm.act(state,
+                If(stop_detected,
+                    NextState("IDLE"),
+                ),
+                If(start_detected,
+                    NextState("ADDR"),
+                ),
+            )
+        self.sync += error.eq((start_detected | stop_detected) &
+                              ~fsm.ongoing("IDLE") & ~fsm.ongoing("WAITING"))
+
+##########################################################################
+##########################################################################
+
+class I2CEngine(Module):
+    """I2C slave built from the parts above.
+
+    It answers to address, or with address=None to the addresses for
+    which addr_hit is driven high from addr. Bytes the master writes are
+    pushed out with rx_we, SCL is stretched while rx_writable is low. The
+    bytes the master reads are popped with tx_re once tx_readable and
+    read_ready are both high, stretching meanwhile. matched pulses once
+    the engine is addressed, is_read then holds the direction and waiting
+    is high while SCL is stretched. byte_read pulses as the master ACKs or
+    NACKs a byte it read, nack for a NACK.
+
+    The bus side is open-drain: scl_oe and sda_oe pull the lines low,
+    scl_w and sda_w stay low.
+    """
+    def __init__(self, address=0x50):
+
+        # Clock signal
+        self.scl_r  = scl_r  = Signal(reset=1, name="scl_r")
+        self.scl_w  = scl_w  = Signal(reset=0, name="scl_w")
+        self.scl_oe = scl_oe = Signal(reset=0, name="scl_oe")
+
+        # Data signal
+        self.sda_r  = sda_r  = Signal(reset=1, name="sda_r")
+        self.sda_w  = sda_w  = Signal(reset=0, name="sda_w")
+        self.sda_oe = sda_oe = Signal(reset=0, name="sda_oe")
+
+        # Address
+        self.addr = addr = Signal(7)
+        self.addr_hit = addr_hit = Signal()
+        self.matched = matched = Signal()
+        self.is_read = is_read = Signal()
+
+        # Bytes read by the master
+        self.tx_byte = tx_byte = Signal(8)
+        self.tx_readable = tx_readable = Signal(reset=0)
+        self.tx_re = tx_re = Signal()
+        self.read_ready = read_ready = Signal(reset=1)
+
+        # Bytes written by the master
+        self.rx_byte = rx_byte = Signal(8)
+        self.rx_writable = rx_writable = Signal(reset=1)
+        self.rx_we = rx_we = Signal()
+
+        self.waiting = waiting = Signal()
+        self.byte_read = byte_read = Signal()
+        self.nack = nack = Signal()
+
+        self.submodules.start = start = I2CStartCondition()
+        self.comb += [start.scl.eq(scl_r), start.sda.eq(sda_r)]
+
+        self.submodules.stop = stop = I2CStopCondition()
+        self.comb += [stop.scl.eq(scl_r), stop.sda.eq(sda_r)]
+
+        self.submodules.data = data = I2CDataShifter()
+        self.comb += [
+            data.scl.eq(scl_r),
+            data.sda_r.eq(sda_r),
+        ]
+
+        self.submodules.ack = ack = I2CAcker()
+        self.comb += [
+            ack.scl_r.eq(scl_r),
+            ack.sda_r.eq(sda_r),
+        ]
+
+        # Addressed, until a START, a STOP or a NACK from the master
+        selected = Signal()
+        # The next byte to send is still to be popped
+        tx_pending = Signal()
+        tx_stretch = Signal()
+        rx_wanted = Signal()
+        rx_pushed = Signal()
+        rx_hold = Signal()
+        addr_seen = Signal()
+        master_ack = Signal()
+        scl_last = Signal(reset=1)
+
+        self.submodules.state = state = I2CStateMachine()
+        self.comb += [
+            state.start_detected.eq(start.detected),
+            state.stop_detected.eq(stop.detected),
+
+            state.data_next.eq(data.run & (data._bit_index == 1)),
+            state.data_finished.eq(data.finished),
+            state.ack_finished.eq(ack.finished),
+
+            # A START restarts the shifter, reads wait for their byte
+            data.run.eq(state.data_run & ~start.detected & ~tx_pending),
+            ack.run.eq(state.ack_run),
+        ]
+
+        if address is not None:
+            self.address = Signal(7, reset=address)
+            self.comb += addr_hit.eq(addr == self.address)
+
+        self.comb += [
+            addr.eq(data.din[1:]),
+            matched.eq(state.addr_ready & ~addr_seen & addr_hit),
+
+            # ACK the address and the bytes written, the master ACKs reads
+            If(state.addr_ready,
+                ack.ack.eq(addr_hit),
+            ).Else(
+                ack.ack.eq(selected & ~is_read),
+            ),
+
+            rx_byte.eq(data.din),
+            rx_wanted.eq(state.data_ready & selected & ~is_read & ~rx_pushed),
+            rx_we.eq(rx_wanted & rx_writable),
+            rx_hold.eq(rx_wanted & ~rx_writable),
+            ack.hold.eq(rx_hold),
+
+            master_ack.eq(state.data_ready & selected & is_read &
+                          scl_r & ~scl_last),
+            byte_read.eq(master_ack),
+            nack.eq(master_ack & sda_r),
+            tx_re.eq(tx_pending & tx_readable & read_ready),
+            data.load.eq(tx_re),
+            data.load_data.eq(tx_byte),
+
+            waiting.eq(rx_hold | tx_stretch),
+            scl_oe.eq(ack.scl_oe | tx_stretch),
+            scl_w.eq(0),
+            sda_oe.eq(ack.sda_oe |
+                      (selected & is_read & data.run & ~data.sda_w)),
+            sda_w.eq(0),
+        ]
+
+        self.sync += [
+            scl_last.eq(scl_r),
+            addr_seen.eq(state.addr_ready),
+            If(~state.data_ready,
+                rx_pushed.eq(0),
+            ).Elif(rx_we,
+                rx_pushed.eq(1),
+            ),
+            If(start.detected | stop.detected,
+                selected.eq(0),
+                is_read.eq(0),
+                tx_pending.eq(0),
+            ).Elif(matched,
+                selected.eq(1),
+                is_read.eq(data.din[0]),
+                tx_pending.eq(data.din[0]),
+            ).Elif(master_ack,
+                If(sda_r,
+                    selected.eq(0),
+                ).Else(
+                    tx_pending.eq(1),
+                ),
+            ).Elif(tx_re,
+                tx_pending.eq(0),
+            ),
+            # Only hold SCL once the master has taken it low after the
+            # ACK, and until the first bit of the byte is on SDA
+            If(tx_pending & selected,
+                If(~scl_r & state.data_run,
+                    tx_stretch.eq(1),
+                ),
+            ).Elif(data.fsm.ongoing("SHIFTED_OUT") | ~selected,
+                tx_stretch.eq(0),
+            ),
+        ]
@@ -4,6 +4,12 @@
 from migen import *
 from migen.fhdl.specials import Tristate
 
+# Run as a script from this directory, or imported as part of the package
+if __package__:
+    from .vcd_helpers import simulate
+else:
+    from vcd_helpers import simulate
+
 class I2CPads(Module):
     def __init__(self, pads, obj):
         self.submodules += obj
@@ -77,9 +83,7 @@ class I2CMunger(Module):
         )
 
 
-if __name__ == "__main__":
-    #run_simulation(my_blinker, ncycles=200, vcd_name="i2c_munger.vcd")
-
+def TestI2CMunger(vcd=None, artifacts="build"):
     lines = [x.split() for x in """\
              S   0       1       2       3       4       5       6       7       A
 sda    ▔▔\▁▁▁▁▁----XXXX----XXXX----XXXX----XXXX----XXXX----XXXX----XXXX----▁▁▁▁▁▁▁▁▁/▔▔▔▔▔▔▔
@@ -116,19 +120,49 @@ scl_r  ▔▔▔▔\▁▁▁/▔▔▔\▁▁▁/▔▔▔\▁▁▁/▔▔▔\
             bits.append(i)
             l = i
         real[name] = bits
-    import pprint
 
     def test(dut):
+        # bits SDA is driven in, while SCL is low and while it is high
+        driven_low = set()
+        driven_high = set()
+        scl_prev = 1
         for sda_r, scl_r in zip(real['sda_r'], real['scl_r']):
             yield dut.sda_r.eq(sda_r)
             yield dut.scl_r.eq(scl_r)
-            yield
-            yield
-            yield
-            yield
-            yield
-            yield
+            for i in range(6):
+                yield
+                assert not (yield dut.scl_oe)
+                if (yield dut.sda_oe):
+                    bit = yield dut.current_bit
+                    # the FSM follows SCL one cycle later
+                    if scl_r and scl_prev:
+                        driven_high.add(bit)
+                    elif not scl_r and not scl_prev:
+                        driven_low.add(bit)
+                scl_prev = scl_r
+        # after the START, bit 2 is forced and SDA is let go again before
+        # bit 3 is sampled
+        assert driven_high == {2}, driven_high
+        assert driven_low == {2, 3}, driven_low
 
     dut = I2CMunger()
-    run_simulation(dut, test(dut), vcd_name="test.vcd")
+    dump = simulate(dut, [test(dut)], "i2c_munger", vcd)
+    if dump:
+        dump.write()
+
+
+TESTS = [
+    TestI2CMunger,
+]
+
+
+if __name__ == "__main__":
+    import argparse
+    from vcd_helpers import add_vcd_args, vcd_settings
+
+    parser = argparse.ArgumentParser(description="Simulate the I2CMunger")
+    add_vcd_args(parser)
+    vcd = vcd_settings(parser.parse_args())
 
+    for test in TESTS:
+        test(vcd)
@@ -1,26 +1,29 @@
 #!/usr/bin/env python3
 # vim: set ts=4 sw=4 et sts=4 ai:
 
+import argparse
+import hashlib
+import inspect
+import os
+
+import numpy as np
+
 from migen import *
 from migen.fhdl.specials import Tristate
 
-from fsm_test_helpers import *
+# Run as a script from this directory, or imported as part of the package
+if __package__:
+    from .fsm_test_helpers import *
+    from .i2c_engine import *
+    from .vcd_helpers import *
+else:
+    from fsm_test_helpers import *
+    from i2c_engine import *
+    from vcd_helpers import *
 
 ##########################################################################
 ##########################################################################
 
-def Shift(sig, direction, d=0):
-    if direction == "right":
-        return Cat(sig[1:], d)
-    elif direction == "left":
-        return Cat(d, sig[:-1])
-
-def Rotate(sig, direction):
-    if direction == "right":
-        return Shift(sig, "right", sig[0])
-    elif direction == "left":
-        return Shift(sig, "left", sig[-1])
-
 def waggle(dut, sig, check):
     yield from check(dut)
     for i in range(0, 10):
@@ -52,44 +55,7 @@ def I2CPads(Module):
 ##########################################################################
 ##########################################################################
 
-class I2CStartCondition(Module):
-    """
-    A start condition is SDA going low and then SCL going low.
-    """
-    def __init__(self):
-        self.scl = Signal(reset=1)      # Clock signal
-        self.sda = Signal(reset=1)      # Data signal
-        self.detected = Signal(reset=0) # Detected start condition
-        self.submodules.fsm = fsm = FSM("PRE")
-
-        # Starting from SCL and SDA high. 
-        fsm.act("PRE",   # 00
-            If((self.scl == 1) & (self.sda == 1), NextState("SDA")),
-        )
-
-        # SCL is high and SDA is high, wait for SDA to go low
-        fsm.act("SDA",   # 01
-            If(self.sda == 0, NextState("SCL")),
-            # Take preference when both change at the same time.
-            If(self.scl != 1, NextState("PRE")), 
-        )
-
-        # SDA is low, wait for SCL to go low
-        fsm.act("SCL",   # 10
-            If(self.scl == 0, NextState("DET")),
-            # Take preference when both change at the same time.
-            If(self.sda != 0, NextState("PRE")),
-        )
-
-        # We have a start condition!
-        fsm.act("DET",     # 11
-            self.detected.eq(1),
-            NextState("PRE"),
-        )
-
-# ------------------------------------------------------------------------
-
-def TestI2CStartCondition():
+def TestI2CStartCondition(vcd=None, artifacts="build"):
     dut = I2CStartCondition()
     state_string(dut.fsm)
 
@@ -147,479 +113,290 @@ def TestI2CStartCondition():
         yield
         assert (yield dut.fsm.next_state) == 0
 
-    run_simulation(dut, test(dut), vcd_name="TestI2CStartCondition.vcd")
+    fragment = dut.get_fragment()
+    if artifacts is not None:
+        convert_cached(dut, fragment, ["scl", "sda", "detected"],
+                       I2CStartCondition, artifacts)
+    dump = simulate(dut, [test(dut)], "TestI2CStartCondition", vcd, fragment)
+    if dump:
+        dump.write()
 
 ##########################################################################
+##### Testing helpers
 ##########################################################################
 
-class I2CStopCondition(Module):
-    """
-    Stop conditions are defined by a 0->1 (low to high) transition on SDA after
-    a 0->1 transition on SCL, with SCL remaining high.
-    """
-    def __init__(self):
-        self.scl = Signal(reset=1)      # Clock signal
-        self.sda = Signal(reset=1)      # Data signal
-        self.detected = Signal(reset=0) # Detected stop condition
-
-        self.submodules.fsm = fsm = FSM("PRE")
-
-        # Starting from SCL and SDA low. 
-        fsm.act("PRE",   # 00
-            If((self.scl == 0) & (self.sda == 0), NextState("SCL")),
-        )
-
-        # SCL is low and SDA is low, wait for SCL to go high
-        fsm.act("SCL",   # 01
-            If(self.scl == 1, NextState("SDA")),
-            # Take preference when both change at the same time.
-            If(self.sda != 0, NextState("PRE")),
-        )
-
-        # SCL is high and SDA is low, wait for SDA to go high
-        fsm.act("SDA",   # 10
-            If(self.sda == 1, NextState("DET")),
-            # Take preference when both change at the same time.
-            If(self.scl != 1, NextState("PRE")),
-        )
-
-        # We have a stop condition!
-        fsm.act("DET",     # 11
-            self.detected.eq(1),
-            NextState("PRE"),
-        )
-
-
-class I2CAcker(Module):
-    """Module which handles the ACK in I2C (with clock stretching).
-
-    Setting ack.eq(1) will cause module to drive SDA low for one cycle.
-    Setting hold.eq(1) will cause module to drive SCL low until it is released.
-    """
+# Sample codes of the compiled waveforms, next to the values themselves
+DONT_CARE = -1
+HOLD = -2  # "-", resolved to the sample before once the line is expanded
 
-    def __init__(self):
-        # Clock signal
-        self.scl_oe = scl_oe = Signal(reset=0)
-        self.scl_r = scl_r = Signal(reset=1)
-        self.scl_w = scl_w = Signal(reset=0)
-
-        # Data signal
-        self.sda_oe = sda_oe = Signal(reset=0)
-        self.sda_r = sda_r = Signal(reset=1)
-        self.sda_w = sda_w = Signal(reset=0)
-
-        self.run = run = Signal(reset=0)
-        self.ack = ack = Signal(reset=0)
-        self.hold = hold = Signal(reset=0)
-        self.finished = finished = Signal(reset=0)
-
-        self.submodules.fsm = fsm = FSM("INIT")
-        fsm.act("INIT",
-            If((run == 1),
-                NextState("WAITING_START"),
-            ),
-        )
-
-        fsm.act("WAITING_START",
-            If(scl_r == 0,
-                NextValue(sda_oe, ack),
-                NextValue(sda_w, 0),
-                NextValue(scl_oe, hold),
-                NextValue(scl_w,  0),
-                NextState("STRETCHING"),
-            ),
-        )
-
-        fsm.act("STRETCHING",
-            If(hold == 0,
-                NextValue(scl_oe, 0),
-                NextState("WAITING_SCL_HIGH"),
-            ),
-        )
-
-        fsm.act("WAITING_SCL_HIGH",
-            If(scl_r == 1,
-                NextState("WAITING_SCL_LOW"),
-            ),
-        )
-
-        fsm.act("WAITING_SCL_LOW",
-            If(scl_r == 0,
-                NextValue(sda_oe, 0),
-                NextState("DONE"),
-            ),
-        )
-
-        fsm.act("DONE",
-            finished.eq(1),
-        )
-
-        # If we stop running, force everything back to IDLE
-        for state in fsm.actions.keys():
-            fsm.act(state, If(run == 0, NextState("INIT")))
+_SAMPLE_CODES = {"_": 0, "▁": 0, "/": 0, "▔": 1, "\\": 1, "-": HOLD,
+                 "X": DONT_CARE}
 
-##########################################################################
-##########################################################################
-
-class I2CDataShifter(Module):
-    """Module which handles the shifting of 8 bits of data."""
-
-    DATA_SIZE = 8
-
-    def __init__(self):
-        self.scl = scl = Signal(reset=1) # Clock signal
-        self.sda_r = sda_r = Signal(reset=1) # Data signal
-        self.sda_w = sda_w = Signal(reset=0) # Data signal
-
-        # Signals to the outside world
-        self.din = din = Signal(self.DATA_SIZE)
-        self.dout = dout = Signal(self.DATA_SIZE, reset=0xA6)
-        self.run = run = Signal(reset=0)
-        self.finished = finished = Signal(reset=0)
-
-        self._bit_index = bit_index = Signal(min=0, max=self.DATA_SIZE)
-        self.submodules.fsm = fsm = FSM("INIT")
-        fsm.act("INIT",
-            If((run == 1) & (scl == 0),
-                NextValue(bit_index, 0),
-                NextState("SHIFT_OUT"),
-            ),
-        )
-
-        # Data changes while SCL is low
-        fsm.act("SHIFT_OUT",
-            NextValue(sda_w, dout[0]),
-            NextValue(dout, Shift(dout, "left")),
-            NextState("SHIFTED_OUT"),
-        )
-
-        fsm.act("SHIFTED_OUT",
-            If(scl == 1,
-                NextState("SHIFT_IN"),
-            ),
-        )
-
-        # Data should be stable while SCL is high
-        fsm.act("SHIFT_IN",
-            NextValue(din, Shift(din, "left", sda_r)),
-            NextState("SHIFTED_IN"),
-        )
-
-        fsm.act("SHIFTED_IN",
-            If(scl == 0,
-                If(bit_index < self.DATA_SIZE-1,
-                    NextValue(bit_index, bit_index+1),
-                    NextState("SHIFT_OUT"),
-                ).Else(
-                    NextState("DONE"),
-                ),
-            ),
-        )
-
-        fsm.act("DONE",
-            finished.eq(1),
-        )
-
-        # If we stop running, force everything back to IDLE
-        for state in fsm.actions.keys():
-            fsm.act(state, If(run == 0, NextState("INIT")))
-
-##########################################################################
-##########################################################################
 
-class I2CStateMachine(Module):
-    def __init__(self):
-        self.start_detected = start_detected = Signal(reset=0)
-        self.stop_detected = stop_detected = Signal(reset=0)
-
-        self.data_run = data_run = Signal(reset=0)
-        self.data_next = data_next = Signal(reset=0)
-        self.data_finished = data_finished = Signal(reset=0)
-
-        self.ack_run = ack_run = Signal(reset=0)
-        self.ack_finished = ack_finished = Signal(reset=0)
-
-        self.addr_ready = addr_ready = Signal(reset=0)
-        self.data_ready = data_ready = Signal(reset=0)
-        self.idle = idle = Signal(reset=0)
-        self.error = error = Signal(reset=0)
-
-        self.submodules.fsm = fsm = FSM("IDLE")
-
-        # Reading addr byte
-        fsm.act("ADDR",
-            data_run.eq(1),
-            If(data_finished == 1,
-                NextState("ADDR_ACK"),
-            ),
-        )
-
-        # Ack the addr byte
-        fsm.act("ADDR_ACK",
-            ack_run.eq(1),
-            addr_ready.eq(1),
-            If(ack_finished == 1,
-                NextState("DATA"),
-            )
-        )
-
-        # Reading the data bytes
-        fsm.act("DATA",
-            data_run.eq(1),
-            If(data_finished == 1,
-                NextState("DATA_ACK"),
-            ),
-        )
-
-        # Ack the data byte
-        fsm.act("DATA_ACK",
-            ack_run.eq(1),
-            data_ready.eq(1),
-            If(ack_finished == 1,
-                NextState("WAITING"),
-            )
-        )
-
-        # If at any time we detect a stop or start condition, goto the error state
-        for state in fsm.actions.keys():
-            fsm.act(state, 
-                If((stop_detected == 1) | (stop_detected == 1),
-                    NextState("ERROR"),
-                ),
-            )
-
-        # Nothing happening
-        fsm.act("IDLE",
-            idle.eq(1),
-            If(start_detected == 1,
-                NextState("ADDR"),
-            ),
-        )
-
-        # Wait for either,
-        #  * Start of next data byte
-        #  * Start condition
-        #  * Stop condition
-        fsm.act("WAITING",
-            data_run.eq(1),
-            # Just another data byte
-            If(data_next,
-                NextState("DATA"),
-            ),
-            # Repeated start condition
-            If(start_detected,
-                NextState("ADDR"),
-            ),
-            # Stop detected
-            If(stop_detected,
-                NextState("IDLE"),
-            ),
-        )
-
-        fsm.act("ERROR",
-            error.eq(1),
-        )
+def _compile_seq(x, pos):
+    """Compile x from pos up to the end or a closing parenthesis.
 
-##########################################################################
-##########################################################################
+    Groups are "(...)*n", the samples of the group repeated n times, and
+    are only compiled once.
+    """
+    parts = []
+    literal = []
+    while pos < len(x) and x[pos] != ")":
+        c = x[pos]
+        if c == "(":
+            if literal:
+                parts.append(np.array(literal, dtype=np.int8))
+                literal = []
+            group, pos = _compile_seq(x, pos + 1)
+            assert x[pos:pos + 2] == ")*", "expected )*n at %i in %r" % (pos, x)
+            pos += 2
+            digits = pos
+            while pos < len(x) and x[pos].isdigit():
+                pos += 1
+            parts.append(np.tile(group, int(x[digits:pos])))
+            continue
+        literal.append(_SAMPLE_CODES[c] if c in _SAMPLE_CODES else int(c))
+        pos += 1
+    if literal:
+        parts.append(np.array(literal, dtype=np.int8))
+    if not parts:
+        return np.zeros(0, dtype=np.int8), pos
+    return np.concatenate(parts), pos
+
+
+def _resolve_holds(samples):
+    """Replace the holds by the last sample that is not one, those at the
+    start are left for the waveform played before."""
+    idx = np.where(samples != HOLD, np.arange(len(samples)), 0)
+    np.maximum.accumulate(idx, out=idx)
+    return samples[idx]
+
+
+def compile_line(x):
+    """Compile one waveform to an array with a sample per character.
+
+    "_▁/" are 0, "▔\\" are 1, digits their value, "X" DONT_CARE and "-"
+    the sample before. "(...)*n" repeats the samples in the parentheses
+    n times.
+    """
+    samples, pos = _compile_seq(x, 0)
+    assert pos == len(x), "unbalanced ) at %i in %r" % (pos, x)
+    return _resolve_holds(samples)
 
-class I2CEngine(Module):
-    def __init__(self):
-
-        self.dummy = Signal(reset=0)
-
-        # Clock signal
-        self.scl_r  = scl_r  = Signal(reset=1, name="scl_r")
-        self.scl_w  = scl_w  = Signal(reset=0, name="scl_w")
-        self.scl_oe = scl_oe = Signal(reset=0, name="scl_oe")
-
-        # Data signal
-        self.sda_r  = sda_r  = Signal(reset=1, name="sda_r")
-        self.sda_w  = sda_w  = Signal(reset=0, name="sda_w")
-        self.sda_oe = sda_oe = Signal(reset=0, name="sda_oe")
-
-        self.submodules.start = start = I2CStartCondition()
-        self.comb += [start.scl.eq(scl_r), start.sda.eq(sda_r)]
-
-        self.submodules.stop = stop = I2CStopCondition()
-        self.comb += [stop.scl.eq(scl_r), stop.sda.eq(sda_r)]
-
-        self.submodules.data = data = I2CDataShifter()
-        self.comb += [
-            data.scl.eq(scl_r),
-            data.sda_r.eq(sda_r),
-            # data.sda_w
-        ]
-
-        self.submodules.ack = ack = I2CAcker()
-        self.comb += [
-            ack.scl_r.eq(scl_r),
-            # ack.scl_w
-            # ack.scl_oe
-            ack.sda_r.eq(sda_r),
-            # ack.sda_w
-            # ack.sda_oe
-        ]
-
-        self.submodules.state = state = I2CStateMachine()
-        self.comb += [
-            state.start_detected.eq(start.detected),
-            state.stop_detected.eq(stop.detected),
-
-            state.data_next.eq(data.run & (data._bit_index == 1)),
-            state.data_finished.eq(data.finished),
-            state.ack_finished.eq(ack.finished),
-
-            data.run.eq(state.data_run),
-            ack.run.eq(state.ack_run),
-        ]
-
-        self.address = address = Signal(7, reset=0x50)
-        self.direction = direction = Signal(reset=0)
-
-        self.comb += [
-            scl_w.eq(ack.scl_w),
-            scl_oe.eq(ack.scl_oe),
-            sda_w.eq(data.sda_w | ack.sda_w),
-            sda_oe.eq(ack.sda_oe | self.direction),
-        ]
-
-        self.sync += [
-            If(state.addr_ready & (self.data.din[1:] == self.address),
-                ack.ack.eq(1),
-                ack.hold.eq(0),
-                direction.eq(self.data.din[0]),
-            ),
-            If(state.idle,
-                ack.ack.eq(0),
-                ack.hold.eq(0),
-            ),
-        ]
 
+class Waveforms(dict):
+    """Compiled waveforms of a block, by signal name, all of the same
+    length. a + b plays b after a, a * n plays a n times.
+    """
+    @property
+    def length(self):
+        return len(next(iter(self.values())))
 
-##########################################################################
-##### Testing helpers
-##########################################################################
+    def __add__(self, other):
+        assert set(self) == set(other)
+        return Waveforms((name, _resolve_holds(np.concatenate([self[name], other[name]])))
+                         for name in self)
 
-def parse_line(x):
-    l = None
-    bits = []
-    for i in x:
-        if False:
-            pass
-        elif i in ("_", "▁", "/"):
-            i = 0
-        elif i in ("▔", "\\"):
-            i = 1
-        elif i in ("-",):
-            i = l
-        elif i in ("X",):
-            i = None
-        else:
-            i = int(i)
-        bits.append(i)
-        l = i
-    assert bits[0] is not None
-    return bits
+    def __mul__(self, n):
+        return Waveforms((name, _resolve_holds(np.tile(a, n)))
+                         for name, a in self.items())
 
 
-def parse_block(b):
+def compile_block(b):
     lines = [x.strip().split() for x in b.splitlines() if not x.startswith('#') and len(x) > 0]
 
-    real = {}
+    real = Waveforms()
     for name, signal in lines:
-        real[name] = parse_line(signal)
-  
+        real[name] = compile_line(signal)
+
     # Check all the signals are the same length
-    first_key = list(real.keys())[0]
-    slen = len(real[first_key])
-    for name in real:
-        assert slen == len(real[name])
+    lengths = set(len(a) for a in real.values())
+    assert len(lengths) == 1, lengths
+
+    return real
+
 
-    return slen, real
+def _to_list(samples):
+    return [None if i == DONT_CARE else int(i) for i in samples]
 
 
-def TestHelper(in_signals, expected_signals, cut):
-    in_slen, in_signals = parse_block(in_signals)
-    ex_slen, ex_signals = parse_block(expected_signals)
+def parse_line(x):
+    """compile_line() as a list, with None for X."""
+    samples = compile_line(x)
+    assert samples[0] not in (HOLD, DONT_CARE)
+    return _to_list(samples)
+
+
+def parse_block(b):
+    """compile_block() as (length, {name: list})."""
+    real = compile_block(b)
+    return real.length, {name: _to_list(a) for name, a in real.items()}
+
+
+def _changes(samples):
+    """Indexes where samples differ from the one before, 0 included."""
+    return np.flatnonzero(np.diff(samples, prepend=samples[0] - 1))
+
+
+def _verilog_key(cut, io_names):
+    """Identifies the Verilog of cut(), from its class, the parameters
+    cut binds and the source of the module defining it."""
+    func = getattr(cut, "func", cut)  # functools.partial
+    h = hashlib.sha256()
+    h.update(func.__qualname__.encode())
+    h.update(repr((getattr(cut, "args", ()),
+                   sorted(getattr(cut, "keywords", {}).items()))).encode())
+    h.update(repr(sorted(io_names)).encode())
+    with open(inspect.getsourcefile(func), "rb") as f:
+        h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def convert_cached(dut, fragment, io_names, cut, artifacts):
+    """Write the Verilog of the fragment of dut, built by cut, with the
+    io_names attributes as ports to the artifacts directory, unless a
+    file for the same key is there already. Returns the file name."""
+    name = getattr(cut, "func", cut).__name__
+    filename = os.path.join(artifacts, "%s-%s.v" % (name, _verilog_key(cut, io_names)))
+    if os.path.exists(filename):
+        return filename
+    from migen.fhdl import verilog
+    ios = set(getattr(dut, i) for i in io_names)
+    os.makedirs(artifacts, exist_ok=True)
+    # several runs can convert the same module at once
+    tmp = "%s.%d" % (filename, os.getpid())
+    verilog.convert(fragment, ios=ios, name=name).write(tmp)
+    os.replace(tmp, filename)
+    return filename
+
+
+def TestHelper(in_signals, expected_signals, cut, vcd=None,
+               artifacts="build"):
+    """Play in_signals into a cut() and check its outputs against
+    expected_signals, both blocks as strings or Waveforms.
+
+    Every sample lasts six clock cycles, the outputs are read on the
+    second one. Only the inputs that change are written, the outputs are
+    recorded in arrays and compared once the simulation is over. With
+    vcd settings, the run is dumped around the first mismatch.
+
+    The Verilog of the cut, with the signals of the blocks as ports, goes
+    to the artifacts directory (None to skip it), and is only converted
+    again once the source of the cut changes.
+    """
+    if isinstance(in_signals, str):
+        in_signals = compile_block(in_signals)
+    if isinstance(expected_signals, str):
+        expected_signals = compile_block(expected_signals)
+    in_slen = in_signals.length
+    ex_slen = expected_signals.length
 
     assert in_slen == ex_slen
 
     dut = cut()
-    ios = set()
-    for i in in_signals:
-        ios.add(getattr(dut, i))
-    for i in ex_signals:
-        ios.add(getattr(dut, i))
-    from migen.fhdl import verilog
-    print("="*75)
-    print(cut.__name__)
-    print("-"*75)
-    print(verilog.convert(dut, ios=ios))
-    print("="*75)
+    io_names = set(in_signals) | set(expected_signals)
+    for sig, samples in expected_signals.items():
+        assert samples[0] >= 0, "%s must start with a value" % sig
+        setattr(dut, "%s_expected" % sig,
+                Signal(name="%s_expected" % sig, reset=int(samples[0])))
+
+    # (signal, value) to write before each sample
+    writes = [[] for i in range(in_slen)]
+    for sig, samples in in_signals.items():
+        assert samples.min() >= 0, "input %s can't be X" % sig
+        for i in _changes(samples):
+            writes[i].append((getattr(dut, sig), int(samples[i])))
+    for sig, samples in expected_signals.items():
+        for i in _changes(samples):
+            if samples[i] != DONT_CARE:
+                writes[i].append((getattr(dut, "%s_expected" % sig),
+                                  int(samples[i])))
+
+    outputs = [(getattr(dut, sig), np.zeros(ex_slen, dtype=np.int64))
+               for sig in expected_signals]
 
-    errors = []
     def test(d):
         for i in range(0, in_slen):
-            for sig in in_signals:
-                yield getattr(d, sig).eq(in_signals[sig][i])
-            for sig in ex_signals:
-                expected = ex_signals[sig][i]
-                if expected is not None:
-                    yield getattr(d, "%s_expected" % sig).eq(expected)
+            for sig, value in writes[i]:
+                yield sig.eq(value)
             # Commit the input signals
             yield
             # Wait one cycle
             yield
             # Read the results
-            for sig in ex_signals:
-                expected = ex_signals[sig][i]
-                value = yield getattr(d, sig)
-                if expected is not None and expected != value:
-                    errors.append("%20s@%04i - %r != %r" % (sig, i, expected, value))
+            for sig, values in outputs:
+                values[i] = yield sig
             # Pump the clock a couple of times
             yield
             yield
             yield
             yield
 
-    dut = cut()
-    for sig in ex_signals:
-        exec("""
-dut.{0}_expected = Signal(name="{0}_expected", reset={1})
-""".format(sig, ex_signals[sig][0]))
-
-    run_simulation(dut, test(dut), vcd_name="%s.vcd" % (cut.__name__))
-    for e in errors:
-        print(e)
-    assert not errors, "Test on %s failed with %s errors" % (cut.__name__, len(errors))
+    # The simulator and the conversion share the one fragment of dut,
+    # the conversion leaves it as it is so it goes first.
+    name = getattr(cut, "func", cut).__name__
+    fragment = dut.get_fragment()
+    if artifacts is not None:
+        print("%s: %s" % (name, convert_cached(dut, fragment, io_names, cut,
+                                               artifacts)))
+    dump = simulate(dut, [test(dut)], name, vcd, fragment)
+
+    errors = 0
+    first = None
+    for (sig, expected), (_, values) in zip(expected_signals.items(), outputs):
+        bad = np.flatnonzero((expected != DONT_CARE) & (expected != values))
+        errors += len(bad)
+        if len(bad) and (first is None or bad[0] < first):
+            first = bad[0]
+        for i in bad:
+            print("%20s@%04i - %r != %r" % (sig, i, int(expected[i]), int(values[i])))
+    if dump:
+        dump.write(failure=None if first is None else int(first)*6 + 2)
+    assert not errors, "Test on %s failed with %s errors" % (cut.__name__, errors)
 
 
+##########################################################################
+##########################################################################
 
-if __name__ == "__main__":
-    TestI2CStartCondition()
+# Every test takes the VCD settings and where the Verilog of the parts
+# goes, run_tests.py finds them in TESTS.
 
-    i2c_frame = r"""
+I2C_FRAME = r"""
 #            S   0       1       2       3       4       5       6       7       A
 #   sda  XXXXXXXX----XXXX----XXXX----XXXX----XXXX----XXXX----XXXX----XXXX----XX_______XXXXXXXX
     scl  ▔▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔▔
     sda  ▔▔\_____1-------0-------1-------0-------0-------0-------0-------0------------____/▔▔▔
 """
 
+
+def TestI2CStartConditionFrame(vcd=None, artifacts="build"):
     TestHelper(
-        i2c_frame,
+        I2C_FRAME,
         r"""
 detected _____▔_______________________________________________________________________________
 """,
-        I2CStartCondition)
+        I2CStartCondition, vcd, artifacts)
 
+
+def TestI2CStopConditionFrame(vcd=None, artifacts="build"):
     TestHelper(
-        i2c_frame,
+        I2C_FRAME,
         r"""
 detected __________________________________________________________________________________▔__
 """,
-        I2CStopCondition)
+        I2CStopCondition, vcd, artifacts)
+
+
+def TestI2CStartConditionBackToBack(vcd=None, artifacts="build"):
+    TestHelper(
+        compile_block(I2C_FRAME) * 16,
+        compile_block(r"""
+detected _____▔_______________________________________________________________________________
+""") * 16,
+        I2CStartCondition, vcd, artifacts)
 
+
+def TestI2CAcker(vcd=None, artifacts="build"):
     i2c_acking = r"""
    sda_r _---------------------------------_________--______________---
    scl_r ▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\___/▔▔▔\__-------__/▔▔▔\___
@@ -636,8 +413,10 @@ finished ___________________________▔_______________▔_______________▔__
   sda_oe __________________________________/▔▔▔▔▔▔▔\__/▔▔▔▔▔▔▔▔▔▔▔▔\___
   sda_w  _XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX_________XX______________XXX
 """,
-        I2CAcker)
+        I2CAcker, vcd, artifacts)
+
 
+def TestI2CDataShifter(vcd=None, artifacts="build"):
     i2c_frame = r"""
 #            S   0       1       2       3       4       5       6       7       A
 #   sda  XXXXXXXX----XXXX----XXXX----XXXX----XXXX----XXXX----XXXX----XXXX----XX_______XXXXXXXX
@@ -650,8 +429,10 @@ finished ___________________________▔_______________▔_______________▔__
         r"""
 finished _____________________________________________________________________▔▔______________
 """,
-        I2CDataShifter)
+        I2CDataShifter, vcd, artifacts)
 
+
+def TestI2CStateMachine(vcd=None, artifacts="build"):
     i2c_state = r"""
 start_detected _▔______________▔______________
  stop_detected _____________________________▔_
@@ -670,8 +451,10 @@ start_detected _▔______________▔______________
     addr_ready ____▔▔▔____________▔▔▔_________
     data_ready __________▔▔▔____________▔▔▔___
 """,
-        I2CStateMachine)
+        I2CStateMachine, vcd, artifacts)
+
 
+def TestI2CEngine(vcd=None, artifacts="build"):
     i2c_frame = r"""
 #            S   A6      A5      A4      A3      A2      A1      A0      R/W     AA          D7      D6      D5      D4      D3      D2      D1      D0      AD        D7      D6      D5      D4      D3      D2      D1      D0      AD        P
   sda_r  ▔▔\_____1-------0-------1-------0-------0-------0-------0-------0----________/▔\___0-------1-------0-------1-------0-------1-------0-------1----________/▔\___1-------0-------1-------0-------1-------0-------1-------0----________/▔\__/▔▔▔
@@ -685,4 +468,29 @@ start_detected _▔______________▔______________
  scl_oe  ____________________________________________________________________________________________________________________________________________________________________________________________________________________________________________
   scl_w  ____________________________________________________________________________________________________________________________________________________________________________________________________________________________________________
 """,
-        I2CEngine)
+        I2CEngine, vcd, artifacts)
+
+
+TESTS = [
+    TestI2CStartCondition,
+    TestI2CStartConditionFrame,
+    TestI2CStopConditionFrame,
+    TestI2CStartConditionBackToBack,
+    TestI2CAcker,
+    TestI2CDataShifter,
+    TestI2CStateMachine,
+    TestI2CEngine,
+]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Test the I2C parts")
+    add_vcd_args(parser)
+    parser.add_argument("--artifacts", default="build",
+                        help="directory of the Verilog of the parts."
+                             " Default: build")
+    args = parser.parse_args()
+    vcd = vcd_settings(args)
+
+    for test in TESTS:
+        test(vcd, args.artifacts)
@@ -0,0 +1,1034 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""Simulation models for benchmarking I2CShiftReg.
+
+I2CMaster drives the bus from a generator, the firmware models mirror the
+servicing code in software/ with a cost in sys clock cycles for every CSR
+access, so the polling loop, the interrupt handler, DMA and the interrupt
+handler taking whole transactions from their descriptors can be compared
+on throughput, stretch time, transaction latency and CPU time per byte.
+
+    $ python -m i2cslave.targets.i2c_sim
+    $ python -m i2cslave.targets.i2c_sim --bus-khz 100,400,1000 \
+        --latency 0,200,1000 --json > bench.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+from functools import partial
+
+from migen import *
+
+from misoc.interconnect.csr import CSRStorage
+from misoc.interconnect import wishbone
+
+from .pipistrello_i2c import I2CShiftReg
+from .vcd_helpers import simulate
+from ..tools import trace2vcd
+
+# Bits of the I2CShiftReg event manager, see software/i2c.h
+EV_RX = 0x01
+EV_TX = 0x02
+# The models use either the transaction queue or DMA, the first of the
+# two the core has takes the next bit
+EV_TXN = 0x20
+EV_DMA = 0x20
+
+
+class I2CBus(Module):
+    """I2CShiftReg, or another core with its interface, on an open-drain
+    bus shared with a master model.
+
+    With image set, the core gets DMA and the image is put in a memory on
+    its Wishbone bus at address 0. scl_spike and sda_spike pull the lines
+    low on top of the master and the core, for glitches.
+    """
+    def __init__(self, image=None, core=I2CShiftReg, **kwargs):
+        if image is not None:
+            kwargs["dma"] = True
+        self.submodules.dut = dut = core(None, **kwargs)
+        if image is not None:
+            words = [int.from_bytes(bytes(image[i:i + 4]), "big")
+                     for i in range(0, len(image), 4)]
+            mem = Memory(32, len(words), init=words)
+            self.submodules.ram = wishbone.SRAM(mem, bus=dut.dma_bus)
+
+        self.master_scl = Signal(reset=1)
+        self.master_sda = Signal(reset=1)
+        self.scl_spike = Signal()
+        self.sda_spike = Signal()
+        self.scl = Signal()
+        self.sda = Signal()
+        self.comb += [
+            self.scl.eq(self.master_scl & ~dut.scl_oe & ~self.scl_spike),
+            self.sda.eq(self.master_sda & ~dut.sda_oe & ~self.sda_spike),
+            dut._scl_i_async.eq(self.scl),
+            dut._sda_i_async.eq(self.sda),
+        ]
+
+
+class I2CMaster:
+    """Bit-level I2C master, half_period is in sys clock cycles.
+
+    The master waits for SCL to actually go high, so the slave can stretch
+    it. cycles counts the clock cycles it has been running, byte_stretch
+    gets the stretch of every byte, including its ACK bit, and
+    transaction_cycles the duration of every eeprom_read().
+    """
+    def __init__(self, bus, half_period):
+        self.bus = bus
+        self.half_period = half_period
+        self.stretch_cycles = 0
+        self.max_stretch = 0
+        self.bytes = 0
+        self.cycles = 0
+        self.byte_stretch = []
+        self.transaction_cycles = []
+        self._stretch = 0
+
+    def _wait(self, n):
+        for i in range(n):
+            yield
+        self.cycles += n
+
+    def _scl_high(self):
+        yield self.bus.master_scl.eq(1)
+        yield
+        self.cycles += 1
+        stretch = 0
+        while not (yield self.bus.scl):
+            stretch += 1
+            yield
+        self.cycles += stretch
+        self.stretch_cycles += stretch
+        self.max_stretch = max(self.max_stretch, stretch)
+        self._stretch += stretch
+
+    def _end_byte(self):
+        self.bytes += 1
+        self.byte_stretch.append(self._stretch)
+        self._stretch = 0
+
+    def _scl_low(self):
+        yield self.bus.master_scl.eq(0)
+        yield from self._wait(self.half_period//2)
+
+    def _bit(self, b):
+        yield self.bus.master_sda.eq(b)
+        yield from self._wait(self.half_period//2)
+        yield from self._scl_high()
+        yield from self._wait(self.half_period//2)
+        r = yield self.bus.sda
+        yield from self._wait(self.half_period//2)
+        yield from self._scl_low()
+        return r
+
+    def start(self):
+        yield self.bus.master_sda.eq(1)
+        yield from self._wait(self.half_period//2)
+        yield from self._scl_high()
+        yield from self._wait(self.half_period//2)
+        yield self.bus.master_sda.eq(0)
+        yield from self._wait(self.half_period//2)
+        yield from self._scl_low()
+
+    def stop(self):
+        yield self.bus.master_sda.eq(0)
+        yield from self._wait(self.half_period//2)
+        yield from self._scl_high()
+        yield from self._wait(self.half_period//2)
+        yield self.bus.master_sda.eq(1)
+        yield from self._wait(self.half_period)
+
+    def write(self, value):
+        """Write a byte, returns True if the slave ACKed it."""
+        self._stretch = 0
+        for i in reversed(range(8)):
+            yield from self._bit((value >> i) & 1)
+        ack = (yield from self._bit(1)) == 0
+        self._end_byte()
+        return ack
+
+    def read(self, ack):
+        self._stretch = 0
+        value = 0
+        for i in range(8):
+            value = (value << 1) | (yield from self._bit(1))
+        yield from self._bit(0 if ack else 1)
+        self._end_byte()
+        return value
+
+    def eeprom_read(self, slave_addr, word_addr, n):
+        """Random read of n bytes from a 2-byte addressed EEPROM."""
+        begin = self.cycles
+        yield from self.start()
+        assert (yield from self.write(slave_addr << 1))
+        yield from self.write(word_addr >> 8)
+        yield from self.write(word_addr & 0xff)
+        yield from self.start()
+        assert (yield from self.write((slave_addr << 1) | 1))
+        data = []
+        for i in range(n):
+            data.append((yield from self.read(i != n - 1)))
+        yield from self.stop()
+        self.transaction_cycles.append(self.cycles - begin)
+        return data
+
+
+class FirmwareModel:
+    """EEPROM emulation as done by software/i2c.c.
+
+    Every CSR access costs csr_cycles per 8-bit word, busy counts the
+    cycles spent servicing the core. With txn set, writes are taken from
+    the transaction descriptors of the core.
+    """
+    def __init__(self, dut, image, fifo_depth, csr_cycles=8, dma=False,
+                 txn=False):
+        self.dut = dut
+        self.dma = dma
+        self.txn = txn
+        self.image = image
+        self.fifo_depth = fifo_depth
+        self.csr_cycles = csr_cycles
+        self.busy = 0
+        self.addr = 0
+        self.addr_high = 0
+        self.loading_low = False
+        self.rx_pos = 0
+        self.rx_start = 0
+
+    def wait(self, n):
+        for i in range(n):
+            yield
+        self.busy += n
+
+    def read_csr(self, sig):
+        value = yield sig
+        yield from self.wait(self.csr_cycles*((len(sig) + 7)//8))
+        return value
+
+    def write_csr(self, csr, value=0, words=None):
+        """Writes csr, or only its last words 8-bit words, which is
+        enough for the strobe."""
+        if words is None:
+            words = (csr.size + 7)//8
+        if isinstance(csr, CSRStorage):
+            yield csr.storage.eq(value)
+            yield
+        else:
+            yield csr.r.eq(value)
+            yield csr.re.eq(1)
+            yield
+            yield csr.re.eq(0)
+        yield from self.wait(self.csr_cycles*words - 1)
+
+    def tx_start(self):
+        """Only used with DMA, the image is at address 0 of its bus."""
+        self.addr %= len(self.image)
+        yield from self.write_csr(self.dut.dma_base, self.addr)
+        yield from self.write_csr(self.dut.dma_length, len(self.image) - self.addr)
+        yield from self.write_csr(self.dut.dma_start)
+        self.addr = 0
+
+    def tx_refill(self):
+        n = self.dut.tx_depth - (yield from self.read_csr(self.dut.tx_level.status))
+        for i in range(n):
+            yield from self.write_csr(self.dut.tx_data,
+                                      self.image[self.addr % len(self.image)])
+            self.addr += 1
+
+    def tx_switch(self, addr):
+        self.addr = addr
+        yield from self.write_csr(self.dut.tx_flush)
+        if self.dma:
+            yield from self.tx_start()
+        else:
+            yield from self.tx_refill()
+
+    def rx_drain(self):
+        if self.txn:
+            yield from self.txn_drain()
+            return
+        for i in range((yield from self.read_csr(self.dut.rx_level.status))):
+            b = yield from self.read_csr(self.dut.rx_data.w)
+            if self.loading_low:
+                yield from self.tx_switch((self.addr_high << 8) | b)
+            else:
+                self.addr_high = b
+            self.loading_low = not self.loading_low
+            yield from self.write_csr(self.dut.rx_data)
+
+    def rx_take(self, n):
+        for i in range(n):
+            b = yield from self.read_csr(self.dut.rx_data.w)
+            if self.rx_pos - self.rx_start == 0:
+                self.addr_high = b
+            elif self.rx_pos - self.rx_start == 1:
+                yield from self.tx_switch((self.addr_high << 8) | b)
+            self.rx_pos += 1
+            yield from self.write_csr(self.dut.rx_data)
+
+    def rx_resync(self, lost):
+        """Skips the bytes of the writes whose descriptors were dropped,
+        returns how many."""
+        if lost <= self.rx_start:
+            return 0
+        n = max(lost - self.rx_pos, 0)
+        for i in range(n):
+            yield from self.write_csr(self.dut.rx_data)
+        self.rx_pos += n
+        self.rx_start = lost
+        return n
+
+    def txn_drain(self):
+        while True:
+            lost = yield from self.read_csr(self.dut.txn.lost.status)
+            level = yield from self.read_csr(self.dut.rx_level.status)
+            n = yield from self.read_csr(self.dut.txn.level.status)
+            if not n:
+                break
+            for i in range(n):
+                txn = yield from self.read_csr(self.dut.txn.data.w)
+                if txn & 0x400:
+                    yield from self.rx_resync(
+                        (yield from self.read_csr(self.dut.txn.lost.status)))
+                taken = self.rx_pos - self.rx_start
+                if not txn & 0x80 and txn >> 16 > taken:
+                    yield from self.rx_take((txn >> 16) - taken)
+                self.rx_pos = self.rx_start = 0
+                yield from self.write_csr(self.dut.txn.data, words=1)
+        level -= yield from self.rx_resync(lost)
+        yield from self.rx_take(level)
+
+    def polling(self, loop_cycles=0):
+        """The main() loop before interrupts, busy the whole time.
+
+        loop_cycles stands for other work done in every iteration.
+        """
+        while True:
+            yield from self.rx_drain()
+            yield from self.tx_refill()
+            yield from self.wait(loop_cycles)
+
+    def interrupt(self, entry_cycles=40):
+        """i2c_isr(), entered entry_cycles after the IRQ line rises.
+
+        With DMA the image wraps around by restarting the transfer from
+        the dma event, tx events are not used.
+        """
+        enable = EV_RX | (EV_DMA if self.dma else EV_TX)
+        if self.txn:
+            enable |= EV_TXN
+            yield from self.write_csr(self.dut.rx_threshold, 2)
+            yield from self.write_csr(self.dut.txn.threshold,
+                                      self.dut.txn.fifo.depth//2)
+        yield self.dut.ev.enable.storage.eq(enable)
+        while True:
+            if not (yield self.dut.ev.irq):
+                yield
+                continue
+            yield from self.wait(entry_cycles)
+            while True:
+                pending = yield from self.read_csr(self.dut.ev.pending.w)
+                pending &= enable
+                if not pending:
+                    break
+                yield from self.write_csr(self.dut.ev.pending, pending)
+                if pending & (EV_RX | (EV_TXN if self.txn else 0)):
+                    yield from self.rx_drain()
+                if pending & EV_TX:
+                    yield from self.tx_refill()
+                if self.dma and pending & EV_DMA:
+                    yield from self.tx_start()
+            yield from self.wait(entry_cycles)
+
+
+def percentile(values, p):
+    """Nearest-rank percentile, p in 0..100."""
+    values = sorted(values)
+    k = max(0, min(len(values) - 1, -(-len(values)*p//100) - 1))
+    return values[k]
+
+
+def _summary(values):
+    return {"p50": percentile(values, 50), "p90": percentile(values, 90),
+            "p99": percentile(values, 99), "max": max(values)}
+
+
+def run(mode, transactions, half_period, fifo_depth, csr_cycles, seed=0,
+        latency=40, clk_freq=83333333):
+    """Serve transactions, a list of (word_addr, n) random reads.
+
+    latency is the firmware service latency in cycles: the interrupt
+    entry and exit time, or the other work in every polling loop.
+    """
+    rng = random.Random(seed)
+    image = [rng.randrange(256) for i in range(256)]
+    dma = mode == "dma"
+    txn = mode == "txn"
+    bus = I2CBus(image if dma else None, fifo_depth=fifo_depth,
+                 txn_depth=16 if txn else 0)
+    master = I2CMaster(bus, half_period)
+    fw = FirmwareModel(bus.dut, image, fifo_depth, csr_cycles, dma, txn)
+
+    def bench():
+        yield bus.dut.match0.addr.storage.eq(0x40)
+        if dma:
+            yield from fw.tx_start()
+        else:
+            yield from fw.tx_refill()
+        fw.busy = 0
+        for word_addr, n in transactions:
+            data = yield from master.eeprom_read(0x40, word_addr, n)
+            expected = [image[(word_addr + i) % len(image)] for i in range(n)]
+            assert data == expected, (data, expected)
+
+    @passive
+    def firmware():
+        if mode == "polling":
+            yield from fw.polling(latency)
+        else:
+            yield from fw.interrupt(latency)
+
+    run_simulation(bus, [bench(), firmware()])
+
+    us = 1e6/clk_freq
+    return {
+        "mode": mode,
+        "bus_khz": round(clk_freq/(2*half_period)/1e3, 1),
+        "half_period": half_period,
+        "fifo_depth": fifo_depth,
+        "csr_cycles": csr_cycles,
+        "latency": latency,
+        "bytes": master.bytes,
+        "cycles": master.cycles,
+        "bytes_per_s": master.bytes*clk_freq/master.cycles,
+        "stretch_per_byte": master.stretch_cycles / master.bytes,
+        "max_stretch": master.max_stretch,
+        "stretch": _summary(master.byte_stretch),
+        "transaction_us": {k: v*us for k, v in
+                           _summary(master.transaction_cycles).items()},
+        "cpu_per_byte": fw.busy / master.bytes,
+    }
+
+
+def _eeprom_bus(image, **kwargs):
+    """A core serving image at 0x40 from its gateware EEPROM, from reset
+    on, without any firmware."""
+    return I2CBus(eeprom_size=len(image), eeprom_init=[image],
+                  reset_addrs=[0x40], **kwargs)
+
+
+def _scl_spikes(bus, width, delay):
+    """Pulls SCL low for width cycles, delay cycles into every high phase
+    of the master clock. Returns the list the spikes are counted in."""
+    count = []
+
+    @passive
+    def gen():
+        while True:
+            while not (yield bus.scl):
+                yield
+            for i in range(delay):
+                yield
+            yield bus.scl_spike.eq(1)
+            for i in range(width):
+                yield
+            yield bus.scl_spike.eq(0)
+            count.append(1)
+            while (yield bus.master_scl):
+                yield
+    return gen(), count
+
+
+def _edges(sig, count):
+    """Counts the falling edges of sig into count[0]."""
+    @passive
+    def gen():
+        last = 1
+        while True:
+            value = yield sig
+            if last and not value:
+                count[0] += 1
+            last = value
+            yield
+    return gen()
+
+
+def TestGlitchFilter(vcd=None, artifacts="build"):
+    """Spikes on SCL shorter than the filter leave reads intact, and the
+    filter lengths out of range work as the nearest one in range."""
+    rng = random.Random(2)
+    image = [rng.randrange(256) for i in range(256)]
+    # filter_len, filter_majority, spike width, all sampled every cycle
+    cases = [
+        (3, 0, 2),
+        (7, 1, 2),  # taken as filter_depth, 5: 3 of 5 samples
+        (0, 0, 0),  # taken as 1: the lines are only resampled
+    ]
+    for filter_len, majority, width in cases:
+        bus = _eeprom_bus(bytes(image))
+        dut = bus.dut
+        master = I2CMaster(bus, 40)
+        raw_falls = [0]
+        filtered_falls = [0]
+
+        def bench():
+            yield dut.sample_div.storage.eq(0)
+            yield dut.filter_len.storage.eq(filter_len)
+            yield dut.filter_majority.storage.eq(majority)
+            for i in range(8):
+                yield
+            data = yield from master.eeprom_read(0x40, 250, 4)
+            assert data == image[250:254], (filter_len, data, image[250:254])
+
+        generators = [bench(), _edges(dut.scl, raw_falls),
+                      _edges(dut.scl_filter.o, filtered_falls)]
+        spikes = []
+        if width:
+            spike_gen, spikes = _scl_spikes(bus, width, 10)
+            generators.append(spike_gen)
+        dump = simulate(bus, generators,
+                        "TestGlitchFilter_len{}".format(filter_len), vcd)
+        if dump:
+            dump.write()
+        # every spike reached the filter, none went through
+        assert raw_falls[0] == filtered_falls[0] + len(spikes), \
+            (raw_falls, filtered_falls, len(spikes))
+        assert not width or spikes
+
+
+def TestHsMode(vcd=None, artifacts="build"):
+    """An Hs-mode master code switches to the Hs sampling until the STOP,
+    and a read at Hs speed goes through."""
+    rng = random.Random(3)
+    image = [rng.randrange(256) for i in range(256)]
+    bus = _eeprom_bus(bytes(image))
+    dut = bus.dut
+    # 400 kHz, then 3.4 MHz at 83 MHz
+    master = I2CMaster(bus, 104)
+
+    def bench():
+        # hs_filter_len 0 is taken as 1
+        yield dut.hs_sample_div.storage.eq(0)
+        yield dut.hs_filter_len.storage.eq(0)
+        yield
+        yield from master.start()
+        # master code 00001xxx, not ACKed
+        assert not (yield from master.write(0x09))
+        assert (yield dut.hs_active.status)
+        master.half_period = 12
+        data = yield from master.eeprom_read(0x40, 17, 6)
+        assert data == image[17:23], (data, image[17:23])
+        assert not (yield dut.hs_active.status)
+        # the default sampling is back, too slow for Hs speed
+        master.half_period = 104
+        data = yield from master.eeprom_read(0x40, 3, 2)
+        assert data == image[3:5], (data, image[3:5])
+
+    dump = simulate(bus, [bench()], "TestHsMode", vcd)
+    if dump:
+        dump.write()
+
+
+def TestDMAAndCPUWrites(vcd=None, artifacts="build"):
+    """tx_data writes during a DMA transfer into the TX FIFO, some of them
+    in the cycle a byte comes from memory, all go in the FIFO."""
+    image = list(range(0x10, 0x1c))
+    cpu = list(range(0xa0, 0xa6))
+    bus = I2CBus(image, fifo_depth=16)
+    dut = bus.dut
+    master = I2CMaster(bus, 40)
+
+    def bench():
+        yield dut.match0.addr.storage.eq(0x40)
+        yield dut.dma_base.storage.eq(0)
+        yield dut.dma_length.storage.eq(len(image))
+        yield dut.dma_start.re.eq(1)
+        yield
+        yield dut.dma_start.re.eq(0)
+        while not (yield dut.dma_bus.ack):
+            yield
+        # one write every cycle, across the next memory reads
+        for value in cpu:
+            yield dut.tx_data.r.eq(value)
+            yield dut.tx_data.re.eq(1)
+            yield
+        yield dut.tx_data.re.eq(0)
+        for i in range(100):
+            yield
+        assert not (yield dut.dma_remaining.status)
+        level = yield dut.tx_level.status
+        assert level == len(image) + len(cpu), level
+
+        yield from master.start()
+        assert (yield from master.write((0x40 << 1) | 1))
+        data = []
+        for i in range(level):
+            data.append((yield from master.read(i != level - 1)))
+        yield from master.stop()
+        assert [b for b in data if b < 0xa0] == image, data
+        assert [b for b in data if b >= 0xa0] == cpu, data
+
+    dump = simulate(bus, [bench()], "TestDMAAndCPUWrites", vcd)
+    if dump:
+        dump.write()
+
+
+def _stretched_fills(bus, delays, values):
+    """Writes values to tx_data one by one, each delays[i] cycles into the
+    next stretch, as a slow CPU would."""
+    dut = bus.dut
+    # held on the CPU: in PAUSE for more than the one cycle it takes with
+    # data to send
+    pause = dut.fsm.ongoing("PAUSE")
+
+    @passive
+    def gen():
+        for delay, value in zip(delays, values):
+            held = 0
+            while held < 2:
+                held = held + 1 if (yield pause) else 0
+                yield
+            for i in range(delay):
+                yield
+            yield dut.tx_data.r.eq(value)
+            yield dut.tx_data.re.eq(1)
+            yield
+            yield dut.tx_data.re.eq(0)
+            while (yield pause):
+                yield
+        while True:
+            yield
+    return gen()
+
+
+def TestPerfCounters(vcd=None, artifacts="build"):
+    """The perf counters count the events of a few transactions, two of
+    them stretched, only show them once updated, bin the stretches by
+    length and clear."""
+    bus = I2CBus(fifo_depth=16, perf=True)
+    dut = bus.dut
+    perf = dut.perf
+    master = I2CMaster(bus, 40)
+    delays = [20, 300]
+
+    def read_byte(addr):
+        yield from master.start()
+        acked = yield from master.write((addr << 1) | 1)
+        value = None
+        if acked:
+            value = yield from master.read(False)
+        yield from master.stop()
+        return value
+
+    def status():
+        yield perf.update.re.eq(1)
+        yield
+        yield perf.update.re.eq(0)
+        yield
+        counts = {}
+        for name in ("starts", "stops", "matches", "nacks", "bytes_read",
+                     "bytes_written", "stretch_cycles", "stretch_max"):
+            counts[name] = yield getattr(perf, name).status
+        return counts
+
+    def histogram():
+        bins = []
+        for k in range(perf.hist_bins):
+            yield perf.hist_index.storage.eq(k)
+            yield
+            yield
+            bins.append((yield perf.hist_count.status))
+        return bins
+
+    def bench():
+        yield dut.match0.addr.storage.eq(0x40)
+        yield dut.tx_data.r.eq(0x5a)
+        yield dut.tx_data.re.eq(1)
+        yield
+        yield dut.tx_data.re.eq(0)
+        yield
+        # one read from the FIFO, two stretched until the CPU fills it
+        assert (yield from read_byte(0x40)) == 0x5a
+        assert (yield from read_byte(0x40)) == 0xa0
+        assert (yield from read_byte(0x40)) == 0xa1
+        # a word address written, and an address not matched
+        yield from master.start()
+        assert (yield from master.write(0x40 << 1))
+        yield from master.write(0x01)
+        yield from master.write(0x23)
+        yield from master.stop()
+        for value in (0x01, 0x23):
+            assert (yield dut.rx_data.w) == value
+            yield dut.rx_data.re.eq(1)
+            yield
+            yield dut.rx_data.re.eq(0)
+            yield
+        assert (yield from read_byte(0x41)) is None
+
+        # nothing shows before an update
+        assert not (yield perf.starts.status)
+        counts = yield from status()
+        short = counts["stretch_cycles"] - counts["stretch_max"]
+        long = counts["stretch_max"]
+        assert delays[0] <= short < delays[0] + 8, counts
+        assert delays[1] <= long < delays[1] + 8, counts
+        del counts["stretch_cycles"], counts["stretch_max"]
+        assert counts == {"starts": 5, "stops": 5, "matches": 4, "nacks": 3,
+                          "bytes_read": 3, "bytes_written": 2}, counts
+        bins = yield from histogram()
+        expected = [0]*perf.hist_bins
+        expected[short.bit_length() - 1] += 1
+        expected[long.bit_length() - 1] += 1
+        assert bins == expected, bins
+        assert bins[4] == bins[8] == 1, bins
+
+        # the live counters go on, the status only follows on update
+        yield dut.tx_data.r.eq(0x5b)
+        yield dut.tx_data.re.eq(1)
+        yield
+        yield dut.tx_data.re.eq(0)
+        assert (yield from read_byte(0x40)) == 0x5b
+        assert (yield perf.starts.status) == 5
+        counts = yield from status()
+        assert counts["starts"] == 6 and counts["bytes_read"] == 4, counts
+        assert counts["stretch_max"] == long, counts
+
+        yield perf.clear.re.eq(1)
+        yield
+        yield perf.clear.re.eq(0)
+        for i in range(perf.hist_bins + 2):
+            yield
+        counts = yield from status()
+        assert not any(counts.values()), counts
+        bins = yield from histogram()
+        assert not any(bins), bins
+
+    dump = simulate(bus, [bench(), _stretched_fills(bus, delays, [0xa0, 0xa1])],
+                    "TestPerfCounters", vcd)
+    if dump:
+        dump.write()
+
+
+def _trace_monitor(dut, samples):
+    """Appends to samples, from the cycle trace.arm is written on, the
+    fields the trace samples in trace2vcd.FIELDS order, the addr trigger
+    and trace.done."""
+    states = [dut.fsm.ongoing(name) for name in dut.trace_states]
+
+    @passive
+    def gen():
+        while not (yield dut.trace.arm.re):
+            yield
+        while True:
+            state = 0
+            for i, ongoing in enumerate(states):
+                if (yield ongoing):
+                    state = i
+            # the drivers as they are the cycle before they reach the pins
+            sample = {
+                "scl": (yield dut.scl_filter.o),
+                "sda": (yield dut.sda_filter.o),
+                "state": state,
+                "rx_level": (yield dut.rx_fifo.level),
+                "tx_level": (yield dut.tx_level.status),
+            }
+            if samples:
+                samples[-1][0]["scl_drv"] = yield dut.scl_oe
+                samples[-1][0]["sda_drv"] = yield dut.sda_oe
+            samples.append((sample, (yield dut.ev.addr.trigger),
+                            (yield dut.trace.done.status)))
+            yield
+    return gen()
+
+
+def _trace_read(dut, depth):
+    """The entries of the last capture, oldest first, and the index of the
+    trigger entry among them."""
+    n = yield dut.trace.write_ptr.status
+    first = 0
+    if (yield dut.trace.wrapped.status):
+        first, n = n, depth
+    entries = []
+    for i in range(n):
+        entries.append((yield dut.trace.sram.mem[(first + i) % depth]))
+    trigger = ((yield dut.trace.trigger_ptr.status) - first) % depth
+    return entries, trigger
+
+
+def _trace_cycles(entries):
+    """The fields of every cycle the entries cover."""
+    cycles = []
+    for (cycle, values), entry in zip(trace2vcd.decode(entries), entries):
+        n = (entry & (2**trace2vcd.COUNT_BITS - 1)) + 1
+        cycles.extend([values]*n)
+    return cycles
+
+
+def TestTraceBuffer(vcd=None, artifacts="build"):
+    """Captures decode with trace2vcd into what the core did, cycle by
+    cycle: a short one with a run longer than an entry holds, triggered
+    by an address match, and one going round the ring several times,
+    triggered by a stretch."""
+    names = [name for name, width in trace2vcd.FIELDS]
+
+    # depth, trigger_mask, post_trigger, idle cycles, fill delays
+    cases = [
+        (128, 0b0010, 4, 4200, []),
+        (16, 0b1000, 8, 0, [50]),
+    ]
+    for depth, mask, post, idle, delays in cases:
+        bus = I2CBus(fifo_depth=16, trace_depth=depth)
+        dut = bus.dut
+        master = I2CMaster(bus, 40)
+        samples = []
+        captured = []
+
+        def bench():
+            yield dut.match0.addr.storage.eq(0x40)
+            yield dut.tx_data.r.eq(0x5a)
+            yield dut.tx_data.re.eq(1)
+            yield
+            yield dut.tx_data.re.eq(0)
+            yield dut.trace.trigger_mask.storage.eq(mask)
+            yield dut.trace.stretch_threshold.storage.eq(20)
+            yield dut.trace.post_trigger.storage.eq(post)
+            yield dut.trace.arm.re.eq(1)
+            yield
+            yield dut.trace.arm.re.eq(0)
+            for i in range(idle):
+                yield
+            for i in range(1 + len(delays)):
+                yield from master.start()
+                assert (yield from master.write((0x40 << 1) | 1))
+                yield from master.read(False)
+                yield from master.stop()
+            assert (yield dut.trace.done.status)
+            captured.append((yield from _trace_read(dut, depth)))
+            captured.append((yield dut.trace.wrapped.status))
+
+        generators = [bench(), _trace_monitor(dut, samples),
+                      _stretched_fills(bus, delays, [0xa1])]
+        dump = simulate(bus, generators,
+                        "TestTraceBuffer_depth{}".format(depth), vcd)
+        if dump:
+            dump.write()
+
+        (entries, trigger), wrapped = captured
+        assert wrapped == (idle == 0), (depth, wrapped)
+        cycles = _trace_cycles(entries)
+        # the capture stops on the entry it writes the cycle before done
+        end = [done for sample, addr, done in samples].index(1) - 1
+        begin = end - len(cycles)
+        assert begin == 0 if not wrapped else begin > 0, (depth, begin)
+        expected = [sample for sample, addr, done in samples[begin:end]]
+        for i, (got, want) in enumerate(zip(cycles, expected)):
+            assert [got[k] for k in names] == [want[k] for k in names], \
+                (depth, begin + i, got, want)
+
+        trigger_begin = len(_trace_cycles(entries[:trigger]))
+        trigger_end = len(_trace_cycles(entries[:trigger + 1]))
+        assert len(entries) - trigger - 1 == post, (depth, trigger)
+        if idle:
+            assert any(entry & (2**trace2vcd.COUNT_BITS - 1) ==
+                       2**trace2vcd.COUNT_BITS - 1 for entry in entries)
+            match = [addr for sample, addr, done in samples].index(1)
+            assert trigger_begin <= match < trigger_end, \
+                (match, trigger_begin, trigger_end)
+        else:
+            pause = dut.trace_states.index("PAUSE")
+            assert cycles[trigger_begin]["state"] == pause
+
+
+def TestEEPROMInit(vcd=None, artifacts="build"):
+    """The images in the bitstream are served from their reset addresses
+    with the CPU held in reset, without a single CSR write: truncated to
+    their bank, padded with 0xff, and the pointer wraps in the bank."""
+    rng = random.Random(4)
+    a = [rng.randrange(256) for i in range(300)]  # larger than its bank
+    b = [rng.randrange(256) for i in range(100)]
+    bus = I2CBus(fifo_depth=16, eeprom_size=512, addresses=2,
+                 eeprom_init=[bytes(a), bytes(b)], reset_addrs=[0x40, 0x51])
+    dut = bus.dut
+    master = I2CMaster(bus, 40)
+
+    def bench():
+        data = yield from master.eeprom_read(0x40, 252, 6)
+        assert data == a[252:256] + a[:2], data
+        data = yield from master.eeprom_read(0x51, 96, 6)
+        assert data == b[96:100] + [0xff]*2, data
+        # each bank kept its own pointer, a current address read goes on
+        # where the first read stopped
+        yield from master.start()
+        assert (yield from master.write((0x40 << 1) | 1))
+        data = yield from master.read(False)
+        assert data == a[2], data
+        assert (yield dut.busy.status)
+        yield from master.stop()
+        assert not (yield dut.busy.status)
+        yield from master.start()
+        assert not (yield from master.write(0x52 << 1))
+        yield from master.stop()
+
+    dump = simulate(bus, [bench()], "TestEEPROMInit", vcd)
+    if dump:
+        dump.write()
+
+
+def TestTxnOverflow(vcd=None, artifacts="build"):
+    """Writes whose descriptors did not fit the queue are skipped by the
+    firmware, found either at the next descriptor or with the queue empty,
+    and the address written after them is the one applied."""
+    rng = random.Random(5)
+    image = [rng.randrange(256) for i in range(256)]
+    bus = I2CBus(fifo_depth=16, txn_depth=2)
+    dut = bus.dut
+    master = I2CMaster(bus, 40)
+    fw = FirmwareModel(dut, image, 16, txn=True)
+    running = [False]
+    # two of them are queued, the last two dropped, the odd lengths leave
+    # the address bytes of the next write off the even positions
+    writes = [[0x00, 0x10], [0x00, 0x20, 0xaa], [0x00, 0x30],
+              [0x00, 0x50, 0xbb]]
+
+    def write(data):
+        yield from master.start()
+        assert (yield from master.write(0x40 << 1))
+        for b in data:
+            assert (yield from master.write(b))
+        yield from master.stop()
+
+    def bench():
+        yield dut.match0.addr.storage.eq(0x40)
+        yield from fw.tx_refill()
+        # with the queue empty once the firmware got the two
+        for data in writes:
+            yield from write(data)
+        assert (yield dut.txn.level.status) == 2
+        running[0] = True
+        data = yield from master.eeprom_read(0x40, 0x64, 4)
+        assert data == image[0x64:0x68], data
+
+        # at the descriptor queued after them
+        running[0] = False
+        for i in range(100):
+            yield
+        for data in writes:
+            yield from write(data)
+        for i in range(2):
+            yield from fw.write_csr(dut.rx_data)
+        yield from fw.write_csr(dut.txn.data, words=1)
+        yield from write([0x00, 0x84])
+        running[0] = True
+        while (yield dut.rx_level.status):
+            yield
+        for i in range(100):
+            yield
+        yield from master.start()
+        assert (yield from master.write((0x40 << 1) | 1))
+        data = []
+        for i in range(4):
+            data.append((yield from master.read(i != 3)))
+        yield from master.stop()
+        assert data == image[0x84:0x88], data
+
+    @passive
+    def firmware():
+        while True:
+            if running[0]:
+                yield from fw.rx_drain()
+                yield from fw.tx_refill()
+            else:
+                yield
+
+    dump = simulate(bus, [bench(), firmware()], "TestTxnOverflow", vcd)
+    if dump:
+        dump.write()
+
+
+TESTS = [
+    TestGlitchFilter,
+    TestHsMode,
+    TestDMAAndCPUWrites,
+    TestPerfCounters,
+    TestTraceBuffer,
+    TestEEPROMInit,
+    TestTxnOverflow,
+]
+
+
+def _int_list(s):
+    return [int(x) for x in s.split(",")]
+
+
+def _run_point(args, transactions, point):
+    mode, half_period, latency = point
+    return run(mode, transactions, half_period, args.fifo_depth,
+               args.csr_cycles, latency=latency, clk_freq=args.clk_freq)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark polling, interrupt,"
+                                                 " DMA and transaction driven"
+                                                 " servicing of I2CShiftReg")
+    parser.add_argument("-n", "--transactions", default=20, type=int,
+                        help="number of random reads, 200 of them for p99"
+                             " figures that mean something. Default: 20")
+    parser.add_argument("-b", "--bytes", default=16, type=int,
+                        help="most bytes per random read, each reads from 1"
+                             " to that many. Default: 16")
+    parser.add_argument("--bus-khz", default=[400], type=_int_list,
+                        help="comma separated SCL frequencies to sweep."
+                             " Default: 400")
+    parser.add_argument("--latency", default=[40], type=_int_list,
+                        help="comma separated firmware service latencies to"
+                             " sweep, in sys clock cycles. Default: 40")
+    parser.add_argument("--modes", default="polling,irq,dma,txn",
+                        help="comma separated servicing modes."
+                             " Default: polling,irq,dma,txn")
+    parser.add_argument("--clk-freq", default=83333333, type=int,
+                        help="sys clock frequency in Hz. Default: 83333333")
+    parser.add_argument("--fifo-depth", default=16, type=int)
+    parser.add_argument("--csr-cycles", default=8, type=int,
+                        help="cost of one CSR access. Default: 8")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON")
+    parser.add_argument("-j", "--jobs", default=os.cpu_count(), type=int,
+                        help="number of processes. Default: one per CPU")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    transactions = [(rng.randrange(256), rng.randint(1, args.bytes))
+                    for i in range(args.transactions)]
+    if not args.json:
+        print("{:>8} {:>7} {:>7} {:>9} {:>13} {:>11} {:>9} {:>9}".format(
+            "mode", "kHz", "latency", "bytes/s", "stretch/byte", "stretch p99",
+            "xfer p99", "cpu/byte"))
+    points = [(mode, round(args.clk_freq/(2*khz*1e3)), latency)
+              for khz in args.bus_khz
+              for latency in args.latency
+              for mode in args.modes.split(",")]
+    results = []
+    # every point is a simulation of its own, about 5 minutes long at
+    # 400 kHz with the default -n and an hour with -n 200
+    with multiprocessing.Pool(min(args.jobs, len(points))) as pool:
+        for r in pool.imap(partial(_run_point, args, transactions), points):
+            results.append(r)
+            if not args.json:
+                print("{mode:>8} {bus_khz:>7} {latency:>7} {bytes_per_s:>9.0f}"
+                      " {stretch_per_byte:>13.1f} {stretch[p99]:>11}"
+                      " {transaction_us[p99]:>7.1f}us {cpu_per_byte:>9.1f}".format(**r))
+                sys.stdout.flush()
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
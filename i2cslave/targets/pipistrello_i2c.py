@@ -4,37 +4,527 @@
 import argparse
 import os
 from fractions import Fraction
+from functools import reduce
+from operator import add, or_
 
 from migen import *
 from migen.fhdl.specials import Tristate
 from migen.genlib.cdc import MultiReg
 from migen.genlib.resetsync import AsyncResetSynchronizer
 from migen.genlib.misc import chooser
+from migen.genlib.fifo import SyncFIFO
 from migen.build.generic_platform import Pins, IOStandard
 
 from misoc.interconnect.csr import *
+from misoc.interconnect.csr_eventmanager import *
+from misoc.interconnect import wishbone
 from misoc.integration.builder import *
 from misoc.cores.sdram_settings import MT46H32M16
 from misoc.cores.sdram_phy import S6HalfRateDDRPHY
 from misoc.cores import spi_flash
 from misoc.integration.soc_sdram import *
 
+from .i2c_engine import I2CEngine
 from ..platforms import pipistrello_i2c
+from ..tools import trace2vcd
 from migen.build.platforms import pipistrello
 
 i2cslave_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)))
 
+class _AddressMatch(Module, AutoCSR):
+    """One slave address table entry, bits set in mask are don't care."""
+    def __init__(self, received, enable=0, addr=0):
+        self.addr = CSRStorage(7, reset=addr)
+        self.mask = CSRStorage(7)
+        self.enable = CSRStorage(reset=enable)
+
+        self.hit = Signal()
+        self.comb += self.hit.eq(self.enable.storage &
+                                 (((received ^ self.addr.storage) & ~self.mask.storage) == 0))
+
+
+class _GlitchFilter(Module):
+    """Follows i once its last n samples agree, or with majority set once
+    most of them do (n odd). n=1 just resamples i, n must be from 1 to
+    depth. Starts high, like an idle bus.
+    """
+    def __init__(self, i, ce, n, majority, depth):
+        self.o = Signal(reset=1)
+
+        ###
+
+        history = Signal(depth, reset=2**depth - 1)
+        window = Signal(depth)
+        mask = Signal(depth)
+        count = Signal(max=depth + 1)
+        self.comb += [
+            mask.eq(Array(C((1 << k) - 1, depth) for k in range(depth + 1))[n]),
+            window.eq(Cat(i, history[:-1]) & mask),
+            count.eq(reduce(add, [window[k] for k in range(depth)])),
+        ]
+        self.sync += If(ce,
+            history.eq(Cat(i, history[:-1])),
+            If(majority,
+                self.o.eq(count > (n >> 1))
+            ).Elif(window == mask,
+                self.o.eq(1)
+            ).Elif(window == 0,
+                self.o.eq(0)
+            )
+        )
+
+
+class _PerfCounters(Module, AutoCSR):
+    """Bus statistics, counting since the last write to clear.
+
+    Writing update copies the live counters into the status registers, so
+    they can be read consistently word by word. The counters wrap around.
+    stretch_cycles and stretch_max count the cycles SCL is held waiting
+    on the CPU, the master only sees the part of a stretch that outlasts
+    its own low half period. Every stretch also counts in the hist_count
+    bin hist_index reads: bin k for 2**k to 2**(k + 1) - 1 cycles, the
+    last bin for everything longer.
+    """
+    def __init__(self, start, stop, match, nack, byte_read, byte_written,
+                 stretch, hist_bins=16):
+        self.hist_bins = hist_bins
+        self.update = CSR()
+        self.clear = CSR()
+        self.starts = CSRStatus(32)
+        self.stops = CSRStatus(32)
+        self.matches = CSRStatus(32)
+        self.nacks = CSRStatus(32)
+        self.bytes_read = CSRStatus(32)
+        self.bytes_written = CSRStatus(32)
+        self.stretch_cycles = CSRStatus(32)
+        self.stretch_max = CSRStatus(32)
+        self.hist_index = CSRStorage(bits_for(hist_bins - 1))
+        self.hist_count = CSRStatus(32)
+
+        ###
+
+        events = [
+            (self.starts, start),
+            (self.stops, stop),
+            (self.matches, match),
+            (self.nacks, nack),
+            (self.bytes_read, byte_read),
+            (self.bytes_written, byte_written),
+            (self.stretch_cycles, stretch),
+        ]
+        for csr, event in events:
+            count = Signal(32)
+            self.sync += [
+                If(self.clear.re,
+                    count.eq(0)
+                ).Elif(event,
+                    count.eq(count + 1)
+                ),
+                If(self.update.re, csr.status.eq(count)),
+            ]
+
+        stretch_r = Signal()
+        length = Signal(32)  # of the current or last stretch
+        ended = Signal()
+        longest = Signal(32)
+        self.comb += ended.eq(stretch_r & ~stretch)
+        self.sync += [
+            stretch_r.eq(stretch),
+            If(stretch,
+                If(~stretch_r,
+                    length.eq(1)
+                ).Elif(length != 2**32 - 1,
+                    length.eq(length + 1)
+                )
+            ),
+            If(self.clear.re,
+                longest.eq(0)
+            ).Elif(ended & (length > longest),
+                longest.eq(length)
+            ),
+            If(self.update.re, self.stretch_max.status.eq(longest)),
+        ]
+
+        # bin of the stretch that just ended, from its most significant bit
+        msb = Signal(5)
+        hist_bin = Signal(bits_for(hist_bins - 1))
+        for k in range(32):
+            self.comb += If(length[k], msb.eq(k))
+        self.comb += hist_bin.eq(Mux(msb >= hist_bins - 1, hist_bins - 1, msb))
+
+        hist = Memory(32, hist_bins)
+        port = hist.get_port(write_capable=True)
+        cpu_port = hist.get_port()
+        self.specials += hist, port, cpu_port
+        self.comb += [
+            cpu_port.adr.eq(self.hist_index.storage),
+            self.hist_count.status.eq(cpu_port.dat_r),
+        ]
+
+        # read the bin when a stretch ends, write it back incremented on
+        # the next cycle. clear walks through the bins to zero them.
+        inc = Signal()
+        inc_bin = Signal(len(hist_bin))
+        clearing = Signal()
+        clear_adr = Signal(len(hist_bin))
+        self.sync += [
+            inc.eq(ended),
+            inc_bin.eq(hist_bin),
+            If(self.clear.re,
+                clearing.eq(1),
+                clear_adr.eq(0)
+            ).Elif(clearing,
+                clear_adr.eq(clear_adr + 1),
+                If(clear_adr == hist_bins - 1, clearing.eq(0))
+            ),
+        ]
+        self.comb += [
+            If(clearing,
+                port.adr.eq(clear_adr),
+                port.dat_w.eq(0),
+                port.we.eq(1)
+            ).Elif(inc,
+                port.adr.eq(inc_bin),
+                port.dat_w.eq(port.dat_r + 1),
+                port.we.eq(1)
+            ).Else(
+                port.adr.eq(hist_bin)
+            )
+        ]
+
+
+class _TraceBuffer(Module, AutoCSR):
+    """Logic analyzer capturing sample into a ring of depth entries.
+
+    Each 32-bit entry holds a value of sample in its upper bits and, in
+    its COUNT_BITS low bits, for how many more cycles it lasted. Long runs take
+    several entries. The ring is read through bus, the oldest entry is at
+    write_ptr once wrapped is set, at 0 before.
+
+    Writing arm restarts the capture. It goes on until post_trigger
+    entries past the one the trigger happened in have been written, then
+    done is set and trigger_ptr tells which entry that was. trigger_mask
+    selects the triggers: bits 0 to 2 for the pulses in triggers, bit 3
+    for stretch lasting stretch_threshold cycles. With no trigger
+    selected, the capture triggers right away.
+    """
+    def __init__(self, sample, triggers, stretch, depth):
+        self.arm = CSR()
+        self.trigger_mask = CSRStorage(len(triggers) + 1)
+        self.stretch_threshold = CSRStorage(16)
+        self.post_trigger = CSRStorage(log2_int(depth))
+        self.done = CSRStatus()
+        self.wrapped = CSRStatus()
+        self.write_ptr = CSRStatus(log2_int(depth))
+        self.trigger_ptr = CSRStatus(log2_int(depth))
+        self.bus = wishbone.Interface()
+
+        ###
+
+        mem = Memory(32, depth)
+        self.submodules.sram = wishbone.SRAM(mem, read_only=True, bus=self.bus)
+        port = mem.get_port(write_capable=True)
+        self.specials += port
+
+        stretch_len = Signal(16)
+        self.sync += If(~stretch,
+            stretch_len.eq(0)
+        ).Elif(stretch_len != 2**16 - 1,
+            stretch_len.eq(stretch_len + 1)
+        )
+        sources = Cat(*triggers, stretch & (stretch_len == self.stretch_threshold.storage))
+        trigger = Signal()
+        self.comb += trigger.eq((self.trigger_mask.storage == 0) |
+                                ((sources & self.trigger_mask.storage) != 0))
+
+        capturing = Signal()
+        triggered = Signal()
+        post_left = Signal(len(self.post_trigger.storage))
+        ptr = self.write_ptr.status
+        value = Signal(len(sample))  # of the current run
+        count = Signal(trace2vcd.COUNT_BITS)
+        emit = Signal()
+        self.comb += [
+            emit.eq(capturing & ((sample != value) |
+                                 (count == 2**len(count) - 1))),
+            port.adr.eq(ptr),
+            port.dat_w.eq(Cat(count, value)),
+            port.we.eq(emit),
+        ]
+        self.sync += [
+            If(emit | ~capturing,
+                value.eq(sample),
+                count.eq(0)
+            ).Else(
+                count.eq(count + 1)
+            ),
+            If(self.arm.re,
+                capturing.eq(1),
+                triggered.eq(0),
+                self.done.status.eq(0),
+                self.wrapped.status.eq(0),
+                ptr.eq(0),
+                post_left.eq(self.post_trigger.storage)
+            ).Elif(capturing,
+                If(~triggered & trigger,
+                    triggered.eq(1),
+                    # the sample goes to the next entry if this run ends
+                    self.trigger_ptr.status.eq(ptr + emit)
+                ),
+                If(emit,
+                    ptr.eq(ptr + 1),
+                    If(ptr == depth - 1, self.wrapped.status.eq(1)),
+                    If(triggered,
+                        If(post_left == 0,
+                            capturing.eq(0),
+                            self.done.status.eq(1)
+                        ).Else(
+                            post_left.eq(post_left - 1)
+                        )
+                    )
+                )
+            )
+        ]
+
+
+class _TransactionQueue(Module, AutoCSR):
+    """Descriptors of the transactions the core answered, for the CPU to
+    handle whole transactions instead of single bytes.
+
+    A transaction starts with the match of its address and ends with a
+    STOP, a repeated START or, for reads, the NACK of the last byte,
+    whichever comes first. Its descriptor is then queued, data reads the
+    oldest one and writing data pops it, level tells how many there are
+    and trigger is high once there are threshold of them:
+
+        bits 0-6    matched address
+        bit 7       read
+        bits 8-9    end: TXN_STOP, TXN_RESTART or TXN_NACK
+        bit 10      descriptors were dropped before this one, the queue
+                    being full
+        bits 11-15  address table entry
+        bits 16-31  bytes transferred, saturated
+
+    The bytes a write leaves in the RX FIFO are all in by the time its
+    descriptor is queued. Those of the writes whose descriptors were
+    dropped are still in it, ahead of the bytes of the next descriptor:
+    lost counts them, saturated, for the oldest descriptor or, with the
+    queue empty, for the transactions since the last one queued.
+    """
+    TXN_STOP = 0
+    TXN_RESTART = 1
+    TXN_NACK = 2
+
+    def __init__(self, match, addr, read, index, byte, start, stop, nack,
+                 depth):
+        self.submodules.fifo = fifo = SyncFIFO(32 + 16, depth)
+        lost = Signal(16)  # since the last descriptor queued
+        self.data = CSR(32)
+        self.lost = CSRStatus(16)
+        self.level = CSRStatus(bits_for(depth))
+        self.threshold = CSRStorage(bits_for(depth), reset=1)
+        self.trigger = Signal()
+
+        self.comb += [
+            self.data.w.eq(fifo.dout[:32]),
+            self.lost.status.eq(Mux(fifo.readable, fifo.dout[32:], lost)),
+            fifo.re.eq(self.data.re),
+            self.level.status.eq(fifo.level),
+            self.trigger.eq(fifo.readable &
+                            (fifo.level >= self.threshold.storage)),
+        ]
+
+        ###
+
+        active = Signal()
+        t_addr = Signal(7)
+        t_read = Signal()
+        t_index = Signal(5)
+        count = Signal(16)
+        count_next = Signal(16)
+        end = Signal(2)
+        push = Signal()
+        dropped = Signal()
+        lost_next = Signal(17)
+        self.comb += [
+            count_next.eq(count + (byte & (count != 2**16 - 1))),
+            lost_next.eq(lost + Mux(t_read, 0, count_next)),
+            If(nack,
+                end.eq(self.TXN_NACK)
+            ).Elif(start,
+                end.eq(self.TXN_RESTART)
+            ).Else(
+                end.eq(self.TXN_STOP)
+            ),
+            push.eq(active & (nack | start | stop)),
+            fifo.din.eq(Cat(t_addr, t_read, end, dropped, t_index,
+                            count_next, lost)),
+            fifo.we.eq(push),
+        ]
+        self.sync += [
+            If(match,
+                active.eq(1),
+                t_addr.eq(addr),
+                t_read.eq(read),
+                t_index.eq(index),
+                count.eq(0)
+            ).Elif(push,
+                active.eq(0)
+            ).Else(
+                count.eq(count_next)
+            ),
+            If(push, dropped.eq(~fifo.writable)),
+            If(push & fifo.writable,
+                lost.eq(0)
+            ).Elif(push,
+                lost.eq(Mux(lost_next[16], 2**16 - 1, lost_next))
+            ),
+        ]
+
+
 class I2CShiftReg(Module, AutoCSR):
-    def __init__(self, pads, debug_ios):
+    """I2C slave with TX/RX FIFOs between the bus and the CPU.
+
+    Bytes written to tx_data are sent to the master on reads, bytes the
+    master writes are queued up for the CPU in rx_data (read the head byte,
+    write anything to pop it). SCL is only stretched when the master reads
+    from an empty TX FIFO or writes into a full RX FIFO.
+
+    Behind the TX FIFO, the next byte to send moves into a shadow register
+    and from there into the shift register as soon as the previous byte is
+    out, during its ACK. A read continuing after an ACK is thus served
+    without going back to the FIFO. Both stages count in tx_level, the
+    shift register until the next byte moves in, so the TX side holds
+    tx_depth = fifo_depth + 2 bytes.
+
+    The core answers to the addresses in a table of match0, match1, ...
+    entries, the first enabled one to match wins. Only match0 is enabled
+    at reset. match_addr holds the last address matched and, with more
+    than one entry, match_index which entry that was. Each entry is a
+    context of its own: bytes in the RX FIFO carry the index of the entry
+    they were written to (rx_index for the head byte), and reads are only
+    served from the TX FIFO once the CPU has set tx_context to the entry
+    being read from, stretching meanwhile.
+
+    Reads also stall while the RX FIFO holds data, so the CPU always sees a
+    written word address before the read it applies to is served.
+
+    With eeprom_size set, the core can also emulate an EEPROM on its own:
+    the word address is parsed in gateware and bytes are read from (and
+    written to) a memory the CPU loads over the Wishbone bus. The memory is
+    split in one bank per table entry, each with its own address pointer.
+    With 1-byte word addresses, the don't care bits of the matched address
+    select the 256 byte block like on a 24C16. eeprom_ctrl takes effect
+    while the bus is idle, or at the STOP of the transaction going on, so
+    the emulation is only ever turned on or off between transactions. busy
+    is set between a START and a STOP.
+
+    eeprom_init, a list of images for the banks of the table entries in
+    order, puts their first bytes in the memory in the bitstream, padded
+    with 0xff. The emulation is then on at reset with 2-byte word
+    addresses, and reset_addrs gives the reset addresses of the first
+    table entries, which are enabled at reset too: reads are served from
+    configuration on, before the CPU runs.
+
+    The rx/tx events fire once the RX FIFO holds rx_threshold bytes or the
+    TX FIFO is down to tx_threshold bytes, so one interrupt services many
+    bytes. The rx event also fires as soon as the bus is stretched waiting
+    on the CPU. Pass pads=None to drive _scl_i_async/_sda_i_async and
+    watch scl_oe/sda_oe directly, e.g. in simulation.
+
+    SCL and SDA are sampled every sample_div + 1 cycles and go through a
+    glitch filter that waits for filter_len agreeing samples, or with
+    filter_majority for most of them. filter_len goes from 1 to
+    filter_depth, 0 is taken as 1 and larger values as filter_depth. The reset values
+    sample every 8 cycles without filtering, which is plenty up to Fast
+    mode. Faster buses need a smaller divider, at the cost of a shorter
+    spike rejection for the same filter length. After an Hs-mode master
+    code, which is not acknowledged, hs_sample_div and hs_filter_len
+    apply instead until the next STOP, and hs_active is set.
 
-        STATUS_FULL = 1
-        STATUS_EMPTY = 2
+    With dma set, dma_bus is a Wishbone master that moves dma_length bytes
+    between memory at byte address dma_base and one of the FIFOs, so the
+    CPU only sets up transfers: dma_mode 0 fills the TX FIFO from memory,
+    1 drains the RX FIFO to memory. Writing dma_start starts a transfer
+    once the current one is over, the dma event fires when it is done.
+    tx_flush cancels a transfer into the TX FIFO, without an event. The
+    CPU can still write tx_data during a transfer into the TX FIFO, its
+    bytes go in between those of the transfer.
 
-        self.shift_reg = shift_reg = CSRStorage(8, write_from_dev=True)
-        self.status = status = CSRStorage(2, reset=STATUS_EMPTY, write_from_dev=True)
-        self.slave_addr = slave_addr = CSRStorage(7)
+    With perf set, the perf submodule counts starts, stops, address
+    matches, NACKs, bytes and stretch cycles, see _PerfCounters.
+
+    With trace_depth set, the trace submodule is a logic analyzer with
+    that many entries, see _TraceBuffer. It samples the filtered SCL and
+    SDA, the SCL and SDA drivers, the FSM state (numbered in the order of
+    trace_states), the RX and TX levels (saturated to 63), laid out as
+    tools/trace2vcd.py decodes them. It triggers on START, address match,
+    NACK and stretch. This replaces the debug_ios pins, which are
+    optional.
+
+    With txn_depth set, the txn submodule queues up to that many
+    descriptors of the transactions served, see _TransactionQueue, and
+    the txn event fires while it holds txn_threshold of them.
+    """
+    def __init__(self, pads, debug_ios=None, fifo_depth=16, eeprom_size=0,
+                 dma=False, addresses=1, filter_depth=5, perf=False,
+                 trace_depth=0, txn_depth=0, eeprom_init=None,
+                 reset_addrs=()):
+        if debug_ios is None:
+            debug_ios = Signal(13)
+
+        ctx = Signal(max=max(addresses, 2))  # table entry that matched last
+        ctx_bits = len(ctx) if addresses > 1 else 0
+
+        self.submodules.tx_fifo = tx_fifo = ResetInserter()(SyncFIFO(8, fifo_depth))
+        self.submodules.rx_fifo = rx_fifo = SyncFIFO(8 + ctx_bits, fifo_depth)
+
+        self.tx_data = tx_data = CSR(8)
+        self.tx_depth = fifo_depth + 2
+        self.tx_level = tx_level = CSRStatus(bits_for(self.tx_depth))
+        self.tx_flush = tx_flush = CSR()
+        self.rx_data = rx_data = CSR(8)
+        self.rx_level = rx_level = CSRStatus(bits_for(fifo_depth))
+        self.rx_threshold = rx_threshold = CSRStorage(bits_for(fifo_depth), reset=1)
+        self.tx_threshold = tx_threshold = CSRStorage(bits_for(fifo_depth), reset=fifo_depth//2)
+        self.match_addr = match_addr = CSRStatus(7)
+        self.sample_div = sample_div = CSRStorage(8, reset=7)
+        self.filter_len = filter_len = CSRStorage(bits_for(filter_depth), reset=1)
+        self.filter_majority = filter_majority = CSRStorage()
+        self.hs_sample_div = hs_sample_div = CSRStorage(8)
+        self.hs_filter_len = hs_filter_len = CSRStorage(bits_for(filter_depth), reset=1)
+        self.hs_active = hs_active = CSRStatus()
+        if addresses > 1:
+            self.match_index = CSRStatus(len(ctx))
+            self.rx_index = CSRStatus(len(ctx))
+            self.tx_context = CSRStorage(len(ctx))
+            self.comb += [
+                self.match_index.status.eq(ctx),
+                self.rx_index.status.eq(rx_fifo.dout[8:]),
+            ]
         self.pads = pads
 
+        self.submodules.ev = EventManager()
+        self.ev.rx = EventSourceLevel()
+        self.ev.tx = EventSourceLevel()
+        self.ev.addr = EventSourcePulse()
+        self.ev.start = EventSourcePulse()
+        self.ev.stop = EventSourcePulse()
+        if txn_depth:
+            self.ev.txn = EventSourceLevel()
+        if dma:
+            self.ev.dma = EventSourcePulse()
+        self.ev.finalize()
+
+        self.comb += [
+            tx_fifo.din.eq(tx_data.r),
+            tx_fifo.we.eq(tx_data.re),
+            tx_fifo.reset.eq(tx_flush.re),
+            rx_data.w.eq(rx_fifo.dout[:8]),
+            rx_fifo.re.eq(rx_data.re),
+            rx_level.status.eq(rx_fifo.level),
+        ]
+
         ###
 
         scl_raw = Signal()
@@ -48,11 +538,14 @@ class I2CShiftReg(Module, AutoCSR):
         _scl_drv_reg = Signal()
         self.sync += _sda_drv_reg.eq(sda_drv)
         self.sync += _scl_drv_reg.eq(scl_drv)
+        if pads is not None:
+            self.specials += [
+                Tristate(pads.sda, 0, _sda_drv_reg, _sda_i_async),
+                Tristate(pads.scl, 0, _scl_drv_reg, _scl_i_async),
+            ]
         self.specials += [
-            Tristate(pads.sda, 0, _sda_drv_reg, _sda_i_async),
-            Tristate(pads.scl, 0, _scl_drv_reg, _scl_i_async),
-            MultiReg(_scl_i_async, scl_raw),
-            MultiReg(_sda_i_async, sda_raw),
+            MultiReg(_scl_i_async, scl_raw, reset=1),
+            MultiReg(_sda_i_async, sda_raw, reset=1),
         ]
 
         # for debug
@@ -61,22 +554,38 @@ class I2CShiftReg(Module, AutoCSR):
         self.sda_o = Signal()
         self.comb += self.sda_o.eq(~_sda_drv_reg)
         self.sda_oe = _sda_drv_reg
+        self.scl_oe = _scl_drv_reg
 
-        shift_reg_full = Signal()
-        shift_reg_empty = Signal()
-        scl_i = Signal()
-        samp_count = Signal(3)
-        samp_carry = Signal()
-        self.sync += [
-            Cat(samp_count, samp_carry).eq(samp_count + 1),
-            If(samp_carry,
-                scl_i.eq(scl_raw),
-                sda_i.eq(sda_raw)
-            )
+        hs_mode = Signal()
+        samp_count = Signal(8)
+        samp_ce = Signal()
+        n_csr = Signal(bits_for(filter_depth))
+        n = Signal(bits_for(filter_depth))
+        self.comb += [
+            samp_ce.eq(samp_count == 0),
+            n_csr.eq(Mux(hs_mode, hs_filter_len.storage, filter_len.storage)),
+            # 0 would never see the lines change, and past filter_depth
+            # there is no mask
+            n.eq(Mux(n_csr == 0, 1,
+                     Mux(n_csr > filter_depth, filter_depth, n_csr))),
+            hs_active.status.eq(hs_mode),
         ]
+        self.sync += If(samp_ce,
+            samp_count.eq(Mux(hs_mode, hs_sample_div.storage, sample_div.storage))
+        ).Else(
+            samp_count.eq(samp_count - 1)
+        )
+        self.submodules.scl_filter = _GlitchFilter(scl_raw, samp_ce, n,
+                                                   filter_majority.storage,
+                                                   filter_depth)
+        self.submodules.sda_filter = _GlitchFilter(sda_raw, samp_ce, n,
+                                                   filter_majority.storage,
+                                                   filter_depth)
+        scl_i = self.scl_filter.o
+        self.comb += sda_i.eq(self.sda_filter.o)
 
-        scl_r = Signal()
-        sda_r = Signal()
+        scl_r = Signal(reset=1)
+        sda_r = Signal(reset=1)
         scl_rising = Signal()
         scl_falling = Signal()
         sda_rising = Signal()
@@ -86,10 +595,7 @@ class I2CShiftReg(Module, AutoCSR):
             sda_r.eq(sda_i)
         ]
         self.comb += [
-            debug_ios[11].eq(status.storage[0]),
-            debug_ios[12].eq(status.storage[1]),
-            shift_reg_full.eq(status.storage[0]),
-            shift_reg_empty.eq(status.storage[1]),
+            debug_ios[11].eq(~rx_fifo.writable),
             scl_rising.eq(scl_i & ~scl_r),
             scl_falling.eq(~scl_i & scl_r),
             sda_rising.eq(sda_i & ~sda_r),
@@ -97,7 +603,13 @@ class I2CShiftReg(Module, AutoCSR):
         ]
 
         start = Signal()
-        self.comb += start.eq(scl_i & sda_falling)
+        stop = Signal()
+        self.comb += [
+            start.eq(scl_i & sda_falling),
+            stop.eq(scl_i & sda_rising),
+        ]
+        hs_code = Signal()
+        self.sync += If(hs_code, hs_mode.eq(1)).Elif(stop, hs_mode.eq(0))
 
         din = Signal(8)
         counter = Signal(max=9)
@@ -120,29 +632,301 @@ class I2CShiftReg(Module, AutoCSR):
         is_read = Signal()
         update_is_read = Signal()
         self.sync += If(update_is_read, is_read.eq(din[0]))
+
+        matches = []
+        for i in range(addresses):
+            m = _AddressMatch(din[1:],
+                              enable=int(i == 0 or i < len(reset_addrs)),
+                              addr=reset_addrs[i] if i < len(reset_addrs) else 0)
+            setattr(self.submodules, "match{}".format(i), m)
+            matches.append(m)
+        addr_hit = Signal()
+        hit_index = Signal(max=max(addresses, 2))
+        hit_mask = Signal(7)
+        match_mask = Signal(7)
+        self.comb += addr_hit.eq(reduce(or_, [m.hit for m in matches]))
+        # lowest index wins
+        for i, m in reversed(list(enumerate(matches))):
+            self.comb += If(m.hit, hit_index.eq(i), hit_mask.eq(m.mask.storage))
+        self.sync += If(update_is_read,
+            ctx.eq(hit_index),
+            match_addr.status.eq(din[1:]),
+            match_mask.eq(hit_mask),
+        )
+        tx_ready = Signal()
+        if addresses > 1:
+            self.comb += tx_ready.eq(self.tx_context.storage == ctx)
+        else:
+            self.comb += tx_ready.eq(1)
+
+        eeprom_en = Signal()
+        eeprom_byte = Signal(8)
+        eeprom_next = Signal()
+        eeprom_write = Signal()
+        if eeprom_size:
+            # bit 0: enable, bit 1: 2-byte word addresses
+            ctrl_reset = 0 if eeprom_init is None else 3
+            self.eeprom_ctrl = eeprom_ctrl = CSRStorage(2, reset=ctrl_reset)
+            self.eeprom_ptr = eeprom_ptr = CSRStatus(16)
+            self.busy = busy = CSRStatus()
+            self.bus = wishbone.Interface()
+            self.sync += If(start, busy.status.eq(1)).Elif(stop, busy.status.eq(0))
+            ctrl = Signal(2, reset=ctrl_reset)
+            self.sync += If(~busy.status | stop, ctrl.eq(eeprom_ctrl.storage))
+
+            init = None
+            if eeprom_init is not None:
+                bank = eeprom_size//addresses
+                init = b"".join(bytes(image[:bank]).ljust(bank, b"\xff")
+                                for image in eeprom_init)
+                init = init.ljust(eeprom_size, b"\xff")
+                # in the words as byte_sel picks them
+                init = [int.from_bytes(init[i:i + 4], "big")
+                        for i in range(0, eeprom_size, 4)]
+            mem = Memory(32, eeprom_size//4, init=init)
+            self.submodules.eeprom_sram = wishbone.SRAM(mem, bus=self.bus)
+            port = mem.get_port(write_capable=True, we_granularity=8)
+            self.specials += port
+
+            # one bank and address pointer per table entry
+            ptrs = Array(Signal(log2_int(eeprom_size//addresses))
+                         for i in range(addresses))
+            ptr = Signal(log2_int(eeprom_size//addresses))
+            ptr_next = Signal(len(ptr))
+            ptr_we = Signal()
+            wide = Signal()
+            addr_bytes = Signal(2)  # word address bytes received so far
+            addr_done = Signal()
+            # The LM32 is big endian, byte 0 of a word is its MSB
+            byte_sel = Signal(2)
+            self.comb += [
+                eeprom_en.eq(ctrl[0]),
+                wide.eq(ctrl[1]),
+                ptr.eq(ptrs[ctx]),
+                eeprom_ptr.status.eq(ptr),
+                addr_done.eq(addr_bytes == Mux(wide, 2, 1)),
+                byte_sel.eq(~ptr[:2]),
+                port.adr.eq(Cat(ptr[2:], ctx) if ctx_bits else ptr[2:]),
+                port.dat_w.eq(Replicate(din, 4)),
+                chooser(port.dat_r, byte_sel, eeprom_byte),
+                If(eeprom_write & addr_done,
+                    port.we.eq(Cat(*[byte_sel == i for i in range(4)]))
+                ),
+                If(eeprom_next | (eeprom_write & addr_done),
+                    ptr_we.eq(1),
+                    ptr_next.eq(ptr + 1)
+                ).Elif(eeprom_write,
+                    ptr_we.eq(1),
+                    If(wide & (addr_bytes == 0),
+                        ptr_next.eq(Cat(ptr[:8], din))
+                    ).Elif(wide,
+                        ptr_next.eq(Cat(din, ptr[8:]))
+                    ).Else(
+                        ptr_next.eq(Cat(din, match_addr.status & match_mask))
+                    )
+                )
+            ]
+            self.sync += [
+                If(update_is_read, addr_bytes.eq(0)),
+                If(eeprom_write & ~addr_done, addr_bytes.eq(addr_bytes + 1)),
+                If(ptr_we, ptrs[ctx].eq(ptr_next)),
+            ]
+
+        if dma:
+            self.dma_base = dma_base = CSRStorage(32)
+            self.dma_length = dma_length = CSRStorage(16)
+            self.dma_mode = dma_mode = CSRStorage(1)
+            self.dma_start = dma_start = CSR()
+            self.dma_remaining = dma_remaining = CSRStatus(16)
+            self.dma_bus = dma_bus = wishbone.Interface()
+
+            dma_adr = Signal(32)
+            dma_count = Signal(16)
+            dma_to_rx = Signal()
+            dma_cancel = Signal()
+            dma_byte = Signal(8)
+            dma_data = Signal(8)  # read from memory, for the TX FIFO
+            dma_sel = Signal(2)
+            # One bus cycle per byte, that is plenty at I2C speeds
+            self.comb += [
+                dma_remaining.status.eq(dma_count),
+                dma_sel.eq(~dma_adr[:2]),
+                dma_bus.adr.eq(dma_adr[2:]),
+                dma_bus.dat_w.eq(Replicate(rx_fifo.dout[:8], 4)),
+                dma_bus.sel.eq(Cat(*[dma_sel == i for i in range(4)])),
+                dma_bus.we.eq(dma_to_rx),
+                chooser(dma_bus.dat_r, dma_sel, dma_byte),
+            ]
+            dma_pending = Signal()
+            dma_load = Signal()
+            self.sync += [
+                If(dma_start.re,
+                    dma_pending.eq(1)
+                ).Elif(dma_load,
+                    dma_pending.eq(0)
+                ),
+                If(dma_load,
+                    dma_cancel.eq(0),
+                    dma_to_rx.eq(dma_mode.storage),
+                ).Elif(tx_flush.re & ~dma_to_rx,
+                    dma_cancel.eq(1)
+                ),
+            ]
+
+            self.submodules.dma_fsm = dma_fsm = FSM()
+            dma_fsm.act("IDLE",
+                If(dma_pending,
+                    dma_load.eq(1),
+                    NextValue(dma_adr, dma_base.storage),
+                    NextValue(dma_count, dma_length.storage),
+                    NextState("NEXT"),
+                )
+            )
+            dma_fsm.act("NEXT",
+                If(dma_cancel,
+                    NextState("IDLE"),
+                ).Elif(dma_count == 0,
+                    self.ev.dma.trigger.eq(1),
+                    NextState("IDLE"),
+                ).Elif(Mux(dma_to_rx, rx_fifo.readable, tx_fifo.writable),
+                    NextState("BUS"),
+                )
+            )
+            # A cycle that was started still completes on cancel, its
+            # byte is dropped
+            dma_fsm.act("BUS",
+                dma_bus.cyc.eq(1),
+                dma_bus.stb.eq(1),
+                If(dma_bus.ack,
+                    NextValue(dma_adr, dma_adr + 1),
+                    If(dma_to_rx,
+                        rx_fifo.re.eq(1),
+                        NextValue(dma_count, dma_count - 1),
+                        NextState("NEXT"),
+                    ).Else(
+                        NextValue(dma_data, dma_byte),
+                        NextState("PUSH"),
+                    )
+                )
+            )
+            # The CPU may write tx_data meanwhile, the byte waits for a
+            # cycle the TX FIFO is free and has room
+            dma_fsm.act("PUSH",
+                If(dma_cancel | tx_flush.re,
+                    NextState("NEXT"),
+                ).Elif(~tx_data.re & tx_fifo.writable,
+                    tx_fifo.din.eq(dma_data),
+                    tx_fifo.we.eq(1),
+                    NextValue(dma_count, dma_count - 1),
+                    NextState("NEXT"),
+                )
+            )
+
         data_bit = Signal()
 
         zero_drv = Signal()
         data_drv = Signal()
         pause_drv = Signal()
-        self.comb += scl_drv.eq(pause_drv)
+        waiting = Signal()  # PAUSE held on the CPU
+        setup_drv = Signal()
+        self.comb += scl_drv.eq(pause_drv | setup_drv)
+        self.comb += [
+            self.ev.rx.trigger.eq(rx_fifo.readable &
+                                  ((rx_fifo.level >= rx_threshold.storage) | pause_drv)),
+            self.ev.tx.trigger.eq(tx_level.status <= tx_threshold.storage),
+            self.ev.addr.trigger.eq(update_is_read),
+            self.ev.start.trigger.eq(start),
+            self.ev.stop.trigger.eq(stop),
+        ]
         self.comb += If(zero_drv, sda_drv.eq(1)).Elif(data_drv,
                                                       sda_drv.eq(~data_bit))
 
+        tx_byte = Signal(8)
+        tx_shadow = Signal(8)
+        tx_shadow_valid = Signal()
+        tx_loaded = Signal()  # tx_byte holds the next byte to send
+        tx_shifting = Signal()
+        tx_prefetch = Signal()
+        tx_send = Signal()
+        self.comb += [
+            tx_fifo.re.eq(~tx_shadow_valid & tx_fifo.readable),
+            tx_prefetch.eq(~tx_loaded & tx_shadow_valid & ~tx_shifting &
+                           ~eeprom_en & ~tx_flush.re),
+            # The byte being shifted out holds its stage until the next
+            # one moves in, and the shadow register is taken as soon as
+            # the FIFO pops into it, so a write never finds the FIFO full
+            tx_level.status.eq(tx_fifo.level +
+                               (tx_shadow_valid | tx_fifo.re) +
+                               (tx_loaded | tx_shifting | tx_prefetch)),
+            debug_ios[12].eq(~tx_loaded),
+        ]
+        self.sync += [
+            If(tx_flush.re,
+                tx_shadow_valid.eq(0)
+            ).Elif(tx_fifo.re,
+                tx_shadow.eq(tx_fifo.dout),
+                tx_shadow_valid.eq(1)
+            ).Elif(tx_prefetch,
+                tx_shadow_valid.eq(0)
+            ),
+            If(tx_flush.re,
+                tx_loaded.eq(0)
+            ).Elif(tx_prefetch,
+                tx_byte.eq(tx_shadow),
+                tx_loaded.eq(1)
+            ).Elif(tx_send,
+                tx_loaded.eq(0)
+            ),
+            If(eeprom_next, tx_byte.eq(eeprom_byte)),
+        ]
+
         data_drv_en = Signal()
         data_drv_stop = Signal()
         self.sync += If(data_drv_en, data_drv.eq(1)).Elif(data_drv_stop,
                                                           data_drv.eq(0))
-        self.sync += If(data_drv_en, chooser(shift_reg.storage,
+        self.sync += If(data_drv_en, chooser(tx_byte,
                                              counter, data_bit, 8,
                                              reverse=True))
+        # The master may have released SCL already when a read leaves
+        # PAUSE: keep it low until the filtered SDA shows the first bit,
+        # or both would seem to change together, like a START. Give up
+        # after as many samples as the filter can take, on a bus error.
+        data_setup = Signal()
+        setup_count = Signal(max=filter_depth + 3)
+        self.sync += If(~data_drv,
+            data_setup.eq(0),
+            setup_count.eq(0)
+        ).Elif(samp_ce & ~data_setup,
+            If((sda_i == data_bit) | (setup_count == filter_depth + 2),
+                data_setup.eq(1)
+            ).Else(
+                setup_count.eq(setup_count + 1)
+            )
+        )
+        byte_read = Signal()
+        byte_written = Signal()
+        nack = Signal()
+        if perf:
+            self.submodules.perf = _PerfCounters(start, stop, update_is_read,
+                                                 nack, byte_read,
+                                                 byte_written, waiting)
+        if txn_depth:
+            self.submodules.txn = _TransactionQueue(
+                update_is_read, din[1:], din[0], hit_index,
+                byte_read | byte_written, start, stop, nack, txn_depth)
+            self.comb += self.ev.txn.trigger.eq(self.txn.trigger)
+
         self.submodules.fsm = fsm = FSM()
 
         fsm.act("WAIT_START")
         fsm.act("RCV_ADDRESS",
             debug_ios[0].eq(1),
             If(counter == 8,
-                If(din[1:] == slave_addr.storage,
+                # 00001xxx is an Hs-mode master code, that nobody ACKs
+                If(din[3:] == 0b00001,
+                    hs_code.eq(1),
+                    NextState("WAIT_START"),
+                ).Elif(addr_hit,
                     update_is_read.eq(1),
                     NextState("ACK_ADDRESS0"),
                 ).Else(
@@ -173,20 +957,30 @@ class I2CShiftReg(Module, AutoCSR):
             debug_ios[4].eq(1),
             counter_reset.eq(1),
             pause_drv.eq(1),
-            If(~shift_reg_empty & is_read,
-               counter_reset.eq(1),
-               NextState("DO_READ"),
-            ).Elif(~shift_reg_full & ~is_read,
-               NextState("DO_WRITE"),
+            waiting.eq(1),
+            If(is_read,
+                If(eeprom_en,
+                    eeprom_next.eq(1),
+                    waiting.eq(0),
+                    NextState("DO_READ"),
+                ).Elif(tx_loaded & ~rx_fifo.readable & tx_ready,
+                    tx_send.eq(1),
+                    waiting.eq(0),
+                    NextState("DO_READ"),
+                )
+            ).Elif(eeprom_en | rx_fifo.writable,
+                waiting.eq(0),
+                NextState("DO_WRITE"),
             )
         )
         fsm.act("DO_READ",
             debug_ios[5].eq(1),
+            tx_shifting.eq(1),
+            setup_drv.eq(~data_setup),
             If(~scl_i,
                 If(counter == 8,
                    data_drv_stop.eq(1),
-                   status.we.eq(1),
-                   status.dat_w.eq(STATUS_EMPTY),
+                   byte_read.eq(1),
                    NextState("ACK_READ0"),
                 ).Else(
                     data_drv_en.eq(1),
@@ -198,6 +992,7 @@ class I2CShiftReg(Module, AutoCSR):
             counter_reset.eq(1),
             If(scl_rising,
                If(sda_i,
+                  nack.eq(1),
                   NextState("WAIT_START"),
                ).Else(
                   NextState("ACK_READ1"),
@@ -213,8 +1008,13 @@ class I2CShiftReg(Module, AutoCSR):
         fsm.act("DO_WRITE",
             debug_ios[7].eq(1),
             If(counter == 8,
-                shift_reg.dat_w.eq(din),
-                shift_reg.we.eq(1),
+                byte_written.eq(1),
+                If(eeprom_en,
+                    eeprom_write.eq(1),
+                ).Else(
+                    rx_fifo.din.eq(Cat(din, ctx)),
+                    rx_fifo.we.eq(1),
+                ),
                 NextState("ACK_WRITE0"),
             )
         )
@@ -235,14 +1035,175 @@ class I2CShiftReg(Module, AutoCSR):
             zero_drv.eq(1),
             If(~scl_i,
                 NextState("PAUSE"),
-                status.we.eq(1),
-                status.dat_w.eq(STATUS_FULL),
             )
         )
 
         for state in fsm.actions.keys():
             fsm.act(state, If(start, NextState("RCV_ADDRESS")))
 
+        if trace_depth:
+            # trace2vcd.py decodes the entries, its states and fields are
+            # the ones sampled here
+            self.trace_states = trace2vcd.STATES
+            assert sorted(fsm.actions) == sorted(self.trace_states)
+            fields = dict(trace2vcd.FIELDS)
+            state = Signal(fields["state"])
+            for i, name in enumerate(self.trace_states):
+                self.comb += If(fsm.ongoing(name), state.eq(i))
+            levels = {}
+            for name, level in (("rx_level", rx_fifo.level),
+                                ("tx_level", tx_level.status)):
+                top = 2**fields[name] - 1
+                levels[name] = Signal(fields[name])
+                self.comb += levels[name].eq(Mux(level >= top, top, level))
+            sample = dict(scl=scl_i, sda=sda_i, scl_drv=scl_drv,
+                          sda_drv=sda_drv, state=state, **levels)
+            assert all(len(sample[name]) == width
+                       for name, width in trace2vcd.FIELDS)
+            self.submodules.trace = _TraceBuffer(
+                Cat(*[sample[name] for name, width in trace2vcd.FIELDS]),
+                [start, update_is_read, nack], waiting, trace_depth)
+
+
+class I2CEngineCore(Module, AutoCSR):
+    """I2C slave built from the I2CEngine parts, with the CSR interface of
+    I2CShiftReg, so the firmware drives either the same way.
+
+    Bytes move between the engine and the TX/RX FIFOs directly, without
+    the shadow and shift register stages, so tx_depth = fifo_depth. SCL is
+    stretched while a read waits on the TX FIFO (or, like I2CShiftReg, on
+    the RX FIFO to drain and on tx_context) and while a write waits on a
+    full RX FIFO. The address table, match_addr, match_index, rx_index,
+    tx_context, the thresholds, the events, the transaction queue of
+    txn_depth and reset_addrs work as in I2CShiftReg.
+
+    The sampling divider, glitch filter, Hs-mode, EEPROM, DMA, perf and
+    trace options of I2CShiftReg are not available, SCL and SDA go to the
+    parts through synchronizers only. Pass pads=None to drive
+    _scl_i_async/_sda_i_async and watch scl_oe/sda_oe directly, e.g. in
+    simulation.
+    """
+    def __init__(self, pads, fifo_depth=16, addresses=1, txn_depth=0,
+                 reset_addrs=()):
+        ctx = Signal(max=max(addresses, 2))  # table entry that matched last
+        ctx_bits = len(ctx) if addresses > 1 else 0
+
+        self.submodules.tx_fifo = tx_fifo = ResetInserter()(SyncFIFO(8, fifo_depth))
+        self.submodules.rx_fifo = rx_fifo = SyncFIFO(8 + ctx_bits, fifo_depth)
+
+        self.tx_data = tx_data = CSR(8)
+        self.tx_depth = fifo_depth
+        self.tx_level = tx_level = CSRStatus(bits_for(self.tx_depth))
+        self.tx_flush = tx_flush = CSR()
+        self.rx_data = rx_data = CSR(8)
+        self.rx_level = rx_level = CSRStatus(bits_for(fifo_depth))
+        self.rx_threshold = rx_threshold = CSRStorage(bits_for(fifo_depth), reset=1)
+        self.tx_threshold = tx_threshold = CSRStorage(bits_for(fifo_depth), reset=fifo_depth//2)
+        self.match_addr = match_addr = CSRStatus(7)
+        if addresses > 1:
+            self.match_index = CSRStatus(len(ctx))
+            self.rx_index = CSRStatus(len(ctx))
+            self.tx_context = CSRStorage(len(ctx))
+            self.comb += [
+                self.match_index.status.eq(ctx),
+                self.rx_index.status.eq(rx_fifo.dout[8:]),
+            ]
+        self.pads = pads
+
+        self.submodules.engine = engine = I2CEngine(address=None)
+
+        self.submodules.ev = EventManager()
+        self.ev.rx = EventSourceLevel()
+        self.ev.tx = EventSourceLevel()
+        self.ev.addr = EventSourcePulse()
+        self.ev.start = EventSourcePulse()
+        self.ev.stop = EventSourcePulse()
+        if txn_depth:
+            self.ev.txn = EventSourceLevel()
+        self.ev.finalize()
+
+        self.comb += [
+            tx_fifo.din.eq(tx_data.r),
+            tx_fifo.we.eq(tx_data.re),
+            tx_fifo.reset.eq(tx_flush.re),
+            tx_level.status.eq(tx_fifo.level),
+            rx_data.w.eq(rx_fifo.dout[:8]),
+            rx_fifo.re.eq(rx_data.re),
+            rx_level.status.eq(rx_fifo.level),
+        ]
+
+        ###
+
+        self._sda_i_async = _sda_i_async = Signal()
+        self._scl_i_async = _scl_i_async = Signal()
+        self.sda_oe = _sda_drv_reg = Signal()
+        self.scl_oe = _scl_drv_reg = Signal()
+        self.sync += [
+            _sda_drv_reg.eq(engine.sda_oe),
+            _scl_drv_reg.eq(engine.scl_oe),
+        ]
+        if pads is not None:
+            self.specials += [
+                Tristate(pads.sda, 0, _sda_drv_reg, _sda_i_async),
+                Tristate(pads.scl, 0, _scl_drv_reg, _scl_i_async),
+            ]
+        self.specials += [
+            MultiReg(_scl_i_async, engine.scl_r, reset=1),
+            MultiReg(_sda_i_async, engine.sda_r, reset=1),
+        ]
+
+        matches = []
+        for i in range(addresses):
+            m = _AddressMatch(engine.addr,
+                              enable=int(i == 0 or i < len(reset_addrs)),
+                              addr=reset_addrs[i] if i < len(reset_addrs) else 0)
+            setattr(self.submodules, "match{}".format(i), m)
+            matches.append(m)
+        hit_index = Signal(max=max(addresses, 2))
+        # The address is in the shifter some cycles before the ACK, there is
+        # time for a register after the table
+        self.sync += engine.addr_hit.eq(reduce(or_, [m.hit for m in matches]))
+        # lowest index wins
+        for i, m in reversed(list(enumerate(matches))):
+            self.sync += If(m.hit, hit_index.eq(i))
+        self.sync += If(engine.matched,
+            ctx.eq(hit_index),
+            match_addr.status.eq(engine.addr),
+        )
+        tx_ready = Signal()
+        if addresses > 1:
+            self.comb += tx_ready.eq(self.tx_context.storage == ctx)
+        else:
+            self.comb += tx_ready.eq(1)
+
+        self.comb += [
+            engine.tx_byte.eq(tx_fifo.dout),
+            engine.tx_readable.eq(tx_fifo.readable & ~tx_flush.re),
+            tx_fifo.re.eq(engine.tx_re),
+            # the CPU sees a written word address before the read it
+            # applies to is served
+            engine.read_ready.eq(~rx_fifo.readable & tx_ready),
+
+            rx_fifo.din.eq(Cat(engine.rx_byte, ctx)),
+            rx_fifo.we.eq(engine.rx_we),
+            engine.rx_writable.eq(rx_fifo.writable),
+
+            self.ev.rx.trigger.eq(rx_fifo.readable &
+                                  ((rx_fifo.level >= rx_threshold.storage) |
+                                   engine.waiting)),
+            self.ev.tx.trigger.eq(tx_level.status <= tx_threshold.storage),
+            self.ev.addr.trigger.eq(engine.matched),
+            self.ev.start.trigger.eq(engine.start.detected),
+            self.ev.stop.trigger.eq(engine.stop.detected),
+        ]
+
+        if txn_depth:
+            self.submodules.txn = _TransactionQueue(
+                engine.matched, engine.addr, engine.data.din[0], hit_index,
+                engine.byte_read | engine.rx_we, engine.start.detected,
+                engine.stop.detected, engine.nack, txn_depth)
+            self.comb += self.ev.txn.trigger.eq(self.txn.trigger)
+
 
 class _CRG(Module):
     def __init__(self, platform, clk_freq):
@@ -369,18 +1330,117 @@ papilio_adapter_io = [
 
 class I2CSoC(BaseSoC):
 
+    # One entry per I2C bus of the platform. The cores are named i2c0,
+    # i2c1, ... in the order of i2c_buses, whichever bus they are on.
     csr_map = {
-        "i2c": 17,
+        "i2c0": 17,
+        "i2c1": 18,
     }
     csr_map.update(BaseSoC.csr_map)
 
-    def __init__(self, **kwargs):
+    interrupt_map = {
+        "i2c0": 2,
+        "i2c1": 3,
+    }
+    interrupt_map.update(BaseSoC.interrupt_map)
+
+    mem_map = {
+        "i2c0_eeprom": 0x30000000,
+        "i2c1_eeprom": 0x31000000,
+        "i2c0_trace": 0x32000000,
+        "i2c1_trace": 0x33000000,
+    }
+    mem_map.update(BaseSoC.mem_map)
+
+    def __init__(self, i2c_buses=("i2c",), i2c_fifo_depth=16,
+                 i2c_eeprom_size=0, i2c_dma=False, i2c_addresses=1,
+                 i2c_perf=False, i2c_trace_depth=0, i2c_debug_ios=False,
+                 i2c_core="shiftreg", i2c_txn_depth=16, i2c_image_flash=None,
+                 i2c_eeprom_init=None, i2c_reset_addrs=(), **kwargs):
+        if i2c_core == "engine":
+            unsupported = [name for name, value in [
+                ("i2c_eeprom_size", i2c_eeprom_size),
+                ("i2c_eeprom_init", i2c_eeprom_init),
+                ("i2c_dma", i2c_dma),
+                ("i2c_perf", i2c_perf),
+                ("i2c_trace_depth", i2c_trace_depth),
+                ("i2c_debug_ios", i2c_debug_ios)] if value]
+            if unsupported:
+                raise ValueError("the engine I2C core has no {}".format(
+                    ", ".join(unsupported)))
+        elif i2c_core != "shiftreg":
+            raise ValueError("unknown I2C core {}".format(i2c_core))
+        if i2c_eeprom_init is not None:
+            if not i2c_eeprom_size:
+                raise ValueError("the EEPROM image needs i2c_eeprom_size")
+            if not i2c_reset_addrs:
+                raise ValueError("the EEPROM image needs a reset slave"
+                                 " address to be served before the CPU runs")
+        if not i2c_buses or len(set(i2c_buses)) != len(i2c_buses):
+            raise ValueError("the I2C buses must be given once each")
+        if len(i2c_reset_addrs) > i2c_addresses:
+            raise ValueError("more reset addresses than table entries")
         BaseSoC.__init__(self, platform=pipistrello_i2c.Platform(), **kwargs)
+        if i2c_image_flash is not None:
+            # the firmware serves the images from this flash offset on
+            if self.integrated_rom_size:
+                raise ValueError("the image partition needs the SPI flash")
+            if (i2c_image_flash <= self.flash_boot_address or
+                    i2c_image_flash % self.config["SPIFLASH_SECTOR_SIZE"]):
+                raise ValueError("the image partition must be in a flash"
+                                 " sector of its own past the runtime")
+            self.config["I2C_IMAGE_FLASH_OFFSET"] = i2c_image_flash
 
         platform = self.platform
-        platform.add_extension(papilio_adapter_io)
-        debug_ios = platform.request("debug_ios")
-        self.submodules.i2c = I2CShiftReg(platform.request("i2c"), debug_ios)
+        debug_ios = None
+        if i2c_debug_ios:
+            platform.add_extension(papilio_adapter_io)
+            debug_ios = platform.request("debug_ios")
+        for i, bus in enumerate(i2c_buses):
+            # all cores are built the same, so the firmware can address
+            # their registers relative to CSR_I2C0_BASE
+            name = "i2c{}".format(i)
+            if i2c_core == "engine":
+                core = I2CEngineCore(platform.request(bus),
+                                     fifo_depth=i2c_fifo_depth,
+                                     addresses=i2c_addresses,
+                                     txn_depth=i2c_txn_depth,
+                                     reset_addrs=i2c_reset_addrs)
+            else:
+                core = I2CShiftReg(platform.request(bus),
+                                   debug_ios if i == 0 else None,
+                                   fifo_depth=i2c_fifo_depth,
+                                   eeprom_size=i2c_eeprom_size,
+                                   dma=i2c_dma,
+                                   addresses=i2c_addresses,
+                                   perf=i2c_perf,
+                                   trace_depth=i2c_trace_depth,
+                                   txn_depth=i2c_txn_depth,
+                                   eeprom_init=i2c_eeprom_init,
+                                   reset_addrs=i2c_reset_addrs)
+            setattr(self.submodules, name, core)
+            if i2c_dma:
+                self.add_wb_master(core.dma_bus)
+            if i2c_eeprom_size:
+                self.register_mem(name + "_eeprom",
+                                  self.mem_map[name + "_eeprom"],
+                                  core.bus, i2c_eeprom_size)
+            if i2c_trace_depth:
+                self.register_mem(name + "_trace",
+                                  self.mem_map[name + "_trace"],
+                                  core.trace.bus, 4*i2c_trace_depth)
+        self.config["I2C_FIFO_DEPTH"] = i2c_fifo_depth
+        self.config["I2C_TX_DEPTH"] = core.tx_depth
+        self.config["I2C_ADDRESSES"] = i2c_addresses
+        if i2c_txn_depth:
+            self.config["I2C_TXN_DEPTH"] = i2c_txn_depth
+        if i2c_reset_addrs:
+            # the firmware leaves these table entries as they are
+            self.config["I2C_RESET_ADDRS"] = len(i2c_reset_addrs)
+        if i2c_perf:
+            self.config["I2C_PERF_HIST_BINS"] = core.perf.hist_bins
+        if i2c_trace_depth:
+            self.config["I2C_TRACE_DEPTH"] = i2c_trace_depth
 
 
 soc_pipistrello_args = soc_sdram_args
@@ -391,9 +1451,80 @@ def main():
     parser = argparse.ArgumentParser(description="MiSoC port to the Pipistrello with I2C pins")
     builder_args(parser)
     soc_pipistrello_args(parser)
+    parser.add_argument("--i2c-bus", action="append",
+                        choices=["i2c", "i2c2"],
+                        help="I2C bus to put a slave core on, repeat for"
+                             " several. The cores are numbered in that"
+                             " order. Default: i2c")
+    parser.add_argument("--i2c-fifo-depth", default=16, type=int,
+                        help="depth of the I2C TX and RX FIFOs. Default: 16")
+    parser.add_argument("--i2c-eeprom-size", default=0, type=int,
+                        help="size in bytes of the memory for gateware EEPROM"
+                             " emulation, 0 to disable. Default: 0")
+    parser.add_argument("--i2c-dma", action="store_true",
+                        help="let the I2C core move bytes between its FIFOs"
+                             " and memory as a Wishbone master")
+    parser.add_argument("--i2c-addresses", default=1, type=int,
+                        help="number of entries in the I2C slave address"
+                             " table. Default: 1")
+    parser.add_argument("--i2c-perf", action="store_true",
+                        help="add performance counters to the I2C cores")
+    parser.add_argument("--i2c-trace-depth", default=0, type=int,
+                        help="entries of the on-chip I2C logic analyzer, a"
+                             " power of 2, 0 to disable. Default: 0")
+    parser.add_argument("--i2c-debug-ios", action="store_true",
+                        help="drive the I2C core state onto the pins of the"
+                             " Papilio adapter")
+    parser.add_argument("--i2c-core", default="shiftreg",
+                        choices=["shiftreg", "engine"],
+                        help="I2C slave core: I2CShiftReg, or I2CEngineCore"
+                             " built from the i2c_engine modules, which has"
+                             " none of the EEPROM, DMA, perf, trace and debug"
+                             " IO options. Default: shiftreg")
+    parser.add_argument("--i2c-txn-depth", default=16, type=int,
+                        help="descriptors the I2C cores queue for the"
+                             " firmware to handle whole transactions, 0 to"
+                             " disable. Default: 16")
+    parser.add_argument("--i2c-image-flash", default=None,
+                        type=lambda s: int(s, 0),
+                        help="serve the images from the partition written"
+                             " by tools/mkimage.py at this flash offset,"
+                             " e.g. 0x200000, instead of building them into"
+                             " the firmware")
+    parser.add_argument("--i2c-eeprom-init", action="append",
+                        help="raw image to put in the gateware EEPROM memory"
+                             " in the bitstream, for it to be served from"
+                             " configuration on, repeat for each slave"
+                             " address table entry in order. Needs"
+                             " --i2c-eeprom-size and --i2c-reset-addr")
+    parser.add_argument("--i2c-reset-addr", action="append", default=[],
+                        type=lambda s: int(s, 0),
+                        help="slave address the I2C cores answer to from"
+                             " reset on, repeat for each table entry in"
+                             " order, e.g. 0x40 then 0x51")
     args = parser.parse_args()
 
-    soc = I2CSoC(**soc_pipistrello_argdict(args))
+    eeprom_init = None
+    if args.i2c_eeprom_init:
+        eeprom_init = []
+        for filename in args.i2c_eeprom_init:
+            with open(filename, "rb") as f:
+                eeprom_init.append(f.read())
+
+    soc = I2CSoC(i2c_buses=args.i2c_bus or ["i2c"],
+                 i2c_fifo_depth=args.i2c_fifo_depth,
+                 i2c_eeprom_size=args.i2c_eeprom_size,
+                 i2c_dma=args.i2c_dma,
+                 i2c_addresses=args.i2c_addresses,
+                 i2c_perf=args.i2c_perf,
+                 i2c_trace_depth=args.i2c_trace_depth,
+                 i2c_debug_ios=args.i2c_debug_ios,
+                 i2c_core=args.i2c_core,
+                 i2c_txn_depth=args.i2c_txn_depth,
+                 i2c_image_flash=args.i2c_image_flash,
+                 i2c_eeprom_init=eeprom_init,
+                 i2c_reset_addrs=args.i2c_reset_addr,
+                 **soc_pipistrello_argdict(args))
     builder = Builder(soc, **builder_argdict(args))
     builder.add_software_package("software", os.path.join(i2cslave_dir,
                                                          "..", "software"))
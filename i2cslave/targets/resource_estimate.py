@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""Vendor-free resource and logic depth estimates for the Migen modules.
+
+The finalized fragment of a module is lowered like for Verilog output and
+mapped, bit by bit, onto LUTs with lut_inputs inputs (6 on the Spartan-6):
+the logic between registers, memory ports, pads and outputs is packed
+greedily into LUTs as long as their inputs fit, and carry chains (adders,
+counters, magnitude comparisons) cost no LUT level past their first one.
+This is no place and route, the numbers are for comparing cores and
+following a core from commit to commit, like the LUT levels the all-state
+If(start, ...) overrides of an FSM add.
+
+    $ python -m i2cslave.targets.resource_estimate
+    $ python -m i2cslave.targets.resource_estimate I2CShiftReg:addresses=4 \
+        I2CEngineCore:addresses=4 I2CStateMachine --json estimate.json
+"""
+
+import argparse
+import ast
+import inspect
+import json
+import os
+import subprocess
+import sys
+
+from migen import *
+from migen.fhdl.bitcontainer import value_bits_sign
+from migen.fhdl.namer import build_namespace
+from migen.fhdl.specials import Memory, SPECIAL_INPUT
+from migen.fhdl.structure import _Assign, _Operator, _Part, _Slice
+from migen.fhdl.tools import (group_by_targets, list_clock_domains,
+                              list_signals, list_targets, lower_basics,
+                              lower_complex_slices, lower_specials)
+from migen.genlib.fsm import FSM
+
+from . import i2c_engine, pipistrello_i2c
+from .vcd_helpers import find_signals
+
+# Modules estimated by default
+DEFAULT_MODULES = ["I2CShiftReg", "I2CEngineCore", "I2CEngine"]
+# Where the modules given by name are looked up
+SEARCH = [pipistrello_i2c, i2c_engine]
+
+
+class _Node:
+    """One bit of logic: a LUT function of the bits in cut, a dict of
+    bit id -> LUT level. wire is set for bits that are just another bit,
+    const for constant ones."""
+    __slots__ = ("cut", "wire", "const", "lut")
+
+    def __init__(self, cut, wire=None, const=False):
+        self.cut = cut
+        self.wire = wire
+        self.const = const
+        self.lut = None  # bit id once it is a LUT output of its own
+
+    @property
+    def level(self):
+        if self.wire is not None:
+            return self.cut[self.wire]
+        return max(self.cut.values()) + 1 if self.cut else 0
+
+
+_CONST = _Node({}, const=True)
+
+
+class _Mapper:
+    def __init__(self, fragment, lut_inputs):
+        self.k = lut_inputs
+        self.luts = 0
+        self.carry_bits = 0
+        self.levels = {}  # bit id -> level
+        self.next_id = 0
+        self.read = set()  # (signal, bit) used by the logic
+
+        # comb statements, grouped like in separate always blocks
+        self.groups = group_by_targets(fragment.comb)
+        self.comb_groups = {}  # signal -> index in groups
+        for i, (targets, statements) in enumerate(self.groups):
+            for target in targets:
+                self.comb_groups[target] = i
+        self.comb_done = {}  # index in groups -> bit nodes
+        self.comb_running = {}
+        self.leaves = {}
+
+    # bits
+
+    def _new_id(self, level):
+        self.next_id += 1
+        self.levels[self.next_id] = level
+        return self.next_id
+
+    def _wire(self, bit_id, level):
+        return _Node({bit_id: level}, wire=bit_id)
+
+    def materialize(self, node):
+        """The id of the bit node computes, as a LUT output if needed."""
+        if node.wire is not None:
+            return node.wire
+        if node.lut is None:
+            node.lut = self._new_id(node.level)
+            self.luts += 1
+        return node.lut
+
+    def combine(self, nodes):
+        """A function of the bits of nodes, packed into as few LUT levels
+        as the greedy packing finds."""
+        nodes = [n for n in nodes if not n.const]
+        if not nodes:
+            return _CONST
+        parts = [n.cut for n in nodes]
+        cut = self._union(parts)
+        if len(cut) <= self.k:
+            return _Node(cut)
+        # make the inputs with the widest cuts LUT outputs of their own,
+        # where that leaves fewer bits to go on
+        for i in sorted(range(len(nodes)), key=lambda i: len(parts[i]),
+                        reverse=True):
+            if len(parts[i]) < 2:
+                break
+            others = self._union(parts[:i] + parts[i + 1:])
+            if len(others) + 1 >= len(cut):
+                continue
+            bit_id = self.materialize(nodes[i])
+            parts[i] = {bit_id: self.levels[bit_id]}
+            cut = self._union(parts)
+            if len(cut) <= self.k:
+                return _Node(cut)
+        return _Node(self._tree(cut))
+
+    def _union(self, parts):
+        cut = {}
+        for part in parts:
+            cut.update(part)
+        return cut
+
+    def _tree(self, cut):
+        """Reduces the bits of cut to lut_inputs with a tree of LUTs,
+        starting with the earliest ones."""
+        inputs = sorted(cut.items(), key=lambda item: item[1])
+        while len(inputs) > self.k:
+            lowest = inputs[0][1]
+            same = [item for item in inputs if item[1] == lowest]
+            if len(same) == 1:
+                # nothing to pair it with yet, it waits for the next ones
+                inputs[0] = (inputs[0][0], inputs[1][1])
+                continue
+            n = min(self.k, len(same), len(inputs) - self.k + 1)
+            self.luts += 1
+            bit_id = self._new_id(lowest + 1)
+            inputs = sorted(inputs[n:] + [(bit_id, lowest + 1)],
+                            key=lambda item: item[1])
+        return dict(inputs)
+
+    def carry_chain(self, a, b, n):
+        """n bits of a chain adding the bits of a and b, each bit behind
+        the LUT levels of all the bits below it."""
+        out = []
+        level = 0
+        for i in range(n):
+            if i < len(a):
+                bit = self.combine([a[i], b[i]])
+                if not bit.const:
+                    level = max(level, self.levels[self.materialize(bit)])
+            out.append(self._wire(self._new_id(level), level))
+            self.carry_bits += 1
+        return out
+
+    # signals
+
+    def leaf(self, signal, bit):
+        self.read.add((signal, bit))
+        if signal in self.comb_groups:
+            group = self.comb_groups[signal]
+            if group in self.comb_running:
+                return self.comb_running[group][(signal, bit)]
+            if group not in self.comb_done:
+                self.comb_done[group] = self.run_comb(group)
+            return self.comb_done[group][(signal, bit)]
+        if (signal, bit) not in self.leaves:
+            self.leaves[(signal, bit)] = self._wire(self._new_id(0), 0)
+        return self.leaves[(signal, bit)]
+
+    def run_comb(self, group):
+        targets, statements = self.groups[group]
+        env = {}
+        for signal in targets:
+            for bit in range(len(signal)):
+                env[(signal, bit)] = _CONST
+        self.comb_running[group] = env
+        self.execute(statements, env, env)
+        del self.comb_running[group]
+        return env
+
+    # expressions
+
+    def _extend(self, bits, n, signed):
+        bits = list(bits[:n])
+        fill = bits[-1] if signed and bits else _CONST
+        return bits + [fill]*(n - len(bits))
+
+    def evaluate(self, expr, env=None):
+        """The nodes of the bits of expr, LSB first. Reads the signals in
+        env from there, like a comb block reads what it assigned."""
+        if isinstance(expr, Constant):
+            return [_CONST]*len(expr)
+        if isinstance(expr, Signal):
+            if env is not None and (expr, 0) in env:
+                for bit in range(len(expr)):
+                    self.read.add((expr, bit))
+                return [env[(expr, bit)] for bit in range(len(expr))]
+            return [self.leaf(expr, bit) for bit in range(len(expr))]
+        if isinstance(expr, _Slice):
+            return self.evaluate(expr.value, env)[expr.start:expr.stop]
+        if isinstance(expr, Cat):
+            bits = []
+            for part in expr.l:
+                bits += self.evaluate(part, env)
+            return bits
+        if isinstance(expr, Replicate):
+            return self.evaluate(expr.v, env)*expr.n
+        if isinstance(expr, _Part):
+            value = self.evaluate(expr.value, env)
+            select = self.evaluate(expr.offset, env)
+            return [self.combine(value + select)]*expr.width
+        if isinstance(expr, _Operator):
+            return self._operator(expr, env)
+        raise TypeError("can't estimate {}".format(expr))
+
+    def _operator(self, expr, env):
+        n, signed = value_bits_sign(expr)
+        op = expr.op
+        operands = [self.evaluate(o, env) for o in expr.operands]
+        if op == "m":
+            select = self.combine(operands[0])
+            a = self._extend(operands[1], n, value_bits_sign(expr.operands[1])[1])
+            b = self._extend(operands[2], n, value_bits_sign(expr.operands[2])[1])
+            return [self.combine([select, x, y]) for x, y in zip(a, b)]
+        if len(operands) == 1:
+            a = self._extend(operands[0], n, value_bits_sign(expr.operands[0])[1])
+            if op == "~":
+                return [self.combine([x]) for x in a]
+            # negation
+            return self.carry_chain([self.combine([x]) for x in a],
+                                    [_CONST]*n, n)
+        width = max(len(operands[0]), len(operands[1]))
+        a, b = [self._extend(bits, width, value_bits_sign(o)[1])
+                for bits, o in zip(operands, expr.operands)]
+        if op in ("&", "|", "^"):
+            return [self.combine([x, y]) for x, y in zip(a, b)][:n] + \
+                [_CONST]*(n - width)
+        if op in ("==", "!="):
+            pairs = [self.combine([x, y]) for x, y in zip(a, b)]
+            return [self.combine(pairs)] + [_CONST]*(n - 1)
+        if op in ("+", "-"):
+            return self.carry_chain(a, b, n)
+        if op in ("<", "<=", ">", ">="):
+            return self.carry_chain(a, b, width)[-1:] + [_CONST]*(n - 1)
+        if op in ("<<<", ">>>") and isinstance(expr.operands[1], Constant):
+            shift = expr.operands[1].value
+            if op == "<<<":
+                return ([_CONST]*shift + operands[0])[:n]
+            return self._extend(operands[0][shift:], n, signed)
+        # barrel shifters, multipliers: anything can reach any bit
+        every = self.combine(operands[0] + operands[1])
+        return [every]*n
+
+    # statements
+
+    def execute(self, statements, env, reads):
+        for statement in statements:
+            if isinstance(statement, _Assign):
+                bits = self._extend(self.evaluate(statement.r, reads),
+                                    len(statement.l),
+                                    value_bits_sign(statement.r)[1])
+                for (signal, bit), node in zip(self._target_bits(statement.l),
+                                               bits):
+                    env[(signal, bit)] = node
+            elif isinstance(statement, If):
+                cond = self.combine(self.evaluate(statement.cond, reads))
+                self._branch(env, reads, [(cond, statement.t)], statement.f)
+            elif isinstance(statement, Case):
+                test = self.evaluate(statement.test, reads)
+                choices = []
+                default = []
+                for value, body in statement.cases.items():
+                    if isinstance(value, str):
+                        default = body
+                    else:
+                        choices.append((self.combine(test), body))
+                self._branch(env, reads, choices, default)
+            elif isinstance(statement, (list, tuple)):
+                self.execute(statement, env, reads)
+            # Display, Finish: simulation only
+
+    def _branch(self, env, reads, choices, default):
+        """Runs the bodies of choices (condition, statements) and default
+        on copies of env, then muxes the bits any of them assigned."""
+        comb = env is reads
+        envs = []
+        for cond, body in choices + [(None, default)]:
+            branch = dict(env)
+            self.execute(body, branch, branch if comb else reads)
+            envs.append(branch)
+        for key in set().union(*envs):
+            nodes = [branch.get(key) for branch in envs]
+            if all(node is env.get(key) for node in nodes):
+                continue
+            old = env.get(key, _CONST)
+            conds = [cond for cond, body in choices]
+            env[key] = self.combine(conds + [node or old for node in nodes])
+
+    def _target_bits(self, target):
+        if isinstance(target, Signal):
+            return [(target, bit) for bit in range(len(target))]
+        if isinstance(target, _Slice):
+            return self._target_bits(target.value)[target.start:target.stop]
+        if isinstance(target, Cat):
+            bits = []
+            for part in target.l:
+                bits += self._target_bits(part)
+            return bits
+        raise TypeError("can't estimate assignments to {}".format(target))
+
+
+def _lower(fragment):
+    """fragment lowered like for Verilog output, without the resets."""
+    for name in sorted(list_clock_domains(fragment)):
+        try:
+            fragment.clock_domains[name]
+        except KeyError:
+            fragment.clock_domains.append(ClockDomain(name))
+    fragment = lower_complex_slices(fragment)
+    fragment = lower_basics(fragment)
+    fragment, lowered = lower_specials(dict(), fragment)
+    return lower_basics(fragment)
+
+
+def _submodules(module, path=""):
+    """Yields (dotted path, module) for module and its submodules."""
+    yield path, module
+    for i, (name, submodule) in enumerate(module._submodules):
+        if name is None:
+            name = "{}{}".format(type(submodule).__name__.lower(), i)
+        yield from _submodules(submodule, path + "." + name if path else name)
+
+
+def _ffs(fragment):
+    return sum(len(signal) for statements in fragment.sync.values()
+               for signal in list_targets(statements))
+
+
+def estimate(module, lut_inputs=6, paths=5):
+    """Estimates for module, as a dict: luts, ffs, carry_bits,
+    logic_levels, the critical endpoints with their LUT levels, the
+    memories, the FSMs and the registers of each submodule."""
+    fragment = _lower(module.get_fragment())
+    mapper = _Mapper(fragment, lut_inputs)
+
+    endpoints = []  # (level, signal, bit)
+    ffs = 0
+    for domain, statements in sorted(fragment.sync.items()):
+        env = {}
+        for signal in list_targets(statements):
+            ffs += len(signal)
+            for bit in range(len(signal)):
+                env[(signal, bit)] = mapper.leaf(signal, bit)
+        mapper.execute(statements, env, None)
+        for (signal, bit), node in env.items():
+            if not node.const:
+                level = mapper.levels[mapper.materialize(node)]
+                endpoints.append((level, signal, bit))
+
+    # memories are named after the submodule holding them
+    owners = {}
+    for path, submodule in _submodules(module):
+        for special in submodule._fragment.specials:
+            owners[special] = path
+
+    memories = []
+    for special in sorted(fragment.specials,
+                          key=lambda s: (owners.get(s, ""), s.duid)):
+        if isinstance(special, Memory):
+            memories.append({
+                "name": ".".join(filter(None, [owners.get(special),
+                                               special.name_override])),
+                "width": special.width,
+                "depth": special.depth,
+                "bits": special.width*special.depth,
+                "kind": "distributed" if any(port.async_read
+                                             for port in special.ports)
+                        else "block",
+            })
+            for port in special.ports:
+                for attr in ("adr", "we", "dat_w", "re"):
+                    value = getattr(port, attr)
+                    if isinstance(value, Signal):
+                        for bit, node in enumerate(mapper.evaluate(value)):
+                            if not node.const:
+                                level = mapper.levels[mapper.materialize(node)]
+                                endpoints.append((level, value, bit))
+            continue
+        for obj, attr, direction in special.iter_expressions():
+            value = getattr(obj, attr)
+            if direction == SPECIAL_INPUT and isinstance(value, Signal):
+                for bit, node in enumerate(mapper.evaluate(value)):
+                    if not node.const:
+                        level = mapper.levels[mapper.materialize(node)]
+                        endpoints.append((level, value, bit))
+
+    # comb bits nothing reads are outputs of the module
+    for group in range(len(mapper.groups)):
+        if group not in mapper.comb_done:
+            mapper.comb_done[group] = mapper.run_comb(group)
+    for signal, group in mapper.comb_groups.items():
+        for bit in range(len(signal)):
+            if (signal, bit) not in mapper.read:
+                node = mapper.comb_done[group][(signal, bit)]
+                if not node.const:
+                    level = mapper.levels[mapper.materialize(node)]
+                    endpoints.append((level, signal, bit))
+
+    # named after the attributes of the modules where possible, like in
+    # the VCD dumps, else like in the Verilog output
+    ns = build_namespace(list_signals(fragment))
+    names = {}
+    for path, signal in find_signals(module):
+        names.setdefault(signal, path)
+
+    def name_of(signal):
+        return names.get(signal) or ns.get_name(signal)
+
+    endpoints.sort(key=lambda e: (-e[0], name_of(e[1]), e[2]))
+    critical = []
+    for level, signal, bit in endpoints[:paths]:
+        name = name_of(signal)
+        if len(signal) > 1:
+            name += "[{}]".format(bit)
+        critical.append({"endpoint": name, "levels": level})
+
+    levels = {}
+    for level, signal, bit in endpoints:
+        levels[signal] = max(levels.get(signal, 0), level)
+    fsms = []
+    registers = {}
+    for path, submodule in _submodules(module):
+        if isinstance(submodule, FSM):
+            n = len(submodule.encoding)
+            fsms.append({
+                "path": path,
+                "states": n,
+                "binary_bits": bits_for(n - 1),
+                "one_hot_bits": n,
+                # of the next state logic
+                "levels": levels.get(submodule.state, 0),
+            })
+        if path and _ffs(submodule._fragment):
+            registers[path] = _ffs(submodule._fragment)
+
+    return {
+        "lut_inputs": lut_inputs,
+        "luts": mapper.luts,
+        "ffs": ffs,
+        "carry_bits": mapper.carry_bits,
+        "logic_levels": endpoints[0][0] if endpoints else 0,
+        "critical": critical,
+        "memories": memories,
+        "fsms": fsms,
+        "registers": registers,
+    }
+
+
+def parse_module(spec):
+    """Name:key=value,... -> (name, class, kwargs)."""
+    name, _, args = spec.partition(":")
+    for module in SEARCH:
+        cls = getattr(module, name, None)
+        if cls is not None:
+            break
+    else:
+        raise ValueError("no module {}".format(name))
+    kwargs = {}
+    for arg in filter(None, args.split(",")):
+        key, _, value = arg.partition("=")
+        kwargs[key] = ast.literal_eval(value)
+    return name, cls, kwargs
+
+
+def build(cls, kwargs):
+    if "pads" in inspect.signature(cls).parameters:
+        return cls(None, **kwargs)
+    return cls(**kwargs)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Estimate the LUTs, FFs and"
+                                                 " logic levels of the Migen"
+                                                 " modules")
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES,
+                        help="modules as Name or Name:key=value,..., looked"
+                             " up in pipistrello_i2c and i2c_engine. Default:"
+                             " " + " ".join(DEFAULT_MODULES))
+    parser.add_argument("-k", "--lut-inputs", default=6, type=int,
+                        help="inputs per LUT. Default: 6")
+    parser.add_argument("-p", "--paths", default=5, type=int,
+                        help="critical endpoints to list. Default: 5")
+    parser.add_argument("--json",
+                        help="write the estimates to this file, - for"
+                             " stdout")
+    args = parser.parse_args()
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    results = []
+    for spec in args.modules:
+        name, cls, kwargs = parse_module(spec)
+        result = estimate(build(cls, kwargs), args.lut_inputs, args.paths)
+        result.update(module=name, args=kwargs)
+        results.append(result)
+
+    if args.json == "-":
+        out = sys.stderr
+    else:
+        out = sys.stdout
+    print("{:<32} {:>6} {:>6} {:>6} {:>7} {:>8} {:>7}".format(
+        "module", "LUTs", "FFs", "carry", "levels", "mem bits", "states"),
+        file=out)
+    for r in results:
+        spec = r["module"] + "".join(
+            ":" + ",".join("{}={}".format(*kv) for kv in r["args"].items())
+            for _ in [0] if r["args"])
+        print("{:<32} {luts:>6} {ffs:>6} {carry_bits:>6} {logic_levels:>7}"
+              " {:>8} {:>7}".format(
+                  spec, sum(m["bits"] for m in r["memories"]),
+                  sum(f["states"] for f in r["fsms"]), **r), file=out)
+        for c in r["critical"]:
+            print("    {levels:>2} levels to {endpoint}".format(**c), file=out)
+
+    if args.json:
+        report = {"commit": _commit(), "modules": results}
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            sys.stdout.write("\n")
+        else:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+                f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+"""Runs the gateware tests in parallel.
+
+The TESTS of MODULES are spread over a pool of processes, each is called
+with the VCD settings and the directory of the build artifacts. With --vcd,
+every worker dumps under its own directory, <vcd-dir>/worker<n>/<test>/,
+so the dumps of tests on the same part don't overwrite each other. The
+run ends with the time each test took.
+
+    $ cd i2cslave/targets
+    $ python run_tests.py
+    $ python run_tests.py -j 4 -k Acker,Engine --vcd --vcd-window 50
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from vcd_helpers import VCDSettings, add_vcd_args, vcd_settings
+
+MODULES = ["i2c_parts", "i2c_munger", "i2c_sim"]
+
+# The modules are imported as part of the package, some import their
+# neighbours relatively
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, os.pardir))
+
+
+def _import(module_name):
+    return importlib.import_module("i2cslave.targets." + module_name)
+
+
+def discover(select=None):
+    """Names of the TESTS of MODULES, as module.function, only those
+    containing one of the select strings if given."""
+    names = []
+    for module_name in MODULES:
+        for test in _import(module_name).TESTS:
+            name = "%s.%s" % (module_name, test.__name__)
+            if select is None or any(s in name for s in select):
+                names.append(name)
+    return names
+
+
+# Set up in each process of the pool by _init_worker()
+_worker = {}
+
+
+def _init_worker(counter, vcd_dir):
+    with counter.get_lock():
+        _worker["index"] = counter.value
+        counter.value += 1
+    _worker["dir"] = os.path.join(vcd_dir, "worker%d" % _worker["index"])
+
+
+def _run(name, vcd, artifacts):
+    """Runs one test in a worker, returns its result with the output it
+    printed and the traceback if it failed."""
+    module_name, function = name.rsplit(".", 1)
+    test = getattr(_import(module_name), function)
+
+    if vcd is not None:
+        directory = os.path.join(_worker["dir"], name)
+        os.makedirs(directory, exist_ok=True)
+        vcd = VCDSettings(directory, vcd.signals, vcd.window, vcd.compress)
+
+    output = io.StringIO()
+    error = None
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            test(vcd, artifacts)
+    except Exception:
+        error = traceback.format_exc()
+    return {
+        "name": name,
+        "worker": _worker["index"],
+        "seconds": time.perf_counter() - start,
+        "error": error,
+        "output": output.getvalue(),
+    }
+
+
+def _indent(text):
+    return "".join("    " + line for line in text.splitlines(True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the gateware tests in"
+                                                 " parallel")
+    parser.add_argument("-j", "--jobs", default=os.cpu_count(), type=int,
+                        help="number of worker processes."
+                             " Default: one per CPU")
+    parser.add_argument("-k", "--select",
+                        help="comma separated parts of the names of the"
+                             " tests to run. Default: all")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="list the tests and exit")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="print the output of every test, not only of"
+                             " the failed ones")
+    parser.add_argument("--artifacts", default="build",
+                        help="directory of the Verilog of the parts."
+                             " Default: build")
+    parser.add_argument("--json",
+                        help="also write the results to this file")
+    add_vcd_args(parser)
+    args = parser.parse_args()
+    vcd = vcd_settings(args)
+
+    names = discover(args.select.split(",") if args.select else None)
+    if args.list:
+        print("\n".join(names))
+        return 0
+    if not names:
+        print("no tests selected")
+        return 1
+
+    counter = multiprocessing.Value("i", 0)
+    results = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(names)),
+                             initializer=_init_worker,
+                             initargs=(counter, args.vcd_dir)) as pool:
+        futures = [pool.submit(_run, name, vcd, args.artifacts)
+                   for name in names]
+        for future in as_completed(futures):
+            r = future.result()
+            results.append(r)
+            print("{:<4} {} ({:.2f}s)".format("FAIL" if r["error"] else "ok",
+                                              r["name"], r["seconds"]))
+            if args.verbose or r["error"]:
+                sys.stdout.write(_indent(r["output"]))
+            if r["error"]:
+                sys.stdout.write(_indent(r["error"]))
+    wall = time.perf_counter() - start
+
+    failed = [r for r in results if r["error"]]
+    print()
+    print("{:>8} {:>6}  {}".format("seconds", "worker", "test"))
+    for r in sorted(results, key=lambda r: r["seconds"], reverse=True):
+        print("{seconds:>8.2f} {worker:>6}  {name}".format(**r))
+    print("{} tests, {} failed, {:.2f}s of tests in {:.2f}s".format(
+        len(results), len(failed), sum(r["seconds"] for r in results), wall))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"seconds": wall, "tests": results}, f, indent=2)
+            f.write("\n")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
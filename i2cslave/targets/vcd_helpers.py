@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sw=4 et sts=4 ai:
+
+import fnmatch
+import gzip
+import os
+
+from migen import *
+
+
+class VCDSettings:
+    """What the simulations dump, pass None instead to dump nothing.
+
+    signals are fnmatch patterns on the dotted attribute paths of the
+    signals in the DUT ("scl", "fsm.state", "data.*"), None for all of
+    them. With window set, only that many cycles on each side of the
+    first failure are kept, and runs that don't fail dump nothing.
+    """
+    def __init__(self, directory=".", signals=None, window=None,
+                 compress=True):
+        self.directory = directory
+        self.signals = signals
+        self.window = window
+        self.compress = compress
+
+
+def add_vcd_args(parser):
+    parser.add_argument("--vcd", action="store_true",
+                        help="dump the simulations to VCD files")
+    parser.add_argument("--vcd-dir", default=".",
+                        help="directory of the VCD files. Default: .")
+    parser.add_argument("--vcd-signals",
+                        help="comma separated patterns of the signals to"
+                             " dump, like scl,fsm.*. Default: all")
+    parser.add_argument("--vcd-window", type=int,
+                        help="only dump this many cycles on each side of"
+                             " the first failure")
+    parser.add_argument("--vcd-no-compress", action="store_true",
+                        help="write plain .vcd files instead of .vcd.gz")
+
+
+def vcd_settings(args):
+    """The VCDSettings add_vcd_args() options ask for, or None."""
+    if not args.vcd:
+        return None
+    return VCDSettings(
+        directory=args.vcd_dir,
+        signals=args.vcd_signals.split(",") if args.vcd_signals else None,
+        window=args.vcd_window,
+        compress=not args.vcd_no_compress)
+
+
+def find_signals(obj, prefix="", seen=None):
+    """Yields (dotted path, signal) for the signals in the attributes of
+    obj and of its submodules."""
+    if seen is None:
+        seen = set()
+    seen.add(id(obj))
+    for name, value in sorted(vars(obj).items()):
+        if name.startswith("_"):
+            continue
+        if isinstance(value, Signal):
+            yield prefix + name, value
+        elif isinstance(value, Module) and id(value) not in seen:
+            yield from find_signals(value, prefix + name + ".", seen)
+
+
+class VCDDump:
+    """Records the signals of dut while recorder() runs alongside the
+    simulation, only keeping their changes, and writes them out once the
+    outcome is known.
+    """
+    def __init__(self, name, dut, settings):
+        self.name = name
+        self.dut = dut
+        self.settings = settings
+        self.cycle = 0
+        self.signals = []
+        self.changes = []  # (cycle, index in signals, value)
+
+    def _select(self):
+        patterns = self.settings.signals
+        # found once the simulator has finalized the DUT, fsm.state only
+        # exists from then on
+        for path, signal in find_signals(self.dut):
+            if patterns is None or any(fnmatch.fnmatchcase(path, p)
+                                       for p in patterns):
+                self.signals.append((path, signal))
+
+    @passive
+    def recorder(self):
+        self._select()
+        last = [None]*len(self.signals)
+        while True:
+            for i, (path, signal) in enumerate(self.signals):
+                value = yield signal
+                if value != last[i]:
+                    self.changes.append((self.cycle, i, value))
+                    last[i] = value
+            self.cycle += 1
+            yield
+
+    def write(self, failure=None):
+        """Writes the file, with failure the cycle of the first failure.
+        Returns its name, None if nothing was written."""
+        window = self.settings.window
+        first, last = 0, self.cycle
+        if window is not None:
+            if failure is None:
+                return None
+            first, last = max(0, failure - window), failure + window
+
+        filename = os.path.join(self.settings.directory, self.name + ".vcd")
+        if self.settings.compress:
+            filename += ".gz"
+            f = gzip.open(filename, "wt")
+        else:
+            f = open(filename, "w")
+        with f:
+            self._write(f, first, last, failure)
+        return filename
+
+    def _write(self, f, first, last, failure):
+        f.write("$timescale 10 ns $end\n")
+        if failure is not None:
+            f.write("$comment first failure at cycle {} $end\n".format(failure))
+        scope = []
+        for i, (path, signal) in enumerate(self.signals):
+            parts = path.split(".")
+            while scope != parts[:len(scope)]:
+                f.write("$upscope $end\n")
+                scope.pop()
+            for name in parts[len(scope):-1]:
+                f.write("$scope module {} $end\n".format(name))
+                scope.append(name)
+            f.write("$var wire {} s{} {} $end\n".format(len(signal), i,
+                                                       parts[-1]))
+        for name in scope:
+            f.write("$upscope $end\n")
+        f.write("$enddefinitions $end\n")
+
+        def value(i, v):
+            if len(self.signals[i][1]) == 1:
+                return "{}s{}\n".format(v & 1, i)
+            return "b{:b} s{}\n".format(v & (2**len(self.signals[i][1]) - 1), i)
+
+        # values at the start of the window, then the changes in it
+        start = {}
+        time = None
+        for cycle, i, v in self.changes:
+            if cycle <= first:
+                start[i] = v
+                continue
+            if cycle > last:
+                break
+            if time is None:
+                f.write("#{}\n".format(first))
+                f.writelines(value(i, v) for i, v in sorted(start.items()))
+            if cycle != time:
+                f.write("#{}\n".format(cycle))
+                time = cycle
+            f.write(value(i, v))
+        if time is None:
+            f.write("#{}\n".format(first))
+            f.writelines(value(i, v) for i, v in sorted(start.items()))
+        f.write("#{}\n".format(min(last, self.cycle)))
+
+
+def simulate(dut, generators, name, vcd=None, fragment=None):
+    """run_simulation() recording a VCDDump of dut with vcd settings.
+
+    Returns the VCDDump to write() once the outcome is known. If the
+    simulation raises, it is written right away around that cycle. Pass
+    the fragment of dut if it has been taken already.
+    """
+    if fragment is None:
+        fragment = dut
+    if vcd is None:
+        run_simulation(fragment, generators)
+        return None
+    dump = VCDDump(name, dut, vcd)
+    try:
+        run_simulation(fragment, list(generators) + [dump.recorder()])
+    except Exception:
+        dump.write(failure=dump.cycle)
+        raise
+    return dump
@@ -1,54 +1,181 @@
 import struct
 import argparse
+import os
 import sys
 
 
+# Data records of a C2 image carry 10 bits of length
+MAX_RECORD = 1023
+# Every record costs its length and load address
+RECORD_HEADER = 4
+# Loads 0x00 into CPUCS, taking the CPU out of reset
+TRAILER = b'\x80\x01\xE6\x00\x00\x00\x00\x00'
+
+
 def getparser():
     p = argparse.ArgumentParser(description="Firmware to Header tool")
     p.add_argument("-i", "--input", required=True,
-                   help="input file in .bin format.")
+                   help="input file in .bin format, or Intel HEX (.ihx,"
+                        " .hex) whose records are loaded as they are.")
     p.add_argument("-o", "--output", default="firmware.h",
-                   help="output header file. Default: firmware.h")
+                   help="output file. Default: firmware.h")
     p.add_argument("-s", "--speed", default=400, type=int, choices=[100, 400],
                    help="I2C bootload speed in kHz. Default is 100."
                         " Choices are 100 or 400")
+    p.add_argument("-f", "--format", default="header",
+                   choices=["header", "raw", "asm"],
+                   help="header: a C array. raw: the EEPROM image as is."
+                        " asm: an assembler file to link in, which includes"
+                        " the raw image written next to it with a .bin"
+                        " extension. Default: header")
+    p.add_argument("-n", "--name", default="fx2fw",
+                   help="name of the C array, or prefix of the _start, _end"
+                        " and _size symbols in asm. Default: fx2fw")
     return p
 
 
-def print_bin_to_header(eeprom, filename):
+def read_ihex(filename):
+    """The bytes of an Intel HEX file, as a dict of address: byte."""
+    memory = {}
+    base = 0
+    with open(filename) as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith(":"):
+                raise ValueError("{}:{}: not a record".format(filename, n))
+            record = bytes.fromhex(line[1:])
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ValueError("{}:{}: bad length".format(filename, n))
+            if sum(record) & 0xff:
+                raise ValueError("{}:{}: bad checksum".format(filename, n))
+            _, address, kind = struct.unpack(">BHB", record[:4])
+            data = record[4:-1]
+            if kind == 0x00:
+                for i, b in enumerate(data):
+                    memory[base + address + i] = b
+            elif kind == 0x01:
+                break
+            elif kind == 0x02:
+                base = struct.unpack(">H", data)[0] << 4
+            elif kind == 0x04:
+                base = struct.unpack(">H", data)[0] << 16
+            # 0x03 and 0x05, start addresses, mean nothing to the FX2
+    if any(a > 0xffff for a in memory):
+        raise ValueError("{}: data past 64 KB".format(filename))
+    return memory
+
+
+def segments(memory):
+    """Splits memory (address: byte) into (address, bytes) segments.
+
+    Gaps shorter than a record header are filled with zeros rather than
+    starting another record, so the records end up as short as they can
+    be. Segments are split to fit in MAX_RECORD.
+    """
+    runs = []
+    for address in sorted(memory):
+        if runs and address - runs[-1][1] < RECORD_HEADER:
+            runs[-1][1] = address + 1
+        else:
+            runs.append([address, address + 1])
+    result = []
+    for start, end in runs:
+        for first in range(start, end, MAX_RECORD):
+            last = min(first + MAX_RECORD, end)
+            result.append((first, bytes(memory.get(a, 0)
+                                        for a in range(first, last))))
+    return result
+
+
+def c2_image(segs, speed=400):
+    """The C2 EEPROM image loading segs into the FX2 at boot."""
+    if speed == 100:
+        config_byte = b'\x00'  # 100 kHz
+    else:
+        config_byte = b'\x01'  # 400 kHz
+
+    eeprom = b'\xC2\xaa\x55\x11\x22\x33\x44' + config_byte
+    for address, data in segs:
+        eeprom += struct.pack(">HH", len(data), address)
+        eeprom += data
+    eeprom += TRAILER
+    return eeprom
+
+
+def print_bin_to_header(eeprom, filename, name="fx2fw"):
     with open(filename, "w+") as f:
         l = len(eeprom)
-        header = "unsigned char fx2fw[" + str(l) + "] = {"
+        header = "unsigned char " + name + "[" + str(l) + "] = {"
         header += ",".join(["0x{:02X}".format(b) for b in eeprom])
         header += "};"
 
         f.write(header)
 
 
+def write_raw(eeprom, filename):
+    with open(filename, "wb") as f:
+        f.write(eeprom)
+
+
+def write_asm(eeprom, filename, name="fx2fw"):
+    """Writes the image to filename with a .bin extension, and filename
+    for the assembler to pull it in from there. The image goes to a
+    section of its own, .rodata.<name>, between <name>_start and
+    <name>_end, and <name>_size is its length:
+
+        extern const uint8_t fx2fw_start[], fx2fw_size[];
+        size_t size = (size_t)fx2fw_size;
+    """
+    binary = os.path.splitext(filename)[0] + ".bin"
+    write_raw(eeprom, binary)
+    with open(filename, "w") as f:
+        f.write("/* Generated by fw2header.py, {} bytes */\n"
+                "\t.section .rodata.{name}, \"a\"\n"
+                "\t.global {name}_start\n"
+                "\t.global {name}_end\n"
+                "\t.global {name}_size\n"
+                "\t.balign 4\n"
+                "{name}_start:\n"
+                "\t.incbin \"{}\"\n"
+                "{name}_end:\n"
+                "\t.set {name}_size, {name}_end - {name}_start\n".format(
+                    len(eeprom), os.path.basename(binary), name=name))
+
+
 if __name__ == "__main__":
     args = getparser().parse_args()
-    eeprom = bytes()
-    fw = bytes()
 
     if args.input.endswith(".ihx") or args.input.endswith(".hex"):
-        print("""Error: the input file needs to be in .bin format
-You can convert a .hex (or .ihex) into .bin by using objcopy.
-eg: $ objcopy -Iihex -Obinary in.hex out.bin""")
-        sys.exit(1)
-
-    with open(args.input, "rb") as f:
-        fw += f.read()
-        fw_len = len(fw)
-
-        if args.speed == 100:
-            config_byte = b'\x00'  # 100 kHz
-        else:
-            config_byte = b'\x01'  # 400 kHz
+        try:
+            memory = read_ihex(args.input)
+        except ValueError as e:
+            print("Error: {}".format(e))
+            sys.exit(1)
+        if not memory:
+            print("Error: {} holds no data".format(args.input))
+            sys.exit(1)
+        # objcopy -Obinary would have filled the image from its first byte
+        # to its last, to be loaded in one go
+        span = max(memory) + 1 - min(memory)
+    else:
+        with open(args.input, "rb") as f:
+            fw = f.read()
+        memory = dict(enumerate(fw))
+        span = len(fw)
 
-        eeprom = b'\xC2\xaa\x55\x11\x22\x33\x44' + config_byte
-        eeprom += struct.pack(">H", fw_len)
-        eeprom += struct.pack(">H", 0)
-        eeprom += fw
-        eeprom += b'\x80\x01\xE6\x00\x00\x00\x00\x00'
+    segs = segments(memory)
+    eeprom = c2_image(segs, args.speed)
+    # Against the one record image, as loaded before the C2 record length
+    # was respected
+    single = 8 + RECORD_HEADER + span + len(TRAILER)
+    print("{}: {} bytes in {} records, {:+d} bytes against a single record"
+          .format(args.output, len(eeprom), len(segs), len(eeprom) - single))
 
-    print_bin_to_header(eeprom, args.output)
+    if args.format == "raw":
+        write_raw(eeprom, args.output)
+    elif args.format == "asm":
+        write_asm(eeprom, args.output, args.name)
+    else:
+        print_bin_to_header(eeprom, args.output, args.name)
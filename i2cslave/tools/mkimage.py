@@ -0,0 +1,46 @@
+import struct
+import argparse
+import zlib
+
+
+# See software/image.h
+MAGIC = 0x49324349
+HEADER = ">III"
+
+
+def getparser():
+    p = argparse.ArgumentParser(
+        description="Builds the image partition the firmware serves from"
+                    " flash with --i2c-image-flash")
+    p.add_argument("-i", "--input", action="append", required=True,
+                   help="raw image served at a slave address table entry,"
+                        " repeat for each entry in table order. The FX2"
+                        " EEPROM image comes from fw2header.py -f raw.")
+    p.add_argument("-o", "--output", default="images.bin",
+                   help="output file. Default: images.bin")
+    return p
+
+
+def partition(images):
+    """The partition holding images (a list of bytes), in order."""
+    out = b""
+    for image in images:
+        out += struct.pack(HEADER, MAGIC, len(image), zlib.crc32(image))
+        out += image
+        # Keeps the next header word aligned
+        out += b"\xff" * (-len(image) % 4)
+    return out
+
+
+if __name__ == "__main__":
+    args = getparser().parse_args()
+
+    images = []
+    for filename in args.input:
+        with open(filename, "rb") as f:
+            images.append(f.read())
+    with open(args.output, "wb") as f:
+        f.write(partition(images))
+    for filename, image in zip(args.input, images):
+        print("{}: {} bytes, CRC {:08x}".format(filename, len(image),
+                                                zlib.crc32(image)))
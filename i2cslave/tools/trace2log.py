@@ -0,0 +1,142 @@
+import struct
+import argparse
+import sys
+
+
+SYNC = 0xA5
+FRAME_LEN = 10  # sync, timestamp(4), addr(2), value, flags, checksum
+
+FLAG_HIT = 0x01
+FLAG_FLUSH = 0x04
+FLAG_DROPPED = 0x80
+
+
+def getparser():
+    p = argparse.ArgumentParser(description="Decode the firmware trace stream"
+                                            " into I2C transaction logs")
+    p.add_argument("-i", "--input", default="-",
+                   help="captured UART stream. Default: stdin")
+    p.add_argument("-c", "--clk-freq", default=83333333, type=int,
+                   help="sys clock frequency in Hz. Default: 83333333")
+    p.add_argument("-g", "--gap", default=1000, type=float,
+                   help="start a new transaction after a gap of this many us."
+                        " Default: 1000")
+    p.add_argument("-r", "--raw", action="store_true",
+                   help="print every event instead of grouping them")
+    return p
+
+
+def decode(data):
+    """Split the stream into trace events and console text.
+
+    Yields ("event", (timestamp, addr, value, flags)) and ("text", bytes).
+    """
+    i = 0
+    text_start = 0
+    while i <= len(data) - FRAME_LEN:
+        frame = data[i:i + FRAME_LEN]
+        payload = frame[1:9]
+        checksum = 0
+        for b in payload:
+            checksum ^= b
+        if frame[0] == SYNC and frame[9] == checksum:
+            if text_start != i:
+                yield "text", data[text_start:i]
+            yield "event", struct.unpack(">IHBB", payload)
+            i += FRAME_LEN
+            text_start = i
+        else:
+            i += 1
+    if text_start != len(data):
+        yield "text", data[text_start:]
+
+
+def _flush(run, addr):
+    """Drops the bytes of run from addr on, which the master never read.
+    Returns None when none are left."""
+    n = (addr - run["addr"]) & 0xffff
+    if n < len(run["data"]):
+        del run["data"][n:]
+        del run["hits"][n:]
+    return run if run["data"] else None
+
+
+def group(events, gap_cycles):
+    """Merge runs of consecutive addresses into transactions.
+
+    The firmware records bytes as it queues them, the flush that follows
+    a transaction takes back the bytes queued for it but never read."""
+    run = None
+    for timestamp, addr, value, flags in events:
+        if flags & FLAG_FLUSH:
+            if run:
+                run = _flush(run, addr)
+            continue
+        if flags & FLAG_DROPPED:
+            if run:
+                yield run
+                run = None
+            yield {"timestamp": timestamp, "dropped": addr}
+            continue
+        if (run is not None and
+                addr == (run["addr"] + len(run["data"])) & 0xffff and
+                (timestamp - run["last"]) & 0xffffffff <= gap_cycles):
+            run["data"].append(value)
+            run["hits"].append(bool(flags & FLAG_HIT))
+            run["last"] = timestamp
+            continue
+        if run:
+            yield run
+        run = {"timestamp": timestamp, "last": timestamp, "addr": addr,
+               "data": [value], "hits": [bool(flags & FLAG_HIT)]}
+    if run:
+        yield run
+
+
+def format_time(timestamp, clk_freq):
+    return "[{:14.6f} ms]".format(timestamp * 1e3 / clk_freq)
+
+
+if __name__ == "__main__":
+    args = getparser().parse_args()
+
+    if args.input == "-":
+        data = sys.stdin.buffer.read()
+    else:
+        with open(args.input, "rb") as f:
+            data = f.read()
+
+    events = []
+    for kind, item in decode(data):
+        if kind == "text":
+            sys.stderr.write(item.decode("ascii", "replace"))
+        else:
+            events.append(item)
+
+    if args.raw:
+        for timestamp, addr, value, flags in events:
+            if flags & FLAG_DROPPED:
+                print("{} dropped {} events".format(
+                    format_time(timestamp, args.clk_freq), addr))
+            elif flags & FLAG_FLUSH:
+                print("{} 0x{:04X} on flushed unread".format(
+                    format_time(timestamp, args.clk_freq), addr))
+            else:
+                print("{} 0x{:04X} = 0x{:02X} {}".format(
+                    format_time(timestamp, args.clk_freq), addr, value,
+                    "hit" if flags & FLAG_HIT else "miss"))
+        sys.exit(0)
+
+    gap_cycles = args.gap * args.clk_freq / 1e6
+    for t in group(events, gap_cycles):
+        if "dropped" in t:
+            print("{} dropped {} events".format(
+                format_time(t["timestamp"], args.clk_freq), t["dropped"]))
+            continue
+        line = "{} read 0x{:04X}+{}: {}".format(
+            format_time(t["timestamp"], args.clk_freq), t["addr"],
+            len(t["data"]), " ".join("{:02X}".format(b) for b in t["data"]))
+        misses = t["hits"].count(False)
+        if misses:
+            line += " ({} outside the image)".format(misses)
+        print(line)
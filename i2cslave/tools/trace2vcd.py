@@ -0,0 +1,127 @@
+import argparse
+import sys
+
+
+# The layout of the capture entries, targets/pipistrello_i2c.py builds
+# them from these: I2CShiftReg.trace_states, numbered in this order
+STATES = [
+    "WAIT_START", "RCV_ADDRESS", "ACK_ADDRESS0", "ACK_ADDRESS1",
+    "ACK_ADDRESS2", "PAUSE", "DO_READ", "ACK_READ0", "ACK_READ1",
+    "DO_WRITE", "ACK_WRITE0", "ACK_WRITE1", "ACK_WRITE2",
+]
+
+COUNT_BITS = 12
+# name, width, from bit COUNT_BITS of each entry up
+FIELDS = [
+    ("scl", 1),
+    ("sda", 1),
+    ("scl_drv", 1),
+    ("sda_drv", 1),
+    ("state", 4),
+    ("rx_level", 6),
+    ("tx_level", 6),
+]
+
+
+def getparser():
+    p = argparse.ArgumentParser(description="Convert the I2C logic analyzer"
+                                            " captures the firmware prints"
+                                            " into VCD files")
+    p.add_argument("-i", "--input", default="-",
+                   help="captured console output. Default: stdin")
+    p.add_argument("-o", "--output", default="trace{}.vcd",
+                   help="VCD file, {} is replaced by the core number."
+                        " Default: trace{}.vcd")
+    p.add_argument("-c", "--clk-freq", default=83333333, type=int,
+                   help="sys clock frequency in Hz. Default: 83333333")
+    return p
+
+
+def parse(lines):
+    """Find the captures in the console output.
+
+    Yields (core, trigger, done, entries) for every "trace" header and the
+    hex words that follow it.
+    """
+    capture = None
+    for line in lines:
+        words = line.split()
+        if words[:1] == ["trace"] and len(words) == 5:
+            if capture:
+                yield capture
+            core, n, trigger, done = (int(w) for w in words[1:])
+            capture = (core, trigger, bool(done), [])
+            remaining = n
+            continue
+        if capture is None or not remaining:
+            continue
+        try:
+            entries = [int(w, 16) for w in words]
+        except ValueError:
+            continue
+        capture[3].extend(entries[:remaining])
+        remaining -= len(entries[:remaining])
+    if capture:
+        yield capture
+
+
+def decode(entries):
+    """Expand the run length encoding.
+
+    Yields (cycle, {field: value}) at the start of every entry.
+    """
+    cycle = 0
+    for entry in entries:
+        values = {}
+        bit = COUNT_BITS
+        for name, width in FIELDS:
+            values[name] = (entry >> bit) & ((1 << width) - 1)
+            bit += width
+        yield cycle, values
+        cycle += (entry & ((1 << COUNT_BITS) - 1)) + 1
+
+
+def write_vcd(f, entries, trigger, clk_freq):
+    ids = {}
+    f.write("$timescale 1 ns $end\n")
+    f.write("$comment states: {} $end\n".format(
+        " ".join("{}={}".format(i, s) for i, s in enumerate(STATES))))
+    f.write("$scope module i2c $end\n")
+    for i, (name, width) in enumerate(FIELDS + [("trigger", 1)]):
+        ids[name] = chr(ord("!") + i)
+        f.write("$var wire {} {} {} $end\n".format(width, ids[name], name))
+    f.write("$upscope $end\n$enddefinitions $end\n")
+
+    last = {}
+    cycle = 0
+    for index, (cycle, values) in enumerate(decode(entries)):
+        values["trigger"] = int(index == trigger)
+        f.write("#{}\n".format(int(cycle*1e9/clk_freq)))
+        for name, width in FIELDS + [("trigger", 1)]:
+            if last.get(name) == values[name]:
+                continue
+            if width == 1:
+                f.write("{}{}\n".format(values[name], ids[name]))
+            else:
+                f.write("b{:b} {}\n".format(values[name], ids[name]))
+        last = values
+    if entries:
+        cycle += (entries[-1] & ((1 << COUNT_BITS) - 1)) + 1
+        f.write("#{}\n".format(int(cycle*1e9/clk_freq)))
+
+
+if __name__ == "__main__":
+    args = getparser().parse_args()
+
+    if args.input == "-":
+        lines = sys.stdin.buffer.read().decode("ascii", "replace").splitlines()
+    else:
+        with open(args.input, "rb") as f:
+            lines = f.read().decode("ascii", "replace").splitlines()
+
+    for core, trigger, done, entries in parse(lines):
+        name = args.output.format(core)
+        with open(name, "w") as f:
+            write_vcd(f, entries, trigger, args.clk_freq)
+        print("{}: {} entries{}".format(
+            name, len(entries), "" if done else ", not triggered"))
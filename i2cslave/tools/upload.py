@@ -0,0 +1,342 @@
+import struct
+import argparse
+import os
+import pty
+import random
+import select
+import sys
+import termios
+import time
+import tty
+import zlib
+
+
+# See software/upload.h
+SYNC = 0xC3
+CHUNK = 256
+MAX_SIZE = 0x10000
+
+BEGIN = 1
+DATA = 2
+COMMIT = 3
+ABORT = 4
+
+ACK = 0
+NAK = 1
+DONE = 2
+ERROR = 3
+
+ERROR_FRAME = 1
+ERROR_SIZE = 2
+ERROR_CRC = 3
+ERRORS = {
+    ERROR_FRAME: "unexpected frame",
+    ERROR_SIZE: "bad device or size",
+    ERROR_CRC: "image does not match its CRC",
+}
+
+REPLY_LEN = 10  # sync, code, value(4), crc(4)
+
+
+class UploadError(Exception):
+    pass
+
+
+def getparser():
+    p = argparse.ArgumentParser(description="Upload an image for the firmware"
+                                            " to serve, over its UART")
+    p.add_argument("-p", "--port",
+                   help="serial port of the firmware console")
+    p.add_argument("-b", "--baud", default=115200, type=int,
+                   help="UART line rate. Default: 115200")
+    p.add_argument("-i", "--input",
+                   help="raw image, e.g. from fw2header.py -f raw")
+    p.add_argument("-d", "--device", default=0, type=int,
+                   help="slave address table entry to serve the image at."
+                        " Default: 0")
+    p.add_argument("-w", "--window", default=8, type=int,
+                   help="data frames sent ahead of their ACK. Default: 8")
+    p.add_argument("-t", "--timeout", default=0.5, type=float,
+                   help="seconds without a reply before sending again."
+                        " Default: 0.5")
+    p.add_argument("--stand-in", action="store_true",
+                   help="instead of uploading, run a model of the firmware"
+                        " on a pseudo terminal, and print its path to upload"
+                        " to")
+    p.add_argument("--error-rate", default=0, type=float,
+                   help="with --stand-in, drop or corrupt this fraction of"
+                        " the bytes received. Default: 0")
+    return p
+
+
+def frame(kind, payload=b""):
+    body = struct.pack(">BH", kind, len(payload)) + payload
+    return bytes([SYNC]) + body + struct.pack(">I", zlib.crc32(body))
+
+
+def reply(code, value):
+    body = struct.pack(">BI", code, value)
+    return bytes([SYNC]) + body + struct.pack(">I", zlib.crc32(body))
+
+
+class ReplyParser:
+    """Picks the replies out of what the UART sends, which also carries
+    console text and trace events."""
+    def __init__(self):
+        self.buf = b""
+
+    def feed(self, data):
+        """Returns the (code, value) of the replies completed by data."""
+        self.buf += data
+        replies = []
+        while True:
+            i = self.buf.find(bytes([SYNC]))
+            if i < 0:
+                self.buf = b""
+                break
+            self.buf = self.buf[i:]
+            if len(self.buf) < REPLY_LEN:
+                break
+            code, value, crc = struct.unpack(">BII", self.buf[1:REPLY_LEN])
+            if zlib.crc32(self.buf[1:6]) == crc:
+                replies.append((code, value))
+                self.buf = self.buf[REPLY_LEN:]
+            else:
+                self.buf = self.buf[1:]
+        return replies
+
+
+def open_port(path, baud):
+    fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+    tty.setraw(fd)
+    attrs = termios.tcgetattr(fd)
+    attrs[4] = attrs[5] = getattr(termios, "B{}".format(baud))
+    termios.tcsetattr(fd, termios.TCSANOW, attrs)
+    return fd
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class Uploader:
+    """Streams images to the firmware over the serial port fd.
+
+    Up to window data frames are in flight. On a NAK the upload goes back
+    to the offset it gives, and when nothing at all comes back for timeout
+    seconds to the last offset ACKed, retries times in a row at most.
+    """
+    def __init__(self, fd, window=8, timeout=0.5, retries=10):
+        self.fd = fd
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.parser = ReplyParser()
+        self.resent = 0
+
+    def _replies(self, timeout):
+        """Waits up to timeout seconds for replies. Returns those completed,
+        as soon as there are some, and whether any byte came at all."""
+        deadline = time.monotonic() + timeout
+        heard = False
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return [], heard
+            r, _, _ = select.select([self.fd], [], [], left)
+            if not r:
+                return [], heard
+            data = os.read(self.fd, 4096)
+            heard = heard or bool(data)
+            # A reply may come in several reads
+            replies = self.parser.feed(data)
+            if replies:
+                return replies, True
+
+    def _request(self, data, code):
+        """Sends data until a reply with code comes, returns its value."""
+        for attempt in range(self.retries):
+            write_all(self.fd, data)
+            deadline = time.monotonic() + self.timeout
+            while time.monotonic() < deadline:
+                replies, _ = self._replies(deadline - time.monotonic())
+                for c, value in replies:
+                    if c == ERROR:
+                        raise UploadError(ERRORS.get(value, value))
+                    if c == code:
+                        return value
+        raise UploadError("no reply")
+
+    def upload(self, device, image):
+        crc = zlib.crc32(image)
+        self._request(frame(BEGIN, struct.pack(">BII", device, len(image),
+                                               crc)), ACK)
+        acked = sent = 0
+        silent = 0
+        while acked < len(image):
+            while sent < len(image) and sent - acked < self.window*CHUNK:
+                chunk = image[sent:sent + CHUNK]
+                write_all(self.fd, frame(DATA, struct.pack(">I", sent) + chunk))
+                sent += len(chunk)
+            replies, heard = self._replies(self.timeout)
+            if not replies and heard:
+                # Only part of a reply, or a corrupt one: the firmware is
+                # there, wait for the next
+                continue
+            if not replies:
+                silent += 1
+                if silent == self.retries:
+                    raise UploadError("no reply at offset {}".format(acked))
+                self.resent += sent - acked
+                sent = acked
+                continue
+            silent = 0
+            for code, value in replies:
+                if code == ERROR:
+                    raise UploadError(ERRORS.get(value, value))
+                if code == ACK and value > acked:
+                    acked = value
+                elif code == NAK and value >= acked:
+                    acked = value
+                    self.resent += sent - value
+                    sent = value
+        # The firmware checks the image against its CRC and serves it
+        # between two transactions, then sends it back
+        if self._request(frame(COMMIT), DONE) != crc:
+            raise UploadError("image served has another CRC")
+        return crc
+
+
+class StandIn:
+    """Model of the firmware side of software/upload.c on a pseudo
+    terminal, which loses or corrupts error_rate of the bytes received."""
+    def __init__(self, devices=2, error_rate=0, seed=None):
+        self.master, slave = pty.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        self.images = [b""]*devices
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.frame = None
+        self.last_byte = 0
+        self.active = False
+        self.committed = False
+        self.nak_sent = False
+
+    def _reply(self, code, value):
+        write_all(self.master, reply(code, value))
+
+    def _nak(self):
+        if self.active and not self.nak_sent:
+            self._reply(NAK, self.received)
+            self.nak_sent = True
+
+    def _take(self, kind, payload):
+        if kind == BEGIN and len(payload) == 9:
+            device, size, crc = struct.unpack(">BII", payload)
+            if device >= len(self.images) or size > MAX_SIZE:
+                self._reply(ERROR, ERROR_SIZE)
+                return
+            self.device, self.size, self.crc = device, size, crc
+            self.buf = bytearray(size)
+            self.received = 0
+            self.active = True
+            self.committed = False
+            self.nak_sent = False
+            self._reply(ACK, 0)
+        elif kind == DATA and self.active and len(payload) >= 4:
+            offset, = struct.unpack(">I", payload[:4])
+            data = payload[4:]
+            if offset != self.received:
+                self._nak()
+            elif offset + len(data) > self.size:
+                self.active = False
+                self._reply(ERROR, ERROR_SIZE)
+            else:
+                self.buf[offset:offset + len(data)] = data
+                self.received += len(data)
+                self.nak_sent = False
+                self._reply(ACK, self.received)
+        elif kind == COMMIT and self.committed:
+            self._reply(DONE, self.crc)
+        elif kind == COMMIT and self.active:
+            self.active = False
+            if self.received != self.size or zlib.crc32(self.buf) != self.crc:
+                self._reply(ERROR, ERROR_CRC)
+                return
+            # The old image is served up to here
+            self.images[self.device] = bytes(self.buf)
+            self.committed = True
+            print("device {}: {} bytes, CRC {:08x}".format(
+                self.device, self.size, self.crc))
+            self._reply(DONE, self.crc)
+        elif kind == ABORT:
+            self.active = False
+            self._reply(ACK, 0)
+        else:
+            self._reply(ERROR, ERROR_FRAME)
+
+    def feed(self, data):
+        now = time.monotonic()
+        if self.frame is not None and now - self.last_byte > 0.01:
+            self.frame = None
+        self.last_byte = now
+        for b in data:
+            if self.rng.random() < self.error_rate:
+                if self.rng.random() < 0.5:
+                    continue
+                b ^= 1 << self.rng.randrange(8)
+            if self.frame is None:
+                if b == SYNC:
+                    self.frame = bytearray()
+                continue
+            self.frame.append(b)
+            if len(self.frame) < 3:
+                continue
+            n = 3 + struct.unpack(">H", self.frame[1:3])[0] + 4
+            if n > 3 + 4 + CHUNK + 4:
+                self.frame = None
+                self._nak()
+            elif len(self.frame) == n:
+                f, self.frame = bytes(self.frame), None
+                if zlib.crc32(f[:-4]) != struct.unpack(">I", f[-4:])[0]:
+                    self._nak()
+                else:
+                    self._take(f[0], f[3:-4])
+
+    def run(self):
+        while True:
+            self.feed(os.read(self.master, 4096))
+
+
+if __name__ == "__main__":
+    args = getparser().parse_args()
+
+    if args.stand_in:
+        stand_in = StandIn(error_rate=args.error_rate)
+        print("stand-in on {}".format(stand_in.path))
+        sys.stdout.flush()
+        stand_in.run()
+
+    if not args.port or not args.input:
+        print("Error: --port and --input are needed to upload")
+        sys.exit(1)
+    with open(args.input, "rb") as f:
+        image = f.read()
+    if len(image) > MAX_SIZE:
+        print("Error: {} is larger than {} bytes".format(args.input, MAX_SIZE))
+        sys.exit(1)
+
+    uploader = Uploader(open_port(args.port, args.baud), args.window,
+                        args.timeout)
+    begin = time.monotonic()
+    try:
+        crc = uploader.upload(args.device, image)
+    except UploadError as e:
+        print("Error: {}".format(e))
+        sys.exit(1)
+    seconds = time.monotonic() - begin
+    print("{}: {} bytes in {:.2f}s ({:.0f} B/s), {} sent again, CRC {:08x}"
+          " verified".format(args.input, len(image), seconds,
+                             len(image)/seconds, uploader.resent, crc))